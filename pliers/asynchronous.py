@@ -0,0 +1,172 @@
+''' Asyncio-based execution for Transformers that query remote services.
+
+The client libraries used by the API Transformers all block, so each request
+runs in a thread; the event loop bounds the number of requests in flight,
+spaces them out per service, and retries requests that fail transiently with
+exponential backoff. Requires Python 3.5+; use Transformer.transform_async() and
+Graph.run_async() rather than importing this module directly. '''
+
+from pliers import config
+from pliers.extractors.base import Extractor
+from pliers.graph import _run_transformer
+from pliers.transformers import BatchTransformerMixin
+from pliers.utils import (isiterable, isgenerator, listify,
+                          EnvironmentKeyMixin)
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import asyncio
+import logging
+import requests
+import socket
+import threading
+import time
+
+
+class RateLimiter(object):
+
+    ''' Spaces out requests so that no more than a fixed number are started
+    per second. Limiters are shared by all coroutines (and event loops) in
+    the process.
+    Args:
+        rate (float): Maximum number of requests per second.
+    '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    async def wait(self):
+        ''' Waits until the next request may be started. '''
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + 1.0 / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+_limiters = {}
+
+
+def get_rate_limiter(transformer):
+    ''' Returns the RateLimiter for a Transformer, or None if it isn't rate
+    limited. Limits are looked up in config.api_rate_limits by class name,
+    starting with the Transformer's own class and moving up through its
+    bases, so a limit set for e.g. 'GoogleAPITransformer' is shared by all of
+    the Google Transformers. '''
+    for cls in type(transformer).__mro__:
+        rate = config.api_rate_limits.get(cls.__name__)
+        if rate:
+            key = (cls.__name__, rate)
+            if key not in _limiters:
+                _limiters[key] = RateLimiter(rate)
+            return _limiters[key]
+    return None
+
+
+def _is_transient(err):
+    ''' Returns True if a request failed in a way that is worth retrying: a
+    connection error, a timeout, or a response with a 429 (rate limit) or 5xx
+    (server error) status. Status codes are read from the errors raised by
+    requests, urllib and the Google API client. '''
+    if isinstance(err, (ConnectionError, TimeoutError, socket.timeout,
+                        requests.ConnectionError, requests.Timeout)):
+        return True
+    response = getattr(err, 'response', None)
+    if response is None:
+        response = getattr(err, 'resp', None)
+    status = getattr(response, 'status_code',
+                     getattr(response, 'status', getattr(err, 'code', None)))
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        return False
+    return status == 429 or 500 <= status < 600
+
+
+def _transform(transformer, stims):
+    # Batches go straight to _iterate() to avoid a progress bar per batch
+    if isinstance(stims, list):
+        return list(transformer._iterate(stims))
+    result = transformer.transform(stims)
+    return list(result) if isgenerator(result) else result
+
+
+async def transform_async(transformer, stims, max_in_flight=None,
+                          max_retries=None, retry_backoff=None):
+    ''' Applies a Transformer to one or more Stims, sending up to
+    max_in_flight requests (one per batch, for batch Transformers)
+    concurrently. See Transformer.transform_async() for arguments. '''
+    if max_in_flight is None:
+        max_in_flight = config.api_max_in_flight
+    if max_retries is None:
+        max_retries = config.api_max_retries
+    if retry_backoff is None:
+        retry_backoff = config.api_retry_backoff
+
+    loop = asyncio.get_event_loop()
+    limiter = get_rate_limiter(transformer)
+    semaphore = asyncio.Semaphore(max_in_flight)
+    executor = ThreadPoolExecutor(max_in_flight)
+
+    async def run(stims):
+        async with semaphore:
+            for attempt in range(max_retries + 1):
+                if limiter is not None:
+                    await limiter.wait()
+                try:
+                    return await loop.run_in_executor(executor, _transform,
+                                                      transformer, stims)
+                except Exception as err:
+                    if attempt == max_retries or not _is_transient(err):
+                        raise
+                    delay = retry_backoff * 2 ** attempt
+                    logging.warning("Request by %s failed (%s); retrying in "
+                                    "%.1f seconds." % (transformer.name, err,
+                                                       delay))
+                    await asyncio.sleep(delay)
+
+    try:
+        if not isiterable(stims):
+            return await run(stims)
+        if isinstance(transformer, BatchTransformerMixin):
+            batches = transformer._iter_batches(stims)
+            results = await asyncio.gather(*[run(b) for b in batches])
+            results = list(chain(*results))
+        else:
+            results = await asyncio.gather(*[run(s) for s in stims])
+    finally:
+        executor.shutdown(wait=False)
+
+    if config.drop_bad_extractor_results:
+        results = [r for r in results if r is not None]
+    return results
+
+
+async def run_graph(graph, stim, merge=True, **kwargs):
+    ''' Executes a Graph on the event loop. See Graph.run_async() for
+    arguments. '''
+    loop = asyncio.get_event_loop()
+    outputs = {}
+    for node in graph.nodes.values():
+        node.wall_time = None
+
+    async def run_node(node, stim):
+        # Only API Transformers are worth retrying; others run once, in the
+        # loop's default executor
+        if isinstance(node.transformer, EnvironmentKeyMixin):
+            start = time.time()
+            result = await transform_async(node.transformer, stim, **kwargs)
+            node.wall_time = time.time() - start
+        else:
+            result, node.wall_time = await loop.run_in_executor(
+                None, _run_transformer, node.transformer, stim)
+        if isinstance(node.transformer, Extractor):
+            outputs[node] = listify(result)
+        else:
+            await asyncio.gather(*[run_node(c, result)
+                                   for c in node.children])
+
+    await asyncio.gather(*[run_node(n, stim) for n in graph.roots])
+    return graph._finish(graph._ordered_outputs(outputs), merge)
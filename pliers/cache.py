@@ -0,0 +1,348 @@
+''' Storage backends for memoized Transformer outputs. '''
+
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+from six import with_metaclass, string_types
+from pliers import config
+import numpy as np
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+
+def estimate_size(obj):
+    ''' Returns a rough estimate (in bytes) of the memory held by a
+    Transformer output. Numpy arrays--including the data held by Stims and
+    ExtractorResults--are counted exactly, except for memory-mapped arrays,
+    which are backed by files; everything else falls back on
+    sys.getsizeof(). Quantities derived from a Stim's data (see
+    AudioStim.get_derivative()) are counted with it. Lazily loaded data is
+    not loaded. '''
+    if isinstance(obj, np.memmap):
+        return 0
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(estimate_size(o) for o in obj)
+    if isinstance(obj, string_types):
+        return sys.getsizeof(obj)
+    attrs = getattr(obj, '__dict__', {})
+    size = sys.getsizeof(obj)
+    data = attrs.get('data', attrs.get('_data'))
+    if data is not None and data is not obj:
+        size += estimate_size(data)
+    derivatives = attrs.get('_derivatives')
+    if derivatives:
+        size += sum(estimate_size(d) for d in derivatives.values())
+    return size
+
+
+class Cache(with_metaclass(ABCMeta)):
+
+    ''' Base class for Transformer caches. Keys are the strings computed by
+    Transformer._get_cache_key(). Subclasses keep track of hits, misses and
+    evictions. Persistent caches are also consulted for individual Stims
+    within batches (see BatchTransformerMixin). '''
+
+    persistent = False
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @abstractmethod
+    def _get(self, key, transformer, stim):
+        pass
+
+    @abstractmethod
+    def _set(self, key, value, transformer, stim):
+        pass
+
+    @abstractmethod
+    def clear(self):
+        pass
+
+    @abstractmethod
+    def __contains__(self, key):
+        pass
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    def get(self, key, transformer=None, stim=None):
+        ''' Returns the value stored under key, or raises a KeyError.
+        Args:
+            key (str): The cache key.
+            transformer (Transformer): The Transformer that produced the
+                value. Backends that serialize values use it (and the stim)
+                to restore references that are not stored.
+            stim (Stim): The Stim the value was computed from.
+        '''
+        try:
+            value = self._get(key, transformer, stim)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return value
+
+    def set(self, key, value, transformer=None, stim=None):
+        ''' Stores value under key. See get() for arguments. '''
+        self._set(key, value, transformer, stim)
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def stats(self):
+        ''' Returns a dict with the hit, miss and eviction counts, plus the
+        current number of entries. '''
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self)}
+
+
+class MemoryCache(Cache):
+
+    ''' An in-memory least-recently-used cache.
+    Args:
+        max_entries (int): Maximum number of entries to retain. If None,
+            the value of config.cache_max_entries is used at insertion time.
+        max_bytes (int): Maximum estimated size (in bytes) of all retained
+            entries. If None, the value of config.cache_max_bytes is used at
+            insertion time. Outputs larger than the budget are never cached.
+    '''
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._sizes = {}
+        self.n_bytes = 0
+        # Graph nodes may memoize results from several threads at once
+        self._lock = threading.RLock()
+        super(MemoryCache, self).__init__()
+
+    @property
+    def max_entries(self):
+        if self._max_entries is not None:
+            return self._max_entries
+        return config.cache_max_entries
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return config.cache_max_bytes
+
+    def _get(self, key, transformer, stim):
+        with self._lock:
+            # Re-insert to mark as most recently used
+            value = self._data.pop(key)
+            self._data[key] = value
+            return value
+
+    def _set(self, key, value, transformer, stim):
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            max_bytes = self.max_bytes
+            if max_bytes is not None and size > max_bytes:
+                return
+            self._data[key] = value
+            self._sizes[key] = size
+            self.n_bytes += size
+            self._evict()
+
+    def _remove(self, key):
+        del self._data[key]
+        self.n_bytes -= self._sizes.pop(key)
+
+    def _evict(self):
+        max_entries, max_bytes = self.max_entries, self.max_bytes
+        while self._data and (
+                (max_entries is not None and len(self._data) > max_entries) or
+                (max_bytes is not None and self.n_bytes > max_bytes)):
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.n_bytes = 0
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class _ResultPickler(pickle.Pickler):
+
+    ''' Pickles a Transformer output, replacing the producing Transformer and
+    the input Stim with persistent references so they are never written. '''
+
+    def __init__(self, file, transformer, stim):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self._refs = [('transformer', transformer), ('stim', stim)]
+
+    def persistent_id(self, obj):
+        for name, ref in self._refs:
+            if ref is not None and obj is ref:
+                return name
+        return None
+
+
+class _ResultUnpickler(pickle.Unpickler):
+
+    ''' Restores a Transformer output written by _ResultPickler. '''
+
+    def __init__(self, file, transformer, stim):
+        pickle.Unpickler.__init__(self, file)
+        self._refs = {'transformer': transformer, 'stim': stim}
+
+    def persistent_load(self, pid):
+        return self._refs[pid]
+
+
+class DiskCache(Cache):
+
+    ''' A persistent cache that survives restarts and can be shared by
+    several processes on the same machine. Outputs are pickled into one file
+    per entry; an SQLite database indexes the entries along with the class
+    and VERSION of the Transformer that produced them. The Transformer and
+    input Stim are never pickled--they are re-attached on retrieval.
+    Args:
+        path (str): Directory to store the cache in. If None, the value of
+            config.cache_dir is used (defaulting to ~/pliers_data/cache).
+    '''
+
+    persistent = True
+    _index_file = 'index.sqlite'
+
+    def __init__(self, path=None):
+        self._path = path
+        self._local = threading.local()
+        super(DiskCache, self).__init__()
+
+    @property
+    def path(self):
+        path = self._path or config.cache_dir or \
+            os.path.join('~', 'pliers_data', 'cache')
+        return os.path.abspath(os.path.expanduser(path))
+
+    def _connect(self):
+        path = self.path
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.path != path:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            conn = sqlite3.connect(os.path.join(path, self._index_file),
+                                   timeout=60)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS results (key TEXT '
+                         'PRIMARY KEY, transformer TEXT, version TEXT, '
+                         'size INTEGER, created REAL)')
+            conn.commit()
+            self._local.conn, self._local.path = conn, path
+        return conn
+
+    def _blob_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.pkl')
+
+    def _get(self, key, transformer, stim):
+        conn = self._connect()
+        row = conn.execute('SELECT key FROM results WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        try:
+            with open(self._blob_path(key), 'rb') as f:
+                return _ResultUnpickler(f, transformer, stim).load()
+        except Exception as err:
+            # Missing or unreadable blob; drop the stale index entry
+            logging.debug("Discarding cache entry %s: %s" % (key, err))
+            with conn:
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+            raise KeyError(key)
+
+    def _set(self, key, value, transformer, stim):
+        blob = self._blob_path(key)
+        blob_dir = os.path.dirname(blob)
+        if not os.path.exists(blob_dir):
+            try:
+                os.makedirs(blob_dir)
+            except OSError:  # Created concurrently by another process
+                pass
+        fd, tmp = tempfile.mkstemp(dir=blob_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                _ResultPickler(f, transformer, stim).dump(value)
+        except Exception as err:
+            # Outputs that can't be pickled are simply not cached
+            logging.debug("Unable to cache output for key %s: %s" %
+                          (key, err))
+            os.remove(tmp)
+            return
+        os.rename(tmp, blob)
+        tr_class = transformer.__class__.__name__ if transformer else None
+        version = getattr(transformer, 'VERSION', None)
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO results VALUES '
+                         '(?, ?, ?, ?, ?)', (key, tr_class, version,
+                                             os.path.getsize(blob),
+                                             time.time()))
+
+    def clear(self):
+        conn = self._connect()
+        keys = [r[0] for r in conn.execute('SELECT key FROM results')]
+        with conn:
+            conn.execute('DELETE FROM results')
+        for key in keys:
+            try:
+                os.remove(self._blob_path(key))
+            except OSError:
+                pass
+
+    def __contains__(self, key):
+        return self._connect().execute('SELECT 1 FROM results WHERE key = ?',
+                                       (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self._connect().execute(
+            'SELECT COUNT(*) FROM results').fetchone()[0]
+
+
+CACHE_BACKENDS = {
+    'memory': MemoryCache,
+    'disk': DiskCache
+}
+
+_caches = {}
+
+
+def get_cache(backend=None):
+    ''' Returns the (process-wide) cache instance for the named backend.
+    Args:
+        backend (str): Name of the cache backend; one of the keys in
+            CACHE_BACKENDS. Defaults to config.cache_backend.
+    '''
+    if backend is None:
+        backend = config.cache_backend
+    if backend not in _caches:
+        if backend not in CACHE_BACKENDS:
+            raise ValueError("Unknown cache backend '%s'. Valid values are: "
+                             "%s." % (backend, ', '.join(CACHE_BACKENDS)))
+        _caches[backend] = CACHE_BACKENDS[backend]()
+    return _caches[backend]
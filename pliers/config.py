@@ -1,9 +1,28 @@
 cache_transformers = True
+cache_backend = 'memory'
+cache_max_entries = None
+cache_max_bytes = None
+cache_dir = None
 log_transformations = True
 drop_bad_extractor_results = True
 progress_bar = True
 parallelize = False
 n_jobs = None
+parallel_chunk_size = 16
+adaptive_batching = False
+batch_target_latency = 5.0
+api_max_in_flight = 8
+http_timeout = 60
+http_max_retries = 3
+http_retry_backoff = 0.5
+http_pool_size = 10
+api_rate_limits = {}
+api_max_retries = 3
+api_retry_backoff = 1.0
+prefetch_frames = 16
+derivative_max_bytes = 2**28
+audio_cache_dir = None
+audio_cache_max_bytes = 2**32
 default_converters = {
     'AudioStim->TextStim': ('IBMSpeechAPIConverter', 'WitTranscriptionConverter'),
     'ImageStim->TextStim': ('GoogleVisionAPITextConverter', 'TesseractConverter')
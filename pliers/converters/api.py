@@ -1,16 +1,13 @@
 ''' Converters that query external APIs. '''
 
 import os
-import base64
-import json
 from abc import abstractproperty
 from pliers.stimuli.text import TextStim, ComplexTextStim
 from pliers.utils import (EnvironmentKeyMixin, attempt_to_import,
                           verify_dependencies)
+from pliers import http_session
 from .audio import AudioToTextConverter
-from six.moves.urllib.parse import urlencode
-from six.moves.urllib.request import Request, urlopen
-from six.moves.urllib.error import URLError, HTTPError
+from requests.exceptions import RequestException
 
 sr = attempt_to_import('speech_recognition', 'sr')
 
@@ -155,36 +152,25 @@ class IBMSpeechAPIConverter(AudioToTextConverter, EnvironmentKeyMixin):
             convert_width=None if clip.sample_width >= 2 else 2
         )
         model = "{0}_BroadbandModel".format("en-US")
-        url = "https://stream.watsonplatform.net/speech-to-text/api/v1/recognize?{0}".format(urlencode({
+        url = "https://stream.watsonplatform.net/speech-to-text/api/v1/recognize"
+        params = {
             "profanity_filter": "false",
             "continuous": "true",
             "model": model,
             "timestamps": "true",
             "inactivity_timeout": -1,
-        }))
-        request = Request(url, data=flac_data, headers={
+        }
+        headers = {
             "Content-Type": "audio/x-flac",
             "X-Watson-Learning-Opt-Out": "true",
-        })
-
-        if hasattr("", "encode"):  # Python 2.6 compatibility
-            authorization_value = base64.standard_b64encode(
-                "{0}:{1}".format(self.username, self.password).encode("utf-8")).decode("utf-8")
-        else:
-            authorization_value = base64.standard_b64encode(
-                "{0}:{1}".format(self.username, self.password))
-        request.add_header(
-            "Authorization", "Basic {0}".format(authorization_value))
+        }
 
         try:
-            response = urlopen(request, timeout=None)
-        except HTTPError as e:
-            raise Exception("recognition request failed: {0}".format(
-                getattr(e, "reason", "status {0}".format(e.code))))
-        except URLError as e:
-            raise Exception(
-                "recognition connection failed: {0}".format(e.reason))
-
-        response_text = response.read().decode("utf-8")
-        result = json.loads(response_text)
-        return result
+            # Long clips can take minutes to transcribe, so never time out
+            response = http_session.post(url, params=params, data=flac_data,
+                                         headers=headers, timeout=None,
+                                         auth=(self.username, self.password))
+        except RequestException as e:
+            raise Exception("recognition request failed: {0}".format(e))
+
+        return response.json()
@@ -1,12 +1,19 @@
 ''' Functionality for loading and manipulating text datasets. '''
 
 import zipfile
+import hashlib
 import json
 import os
+import shutil
 import tempfile
 import io
-import requests
+import numpy as np
 import pandas as pd
+from pliers import http_session
+from pliers.utils import attempt_to_import, verify_dependencies
+
+keyedvectors = attempt_to_import('gensim.models.keyedvectors', 'keyedvectors',
+                                 ['KeyedVectors'])
 
 
 def _load_datasets():
@@ -28,13 +35,59 @@ def _get_dictionary_path():
     return dir_path
 
 
+def _get_binary_path(name):
+    return os.path.join(_get_dictionary_path(), name + '.npd')
+
+
+def _write_binary(data, path):
+    ''' Saves an indexed DataFrame as a directory of .npy files--one per
+    column, plus the string index--that _read_binary() memory-maps. '''
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(path))
+    index = data.index.astype(str)
+    np.save(os.path.join(tmp, 'index.npy'), np.asarray(index, dtype='U'))
+    for i, col in enumerate(data.columns):
+        values = data.iloc[:, i]
+        if values.dtype.kind in 'biuf':
+            values = values.values
+        else:
+            values = values.astype(object).values
+        np.save(os.path.join(tmp, 'col_%d.npy' % i), values,
+                allow_pickle=True)
+    meta = {'index': data.index.name, 'columns': list(data.columns)}
+    with io.open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(meta, ensure_ascii=False))
+    if os.path.exists(path):
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmp, path)
+    except OSError:  # Written concurrently by another process
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _read_binary(path):
+    ''' Loads a DataFrame saved by _write_binary(). Numeric columns are
+    memory-mapped rather than read. '''
+    with io.open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    index = pd.Index(np.load(os.path.join(path, 'index.npy')),
+                     name=meta['index'])
+    columns = []
+    for i in range(len(meta['columns'])):
+        col_path = os.path.join(path, 'col_%d.npy' % i)
+        try:
+            columns.append(np.load(col_path, mmap_mode='r'))
+        except ValueError:  # Object arrays can't be memory-mapped
+            columns.append(np.load(col_path, allow_pickle=True))
+    data = pd.DataFrame(dict(enumerate(columns)), index=index, copy=False)
+    data.columns = meta['columns']
+    return data
+
+
 def _download_dictionary(url, format, rename):
 
     tmpdir = tempfile.mkdtemp()
     _file = os.path.join(tmpdir, os.path.basename(url))
-    r = requests.get(url)
-    with open(_file, 'wb') as f:
-        f.write(r.content)
+    http_session.download(url, _file)
 
     if zipfile.is_zipfile(_file):
         with zipfile.ZipFile(_file) as zf:
@@ -78,12 +131,24 @@ def fetch_dictionary(name, url=None, format=None, index=0, rename=None,
             time it is retrieved.
     Returns: A pandas DataFrame indexed by strings (typically words).
 
+    Dictionaries are saved in a binary format that is memory-mapped when
+    they are loaded again; dictionaries saved as CSV files by earlier
+    versions of pliers are converted the first time they are loaded.
     '''
+    binary_path = _get_binary_path(name)
+    if os.path.exists(binary_path):
+        return _read_binary(binary_path)
+
     file_path = os.path.join(_get_dictionary_path(), name + '.csv')
     if os.path.exists(file_path):
         df = pd.read_csv(file_path)
-        index = datasets[name].get('index', df.columns[index])
-        return df.set_index(index)
+        if name in datasets:
+            index = datasets[name].get('index', df.columns[index])
+        elif isinstance(index, int):
+            index = df.columns[index]
+        df = df.set_index(index)
+        _write_binary(df, binary_path)
+        return _read_binary(binary_path)
 
     elif name in datasets:
         url = datasets[name]['url']
@@ -101,6 +166,118 @@ def fetch_dictionary(name, url=None, format=None, index=0, rename=None,
     data = data.set_index(index)
 
     if save:
-        file_path = os.path.join(_get_dictionary_path(), name + '.csv')
-        data.to_csv(file_path, encoding='utf-8')
+        _write_binary(data, binary_path)
+        return _read_binary(binary_path)
     return data
+
+
+_merged = {}
+
+
+def fetch_dictionaries(variables, case_sensitive=True):
+    ''' Retrieve several dictionaries (see fetch_dictionary()) and merge
+    them into a single DataFrame, with columns named '<dictionary>_<column>'.
+    Merged dictionaries are cached both in memory and alongside the saved
+    dictionaries, so repeated calls with the same arguments are fast.
+    Args:
+        variables (dict): The names of the dictionaries to merge, mapped onto
+            lists of the columns to keep (or empty lists to keep all
+            columns).
+        case_sensitive (bool): If False, the index of each dictionary is
+            lowercased before merging.
+    Returns: A pandas DataFrame indexed by strings (typically words).
+    '''
+    # Re-saved dictionaries invalidate any merged copies
+    names = list(variables.keys())
+    for name in names:
+        if not os.path.exists(_get_binary_path(name)):
+            fetch_dictionary(name)
+    stamps = [os.path.getmtime(_get_binary_path(n)) for n in names]
+    spec = json.dumps([list(variables.items()), case_sensitive, stamps])
+    if spec not in _merged:
+        key = hashlib.sha1(spec.encode('utf-8')).hexdigest()
+        path = os.path.join(_get_dictionary_path(), 'merged', key + '.npd')
+        if not os.path.exists(path):
+            dicts = []
+            for k, v in variables.items():
+                d = fetch_dictionary(k)
+                if not case_sensitive:
+                    d.index = d.index.str.lower()
+                if v:
+                    d = d[v]
+                d.columns = ['%s_%s' % (k, c) for c in d.columns]
+                dicts.append(d)
+            data = pd.concat(dicts, axis=1, join='outer')
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            _write_binary(data, path)
+        _merged[spec] = _read_binary(path)
+    return _merged[spec].copy(deep=False)
+
+
+def _get_embedding_path():
+    dir_path = os.path.expanduser(
+        os.path.join('~', 'pliers_data', 'embeddings'))
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    return dir_path
+
+
+def convert_embeddings(embedding_file, binary=False, path=None):
+    ''' Convert a word embedding file into a store that load_embeddings()
+    can memory-map: a float32 matrix of vectors, plus the vocabulary (one
+    word per line) in the order of its rows.
+    Args:
+        embedding_file (str): Path to a word embedding file in word2vec
+            format compatible with gensim.
+        binary (bool): Whether the embedding file is in binary format.
+        path (str): Directory to save the store in. Defaults to a directory
+            under ~/pliers_data/embeddings that identifies the file by its
+            path, size and modification time, so each file is only
+            converted once.
+    Returns: The path of the store.
+    '''
+    if path is None:
+        embedding_file = os.path.abspath(embedding_file)
+        stat = os.stat(embedding_file)
+        key = json.dumps([embedding_file, stat.st_size, stat.st_mtime,
+                          binary])
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        name = os.path.splitext(os.path.basename(embedding_file))[0]
+        path = os.path.join(_get_embedding_path(),
+                            '%s_%s.npe' % (name, key))
+    if not os.path.exists(path):
+        verify_dependencies(['keyedvectors'])
+        model = keyedvectors.KeyedVectors.load_word2vec_format(
+            embedding_file, binary=binary)
+        vocab = getattr(model, 'index_to_key', None) or model.index2word
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+        np.save(os.path.join(tmp, 'vectors.npy'),
+                np.asarray(model.vectors, dtype=np.float32))
+        with io.open(os.path.join(tmp, 'vocab.txt'), 'w',
+                     encoding='utf-8') as f:
+            f.write(u'\n'.join(vocab))
+        try:
+            os.rename(tmp, path)
+        except OSError:  # Converted concurrently by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+    return path
+
+
+_embeddings = {}
+
+
+def load_embeddings(path):
+    ''' Load a store created by convert_embeddings(). Stores are loaded
+    once per process, and their vectors are memory-mapped read-only, so
+    every process using a store shares the same memory.
+    Returns: A tuple of the vocabulary (a pandas Index) and the matrix of
+        vectors, with one row per word.
+    '''
+    path = os.path.abspath(path)
+    if path not in _embeddings:
+        with io.open(os.path.join(path, 'vocab.txt'), encoding='utf-8') as f:
+            vocab = pd.Index(f.read().split(u'\n'), dtype=object)
+        vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        _embeddings[path] = (vocab, vectors)
+    return _embeddings[path]
@@ -1,8 +1,16 @@
 from os.path import exists, isdir, join
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+import numpy as np
+import os
 import pandas as pd
 from six import with_metaclass
-from pliers.extractors.base import ExtractorResult
+from pliers.extractors.base import ExtractorResult, merge_results
+from pliers.utils import attempt_to_import, verify_dependencies
+
+pa = attempt_to_import('pyarrow', 'pa')
+pq = attempt_to_import('pyarrow.parquet', 'pq', ['ParquetWriter'])
+tables = attempt_to_import('tables')
 
 
 class Exporter(with_metaclass(ABCMeta)):
@@ -14,30 +22,77 @@ class Exporter(with_metaclass(ABCMeta)):
         pass
 
 
-def to_long_format(df):
-    ''' Convert from wide to long format, making each row a single
-    feature/value pair.
+# Columns that identify a row rather than hold a feature
+_id_columns = ['stim', 'onset', 'duration', 'stim_name', 'class', 'filename',
+               'history', 'source_file']
+
+
+def iter_long_format(df, chunk_size=10000):
+    ''' Converts a timeline from wide to long format one block of rows at a
+    time, yielding a long-format DataFrame per block (see to_long_format()).
+    Blocks can be passed straight to an exporter--e.g.,
+    ParquetExporter().export(iter_long_format(df), path)--so the full
+    long-format timeline is never held in memory.
 
     Args:
-        df (DataFrame): a timeline that is currently in wide format
+        df (DataFrame, ExtractorResult): a timeline that is currently in wide
+            format
+        chunk_size (int): number of wide-format rows to convert at a time
     '''
     if isinstance(df, ExtractorResult):
         df = df.to_df()
 
-    if isinstance(df.columns, pd.core.index.MultiIndex):
-        ids = list(filter(lambda x: x[1] is '', df.columns))
-        variables = ['extractor', 'feature']
+    if isinstance(df.columns, pd.MultiIndex):
+        ids = [i for i, c in enumerate(df.columns) if c[1] == '']
+        names = [df.columns[i][0] for i in ids]
+        variables = [i for i, c in enumerate(df.columns) if c[1] != '']
+        labels = [('extractor', [df.columns[i][0] for i in variables]),
+                  ('feature', [df.columns[i][1] for i in variables])]
     else:
-        df = df.reset_index() if not isinstance(
-            df.index, pd.Int64Index) else df
-        ids = list(set(df.columns) & set(['stim', 'onset', 'duration']))
-        variables = 'feature'
+        if not pd.api.types.is_integer_dtype(df.index):
+            df = df.reset_index()
+        ids = [i for i, c in enumerate(df.columns) if c in _id_columns]
+        names = [df.columns[i] for i in ids]
+        variables = [i for i, c in enumerate(df.columns)
+                     if c not in _id_columns]
+        labels = [('feature', [df.columns[i] for i in variables])]
+
+    # Labels are categorical, with the same categories in every block
+    codes = []
+    for name, values in labels:
+        label_codes, categories = pd.factorize(pd.Index(values, dtype=object))
+        codes.append((name, label_codes, pd.CategoricalDtype(categories)))
 
-    values = list(set(df.columns) - set(ids))
-    converted = pd.melt(df, id_vars=ids, value_vars=values, var_name=variables)
-    converted.columns = [
-        c[0] if isinstance(c, tuple) else c for c in converted.columns]
-    return converted
+    n_vars = len(variables)
+    for start in range(0, max(len(df), 1), chunk_size):
+        block = df.iloc[start:start + chunk_size]
+        rows = np.repeat(np.arange(len(block)), n_vars)
+        var_codes = np.tile(np.arange(n_vars), len(block))
+        converted = OrderedDict()
+        for name, i in zip(names, ids):
+            converted[name] = block.iloc[:, i].array.take(rows)
+        for name, label_codes, dtype in codes:
+            converted[name] = pd.Categorical.from_codes(
+                label_codes[var_codes], dtype=dtype)
+        converted['value'] = block.iloc[:, variables].to_numpy().ravel()
+        yield pd.DataFrame(converted)
+
+
+def to_long_format(df, chunk_size=None):
+    ''' Convert from wide to long format, making each row a single
+    feature/value pair. Rows are ordered as in the wide timeline, with one
+    row per feature; extractor and feature names are stored as categoricals.
+
+    Args:
+        df (DataFrame): a timeline that is currently in wide format
+        chunk_size (int): optional number of wide-format rows to convert at a
+            time. Use iter_long_format() to avoid holding the whole result
+            in memory.
+    '''
+    if isinstance(df, ExtractorResult):
+        df = df.to_df()
+    blocks = iter_long_format(df, chunk_size or max(len(df), 1))
+    return pd.concat(blocks, ignore_index=True)
 
 
 class FSLExporter(Exporter):
@@ -68,3 +123,200 @@ class FSLExporter(Exporter):
                 d.to_csv(filename, sep='\t', index=False, header=False)
         else:
             return results
+
+
+def _iter_chunks(timeline, chunk_size, long_format=False):
+    # Yields a timeline as DataFrames of at most chunk_size rows, with flat
+    # column names. Timelines can be DataFrames, ExtractorResults, lists of
+    # ExtractorResults (which are merged) or iterables of DataFrames.
+    # If long_format is True, wide DataFrames are converted to long format
+    # first, while their columns still identify extractor and feature.
+    if isinstance(timeline, ExtractorResult):
+        timeline = timeline.to_df()
+    elif isinstance(timeline, (list, tuple)) and timeline and \
+            isinstance(timeline[0], ExtractorResult):
+        timeline = merge_results(timeline)
+    frames = [timeline] if isinstance(timeline, pd.DataFrame) else timeline
+    if long_format:
+        # Blocks of about chunk_size long-format rows
+        frames = (block for df in frames for block in
+                  iter_long_format(df, max(chunk_size // max(df.shape[1], 1),
+                                           1)))
+    # Columns of mixed types (e.g., feature values that are sometimes
+    # numbers and sometimes strings) are stored as strings throughout
+    mixed = set()
+    for df in frames:
+        if isinstance(df.columns, pd.MultiIndex):
+            df = df.copy(deep=False)
+            df.columns = ['_'.join(str(lvl) for lvl in col).strip('_')
+                          for col in df.columns.values]
+        mixed.update(col for col in df.columns if df[col].dtype == object and
+                     _is_mixed(df[col]))
+        # e.g., feature names in long format, which may be numbers
+        categorical = [col for col in df.columns
+                       if isinstance(df[col].dtype, pd.CategoricalDtype) and
+                       _is_mixed(df[col].cat.categories)]
+        for start in range(0, len(df), chunk_size):
+            chunk = df.iloc[start:start + chunk_size]
+            if mixed or categorical:
+                chunk = chunk.copy(deep=False)
+                for col in mixed & set(chunk.columns):
+                    values = chunk[col].astype(object)
+                    chunk[col] = values.where(values.isnull(),
+                                              values.astype(str))
+                for col in categorical:
+                    chunk[col] = chunk[col].cat.rename_categories(str)
+            yield chunk
+
+
+def _is_mixed(values):
+    return pd.api.types.infer_dtype(values, skipna=True) in \
+        ('mixed', 'mixed-integer')
+
+
+class ParquetExporter(Exporter):
+
+    ''' Exports a timeline to Apache Parquet, a compressed, typed, columnar
+    format that pandas, pyarrow, Spark, etc. can read selectively (only some
+    columns, or only the row groups that match a filter) without parsing
+    the whole file. Requires pyarrow.
+    Args:
+        compression (str): Compression codec; e.g., 'snappy', 'gzip' or
+            'zstd'.
+        row_group_size (int): Maximum number of rows per row group. Timelines
+            are converted and written one row group at a time.
+        long_format (bool): If True, timelines are converted to long format
+            (see to_long_format()) before writing.
+    '''
+
+    def __init__(self, compression='snappy', row_group_size=100000,
+                 long_format=False):
+        verify_dependencies(['pa', 'pq'])
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.long_format = long_format
+
+    def export(self, timeline, path, append=False):
+        '''
+        Args:
+            timeline: The timeline to export. Either a DataFrame (e.g., as
+                returned by merge_results() or to_long_format()), an
+                ExtractorResult, a list of ExtractorResults (which are merged
+                first), or an iterable of DataFrames (e.g., a timeline
+                produced in chunks), which are written one at a time.
+            path (str): The file to write. If append is True, path is
+                instead a directory, to which a new file is added on every
+                call; pyarrow (and pandas.read_parquet()) read the
+                directory as a single dataset.
+            append (bool): If True, adds the timeline to those previously
+                exported to path rather than overwriting them.
+        '''
+        if append:
+            if not exists(path):
+                os.makedirs(path)
+            n_parts = len([f for f in os.listdir(path)
+                           if f.endswith('.parquet')])
+            path = join(path, 'part-%05d.parquet' % n_parts)
+
+        writer = None
+        try:
+            for chunk in _iter_chunks(timeline, self.row_group_size,
+                                      self.long_format):
+                if writer is None:
+                    schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                    # Columns that are empty in the first chunk may not be
+                    # in later ones
+                    for i, field in enumerate(schema):
+                        if field.type == pa.null():
+                            schema = schema.set(i, field.with_type(
+                                pa.string()))
+                    writer = pq.ParquetWriter(path, schema,
+                                              compression=self.compression)
+                table = pa.Table.from_pandas(chunk, schema=writer.schema,
+                                             preserve_index=False)
+                writer.write_table(table, row_group_size=self.row_group_size)
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+class HDF5Exporter(Exporter):
+
+    ''' Exports a timeline to a table in an HDF5 file, using PyTables (via
+    pandas.HDFStore). Tables are compressed, can be appended to, and can be
+    queried on disk (e.g., pd.read_hdf(path, where='onset > 10')) without
+    loading them into memory. Requires PyTables.
+    Args:
+        key (str): Name of the table within the file.
+        complib (str): Compression library; e.g., 'blosc', 'zlib' or 'lzo'.
+        complevel (int): Compression level (0-9).
+        chunk_size (int): Number of rows to convert and write at once.
+        data_columns (list): Columns to index, so they can be used in where
+            queries. Defaults to whichever of stim_name, onset, duration,
+            extractor and feature are present.
+        string_size (int): Minimum width reserved for string columns. Strings
+            appended later can't be longer than the widest string in the
+            first chunk written, or than this.
+        long_format (bool): If True, timelines are converted to long format
+            (see to_long_format()) before writing.
+    '''
+
+    _default_data_columns = ['stim_name', 'onset', 'duration', 'extractor',
+                             'feature']
+
+    def __init__(self, key='timeline', complib='blosc', complevel=5,
+                 chunk_size=100000, data_columns=None, string_size=256,
+                 long_format=False):
+        verify_dependencies(['tables'])
+        self.key = key
+        self.complib = complib
+        self.complevel = complevel
+        self.chunk_size = chunk_size
+        self.data_columns = data_columns
+        self.string_size = string_size
+        self.long_format = long_format
+
+    def export(self, timeline, path, append=False):
+        '''
+        Args:
+            timeline: The timeline to export; see ParquetExporter.export().
+            path (str): The HDF5 file to write.
+            append (bool): If True, adds rows to an existing table (which
+                must have the same columns) rather than overwriting it.
+        '''
+        store = pd.HDFStore(path, complib=self.complib,
+                            complevel=self.complevel)
+        try:
+            if not append and self.key in store:
+                store.remove(self.key)
+            for chunk in _iter_chunks(timeline, self.chunk_size,
+                                      self.long_format):
+                chunk = self._prepare(chunk)
+                data_columns = self.data_columns
+                if data_columns is None:
+                    data_columns = [c for c in self._default_data_columns
+                                    if c in chunk.columns]
+                min_itemsize = dict((c, self.string_size)
+                                    for c in data_columns
+                                    if chunk[c].dtype == object)
+                min_itemsize['values'] = self.string_size
+                store.append(self.key, chunk, format='table',
+                             data_columns=data_columns,
+                             min_itemsize=min_itemsize, index=False)
+            if self.key in store:
+                store.create_table_index(self.key, optlevel=6, kind='medium')
+        finally:
+            store.close()
+
+    @staticmethod
+    def _prepare(chunk):
+        # HDF5 tables have no notion of missing strings, or of Python objects
+        chunk = chunk.copy(deep=False)
+        for col in chunk.columns:
+            dtype = chunk[col].dtype
+            if not (pd.api.types.is_numeric_dtype(dtype) or
+                    isinstance(dtype, pd.CategoricalDtype)):
+                values = chunk[col].astype(object)
+                chunk[col] = values.where(values.notnull(), '').astype(str) \
+                    .astype(object)
+        return chunk
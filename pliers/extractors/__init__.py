@@ -1,6 +1,7 @@
 ''' Extractor hierarchy. '''
 
-from .base import Extractor, ExtractorResult, merge_results
+from .base import (Extractor, ExtractorResult, ResultAccumulator,
+                   merge_results)
 from .api import (IndicoAPITextExtractor,
                   IndicoAPIImageExtractor,
                   ClarifaiAPIExtractor)
@@ -19,7 +20,8 @@ from .audio import (STFTAudioExtractor,
                     MelspectrogramExtractor,
                     MFCCExtractor,
                     TonnetzExtractor,
-                    TempogramExtractor)
+                    TempogramExtractor,
+                    LibrosaMultiFeatureExtractor)
 from .google import (GoogleVisionAPIFaceExtractor,
                      GoogleVisionAPILabelExtractor,
                      GoogleVisionAPIPropertyExtractor,
@@ -57,6 +59,7 @@ __all__ = [
     'MFCCExtractor',
     'TonnetzExtractor',
     'TempogramExtractor',
+    'LibrosaMultiFeatureExtractor',
     'GoogleVisionAPIFaceExtractor',
     'GoogleVisionAPILabelExtractor',
     'GoogleVisionAPIPropertyExtractor',
@@ -77,5 +80,6 @@ __all__ = [
     'WordEmbeddingExtractor',
     'TextVectorizerExtractor',
     'VADERSentimentExtractor',
+    'ResultAccumulator',
     'merge_results'
 ]
@@ -5,7 +5,7 @@ from pliers.stimuli.text import ComplexTextStim
 from pliers.extractors.base import Extractor, ExtractorResult
 from pliers.utils import attempt_to_import, verify_dependencies, listify
 import numpy as np
-from scipy import fft
+from numpy.lib.stride_tricks import as_strided
 
 librosa = attempt_to_import('librosa')
 
@@ -41,6 +41,8 @@ class STFTAudioExtractor(AudioExtractor):
 
     _log_attributes = ('frame_size', 'hop_size', 'freq_bins')
     VERSION = '1.0'
+    # Maximum number of samples to window and transform at once
+    _chunk_size = 2**22
 
     def __init__(self, frame_size=0.5, hop_size=0.1, freq_bins=5,
                  spectrogram=False):
@@ -50,18 +52,31 @@ class STFTAudioExtractor(AudioExtractor):
         self.freq_bins = freq_bins
         super(STFTAudioExtractor, self).__init__()
 
-    def _stft(self, stim):
+    def _iter_spectra(self, stim):
+        ''' Yields the spectra of successive blocks of frames. Frames are
+        strided views into the signal, so only one block of windowed samples
+        is held in memory at a time. '''
         x = stim.data
         framesamp = int(self.frame_size*stim.sampling_rate)
         hopsamp = int(self.hop_size*stim.sampling_rate)
+        n_frames = len(range(0, len(x)-framesamp, hopsamp))
+        nyquist_lim = framesamp//2
+        frames = as_strided(x, shape=(max(n_frames, 0), framesamp),
+                            strides=(hopsamp*x.strides[0], x.strides[0]))
         w = np.hanning(framesamp)
-        X = np.array([fft(w*x[i:(i+framesamp)])
-                      for i in range(0, len(x)-framesamp, hopsamp)])
-        nyquist_lim = int(X.shape[1]//2)
-        X = np.log(X[:, :nyquist_lim])
-        X = np.absolute(X)
+        block = max(1, self._chunk_size//framesamp)
+        for i in range(0, max(n_frames, 1), block):
+            X = np.fft.rfft(frames[i:i+block]*w, axis=1)[:, :nyquist_lim]
+            # Equivalent to np.absolute(np.log(X)), without the complex log
+            with np.errstate(divide='ignore', invalid='ignore'):
+                yield np.hypot(np.log(np.absolute(X)), np.angle(X))
+
+    def _stft(self, stim):
+        X = np.vstack(list(self._iter_spectra(stim)))
         if self.spectrogram:
             import matplotlib.pyplot as plt
+            framesamp = int(self.frame_size*stim.sampling_rate)
+            nyquist_lim = framesamp//2
             bins = np.fft.fftfreq(framesamp, d=1./stim.sampling_rate)
             bins = bins[:nyquist_lim]
             plt.imshow(X.T, origin='lower', aspect='auto',
@@ -73,26 +88,45 @@ class STFTAudioExtractor(AudioExtractor):
             plt.show()
         return X
 
+    def _get_bands(self, n_bins):
+        if isinstance(self.freq_bins, int):
+            bin_size = n_bins / float(self.freq_bins)
+            return [(i*bin_size, (i+1)*bin_size)
+                    for i in range(self.freq_bins)]
+        return self.freq_bins
+
+    @staticmethod
+    def _band_means(data, membership):
+        # Non-finite values zero out any band they fall in
+        bad = ~np.isfinite(data)
+        data[bad] = 0.
+        values = data.dot(membership)
+        values[bad.dot(membership > 0)] = 0.
+        return values
+
     def _extract(self, stim):
-        data = self._stft(stim)
-        time_bins = np.arange(0., stim.duration-self.frame_size, self.hop_size)
+        framesamp = int(self.frame_size*stim.sampling_rate)
+        n_bins = framesamp//2
+        bands = self._get_bands(n_bins)
 
-        if isinstance(self.freq_bins, int):
-            bins = []
-            bin_size = data.shape[1] / self.freq_bins
-            for i in range(self.freq_bins):
-                bins.append((i*bin_size, (i+1)*bin_size))
-            self.freq_bins = bins
+        # Each column averages the spectrum over one band of bins
+        membership = np.zeros((n_bins, len(bands)))
+        for i, (start, stop) in enumerate(bands):
+            idx = np.arange(n_bins)[int(start):int(stop)]
+            if len(idx):
+                membership[idx, i] = 1. / len(idx)
+
+        spectra = [self._stft(stim)] if self.spectrogram else \
+            self._iter_spectra(stim)
+        data = np.vstack([self._band_means(X, membership) for X in spectra])
 
-        features = ['%d_%d' % fb for fb in self.freq_bins]
+        time_bins = np.arange(0., stim.duration-self.frame_size, self.hop_size)
+        features = ['%d_%d' % fb for fb in bands]
         offset = 0.0 if stim.onset is None else stim.onset
         index = [tb + offset for tb in time_bins]
         values = np.zeros((len(index), len(features)))
-        for i, fb in enumerate(self.freq_bins):
-            start, stop = fb
-            values[:, i] = data[:, start:stop].mean(1)
-        values[np.isnan(values)] = 0.
-        values[np.isinf(values)] = 0.
+        n = min(len(index), len(data))
+        values[:n] = data[:n]
         return ExtractorResult(values, stim, self, features=features,
                                onsets=index, durations=self.hop_size)
 
@@ -130,9 +164,18 @@ class MeanAmplitudeExtractor(Extractor):
 
 class LibrosaFeatureExtractor(AudioExtractor):
 
-    ''' A generic class for audio extractors using the librosa library. '''
+    ''' A generic class for audio extractors using the librosa library.
+
+    Features that are computed from a short-time Fourier transform share a
+    single spectrogram per stim (and n_fft/hop_length), which is passed to
+    librosa instead of the waveform. '''
 
     _log_attributes = ('hop_length', 'librosa_kwargs')
+    # Power of the magnitude spectrogram the librosa feature accepts as S;
+    # None if the feature is computed from the waveform.
+    _spectrogram_power = None
+    # Arguments that change the STFT itself, precluding a shared spectrogram
+    _stft_kwargs = ('win_length', 'window', 'center', 'pad_mode', 'dtype')
 
     def __init__(self, feature=None, hop_length=512, **librosa_kwargs):
         verify_dependencies(['librosa'])
@@ -145,7 +188,27 @@ class LibrosaFeatureExtractor(AudioExtractor):
     def get_feature_names(self):
         return self._feature
 
+    def _get_spectrogram(self, stim):
+        ''' Returns the stim's spectrogram, raised to the power the feature
+        expects, or None if the feature can't use a shared spectrogram. '''
+        power = self.librosa_kwargs.get('power', self._spectrogram_power)
+        if power is None or \
+                any(k in self.librosa_kwargs for k in self._stft_kwargs):
+            return None
+        n_fft = self.librosa_kwargs.get('n_fft', 2048)
+        key = ('spectrogram', n_fft, self.hop_length)
+        S = stim.get_derivative(key, lambda: np.abs(librosa.stft(
+            stim.data, n_fft=n_fft, hop_length=self.hop_length)))
+        if power != 1:
+            S = stim.get_derivative(key + (power,), lambda: S**power)
+        return S
+
     def _get_values(self, stim):
+        S = self._get_spectrogram(stim)
+        if S is not None:
+            return getattr(librosa.feature, self._feature)(
+                S=S, sr=stim.sampling_rate, hop_length=self.hop_length,
+                **self.librosa_kwargs)
         return getattr(librosa.feature, self._feature)(y=stim.data,
                                                        sr=stim.sampling_rate,
                                                        hop_length=self.hop_length,
@@ -175,6 +238,7 @@ class SpectralCentroidExtractor(LibrosaFeatureExtractor):
     https://librosa.github.io/librosa/feature.html.'''
 
     _feature = 'spectral_centroid'
+    _spectrogram_power = 1
 
 
 class SpectralBandwidthExtractor(LibrosaFeatureExtractor):
@@ -185,6 +249,7 @@ class SpectralBandwidthExtractor(LibrosaFeatureExtractor):
     https://librosa.github.io/librosa/feature.html.'''
 
     _feature = 'spectral_bandwidth'
+    _spectrogram_power = 1
 
 
 class SpectralContrastExtractor(LibrosaFeatureExtractor):
@@ -195,6 +260,7 @@ class SpectralContrastExtractor(LibrosaFeatureExtractor):
     https://librosa.github.io/librosa/feature.html.'''
 
     _feature = 'spectral_contrast'
+    _spectrogram_power = 1
 
     def __init__(self, n_bands=6, **kwargs):
         self.n_bands = n_bands
@@ -212,6 +278,7 @@ class SpectralRolloffExtractor(LibrosaFeatureExtractor):
     https://librosa.github.io/librosa/feature.html.'''
 
     _feature = 'spectral_rolloff'
+    _spectrogram_power = 1
 
 
 class PolyFeaturesExtractor(LibrosaFeatureExtractor):
@@ -223,6 +290,7 @@ class PolyFeaturesExtractor(LibrosaFeatureExtractor):
     https://librosa.github.io/librosa/feature.html.'''
 
     _feature = 'poly_features'
+    _spectrogram_power = 1
 
     def __init__(self, order=1, **kwargs):
         self.order = order
@@ -270,6 +338,7 @@ class ChromaSTFTExtractor(LibrosaFeatureExtractor):
     https://librosa.github.io/librosa/feature.html.'''
 
     _feature = 'chroma_stft'
+    _spectrogram_power = 2
 
     def __init__(self, n_chroma=12, **kwargs):
         self.n_chroma = n_chroma
@@ -322,6 +391,7 @@ class MelspectrogramExtractor(LibrosaFeatureExtractor):
     https://librosa.github.io/librosa/feature.html.'''
 
     _feature = 'melspectrogram'
+    _spectrogram_power = 2
 
     def __init__(self, n_mels=128, **kwargs):
         self.n_mels = n_mels
@@ -339,6 +409,7 @@ class MFCCExtractor(LibrosaFeatureExtractor):
     https://librosa.github.io/librosa/feature.html.'''
 
     _feature = 'mfcc'
+    _spectrogram_power = 2
 
     def __init__(self, n_mfcc=20, **kwargs):
         self.n_mfcc = n_mfcc
@@ -347,6 +418,19 @@ class MFCCExtractor(LibrosaFeatureExtractor):
     def get_feature_names(self):
         return ['mfcc_%d' % i for i in range(self.n_mfcc)]
 
+    def _get_values(self, stim):
+        S = self._get_spectrogram(stim)
+        if S is None:
+            return super(MFCCExtractor, self)._get_values(stim)
+        # librosa expects a log-power mel spectrogram here, not an STFT
+        mel_kwargs = dict(self.librosa_kwargs)
+        mel_kwargs.pop('n_mfcc')
+        S = librosa.feature.melspectrogram(S=S, sr=stim.sampling_rate,
+                                           **mel_kwargs)
+        to_db = getattr(librosa, 'power_to_db', None) or \
+            librosa.logamplitude
+        return librosa.feature.mfcc(S=to_db(S), n_mfcc=self.n_mfcc)
+
 
 class TonnetzExtractor(LibrosaFeatureExtractor):
 
@@ -381,3 +465,56 @@ class TempogramExtractor(LibrosaFeatureExtractor):
 
     def get_feature_names(self):
         return ['tempo_%d' % i for i in range(self.win_length)]
+
+
+class LibrosaMultiFeatureExtractor(LibrosaFeatureExtractor):
+
+    ''' Extracts several librosa features from audio in a single pass. The
+    samples are decoded, the spectrogram is computed, and frame onsets are
+    generated once per stim, and all features are returned in a single
+    ExtractorResult, using the same feature names as the corresponding
+    single-feature extractors (e.g., MFCCExtractor).
+
+    Args:
+        features (list, dict): The names of the librosa features to extract
+            (e.g., ['mfcc', 'chroma_stft', 'spectral_contrast']). To pass
+            arguments to individual features, pass a dict mapping feature
+            names to dicts of keyword arguments instead.
+        hop_length (int): Number of samples between successive frames, for
+            all features.
+
+    For details on argument specification visit:
+    https://librosa.github.io/librosa/feature.html.'''
+
+    _log_attributes = ('features', 'hop_length')
+
+    def __init__(self, features, hop_length=512):
+        available = dict((c._feature, c) for c in
+                         LibrosaFeatureExtractor.__subclasses__()
+                         if hasattr(c, '_feature'))
+        items = list(features.items()) if isinstance(features, dict) else \
+            [(f, {}) for f in listify(features)]
+        unknown = [f for f, _ in items if f not in available]
+        if unknown:
+            raise ValueError("Unknown librosa feature(s): %s. Valid values "
+                             "are: %s." % (', '.join(unknown),
+                                           ', '.join(sorted(available))))
+        self.features = features
+        self._extractors = [available[f](hop_length=hop_length, **kwargs)
+                            for f, kwargs in items]
+        super(LibrosaMultiFeatureExtractor, self).__init__(
+            hop_length=hop_length)
+
+    def get_feature_names(self):
+        return [name for ext in self._extractors
+                for name in listify(ext.get_feature_names())]
+
+    def _get_values(self, stim):
+        values = [ext._get_values(stim) for ext in self._extractors]
+        n_frames = max(v.shape[1] for v in values)
+        # Features computed over fewer frames (e.g., uncentered ones) are
+        # padded with NaNs
+        values = [np.pad(v.astype(float), ((0, 0), (0, n_frames - v.shape[1])),
+                         'constant', constant_values=np.nan)
+                  if v.shape[1] < n_frames else v for v in values]
+        return np.vstack(values)
@@ -1,12 +1,17 @@
 ''' Base Extractor class and associated functionality. '''
 
-from collections import defaultdict
+from collections import defaultdict, Counter, OrderedDict
 from abc import ABCMeta, abstractmethod
 from six import with_metaclass
 import pandas as pd
 import numpy as np
+import os
+import shutil
+import tempfile
 from pliers.transformers import Transformer
-from pliers.utils import isgenerator
+from pliers.utils import isgenerator, attempt_to_import, verify_dependencies
+
+pyarrow = attempt_to_import('pyarrow')
 
 
 class Extractor(with_metaclass(ABCMeta, Transformer)):
@@ -34,11 +39,26 @@ class Extractor(with_metaclass(ABCMeta, Transformer)):
 
 class ExtractorResult(object):
 
+    ''' Stores the features extracted from a Stim. Values are held in a
+    single column-major 2D array (one row per onset, one column per
+    feature), alongside arrays of onsets and durations, so they can be
+    handed to pandas, NumPy or Arrow without copying.
+    Args:
+        data (array-like): The extracted values, with one row per onset and
+            one column per feature. Anything pd.DataFrame() accepts works.
+        stim (Stim): The Stim the values were extracted from.
+        extractor (Extractor): The Extractor that produced the values.
+        features (list): Optional names of the features (columns).
+        onsets (float, list): Onset of each row. Defaults to the Stim's onset.
+        durations (float, list): Duration of each row. Defaults to the
+            Stim's duration.
+    '''
+
     def __init__(self, data, stim, extractor, features=None, onsets=None,
                  durations=None):
+        self.features = features
         self.data = data
         self.extractor = extractor
-        self.features = features
         self._history = None
         self.stim = stim
 
@@ -50,19 +70,69 @@ class ExtractorResult(object):
             durations = stim.duration
         self.durations = durations if durations is not None else np.nan
 
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        features = getattr(self, '_features', None)
+        self._data = np.asfortranarray(_to_2d(data, len(features or [])))
+
+    @property
+    def features(self):
+        return self._features
+
+    @features.setter
+    def features(self, features):
+        if features is None:
+            self._features = self._columns = None
+        else:
+            self._features, self._columns = _intern_features(features)
+
+    @property
+    def onsets(self):
+        return np.broadcast_to(self._onsets, (len(self._data),))
+
+    @onsets.setter
+    def onsets(self, onsets):
+        self._onsets = _as_times(onsets)
+
+    @property
+    def durations(self):
+        return np.broadcast_to(self._durations, (len(self._data),))
+
+    @durations.setter
+    def durations(self, durations):
+        self._durations = _as_times(durations)
+
+    def _get_columns(self):
+        # Feature labels, with repeated names numbered
+        if self._columns is None:
+            return tuple(range(self._data.shape[1]))
+        return self._columns
+
+    def to_numpy(self):
+        ''' Returns the feature values as a 2D array, with one row per onset
+        and one column per feature. The array is not a copy; onsets and
+        durations are available as the onsets and durations attributes. '''
+        return self._data
+
+    def to_arrow(self):
+        ''' Returns the onsets, durations and feature values as a
+        pyarrow.Table. Numeric columns are not copied. '''
+        verify_dependencies(['pyarrow'])
+        columns = [self.onsets, self.durations]
+        columns += [self._data[:, i] for i in range(self._data.shape[1])]
+        names = ['onset', 'duration']
+        names += [str(c) for c in self._get_columns()]
+        return pyarrow.Table.from_arrays([pyarrow.array(c) for c in columns],
+                                         names=names)
+
     def to_df(self, metadata=False):
-        df = pd.DataFrame(self.data)
-        if self.features is not None:
-            # Handle duplicate features
-            counts = defaultdict(int)
-            features = []
-            for f in self.features:
-                if self.features.count(f) > 1:
-                    counts[f] += 1
-                    features.append(f + '_%d' % counts[f])
-                else:
-                    features.append(f)
-            df.columns = features
+        df = pd.DataFrame(self._data, columns=self._get_columns(), copy=False)
+        if self._data.dtype.hasobject:
+            df = df.infer_objects()
         df.insert(0, 'duration', self.durations)
         df.insert(0, 'onset', self.onsets)
         if metadata:
@@ -73,6 +143,14 @@ class ExtractorResult(object):
             df['source_file'] = self.history.to_df().iloc[0].source_file
         return df
 
+    def __setstate__(self, state):
+        # Results pickled before values were stored as arrays
+        attrs = ['data', 'features', 'onsets', 'durations']
+        legacy = dict((a, state.pop(a)) for a in attrs if a in state)
+        self.__dict__.update(state)
+        for attr, value in legacy.items():
+            setattr(self, attr, value)
+
     @property
     def history(self):
         return self._history
@@ -99,47 +177,15 @@ class ExtractorResult(object):
 
         # Make sure all ExtractorResults are associated with same Stim.
         stims = set([r.stim.name for r in results])
-        dfs = [r.to_df(metadata=metadata) for r in results]
         if len(stims) > 1:
             raise ValueError("merge_features() can only be called on a set of "
                              "ExtractorResults associated with the same Stim.")
 
-        keys = [r.extractor.name for r in results] if extractor_names else None
-        extra_columns = ['onset', 'duration', 'class', 'filename', 'history',
-                         'stim_name', 'source_file']
-
-        # If onsets are all NaN
-        if all([r['onset'].isnull().all() for r in dfs]):
-            if len(set([len(r) for r in dfs])) > 1:
-                raise ValueError("If ExtractorResults do not specify onsets, "
-                                 "all ExtractorResults to merge must have "
-                                 "identical numbers of rows.")
-            feature_dfs = [r.drop(extra_columns, axis=1) for r in dfs]
-            result = pd.concat(feature_dfs, axis=1, keys=keys)
-            result.insert(0, 'onset', np.nan)
-
-        # If onsets are specified
-        elif all([r['onset'].notnull().all() for r in dfs]):
-            feature_dfs = [r.set_index('onset').sort_index() for r in dfs]
-            feature_dfs = [r.drop(extra_columns, axis=1, errors='ignore') for r in feature_dfs]
-            result = pd.concat(feature_dfs, axis=1, keys=keys).reset_index()
-
-        else:
-            raise ValueError("To merge a list of ExtractorResults, all "
-                             "instances must either contain onsets, or lack "
-                             "onsets and have the same number of rows. It is "
-                             "not possible to merge mismatched instances.")
-
-        extra_columns.remove('onset')
-        if not metadata:
-            extra_columns = ['duration']
-        for col in extra_columns:
-            result.insert(0, col, dfs[0][col][0])
-
-        result = result.sort_values(['onset']).reset_index(drop=True)
-        if flatten_columns:
-            result.columns = ['_'.join(str(lvl) for lvl in col).strip('_') for col in result.columns.values]
-        return result
+        accumulator = ResultAccumulator(metadata, extractor_names,
+                                        flatten_columns)
+        for r in results:
+            accumulator.add(r)
+        return accumulator.to_df()
 
     @classmethod
     def merge_stims(cls, results):
@@ -148,27 +194,428 @@ class ExtractorResult(object):
         return pd.concat(results, axis=0).sort_values('onset').reset_index(drop=True)
 
 
-def merge_results(results, **merge_feature_args):
+# Feature names seen so far, so that results from the same Extractor share
+# a single tuple of names (and of labels)
+_feature_names = {}
+_max_feature_names = 10000
+
+
+def _intern_features(features):
+    key = tuple(features)
+    names = _feature_names.get(key)
+    if names is None:
+        if len(_feature_names) >= _max_feature_names:
+            _feature_names.clear()
+        names = (key, tuple(_dedupe_features(key)))
+        _feature_names[key] = names
+    return names
+
+
+def _as_times(times):
+    times = np.asarray(times)
+    if times.dtype.kind not in 'biuf':
+        times = times.astype(float)
+    return times
+
+
+def _dedupe_features(features):
+    # Numbers repeated feature names in order of appearance: a, b, a ->
+    # a_1, b, a_2
+    totals = Counter(features)
+    counts = defaultdict(int)
+    deduped = []
+    for f in features:
+        if totals[f] > 1:
+            counts[f] += 1
+            deduped.append(f + '_%d' % counts[f])
+        else:
+            deduped.append(f)
+    return deduped
+
+
+def _to_2d(data, n_features=0):
+    # Returns result data as a 2D array with one row per onset. Numeric
+    # arrays pass straight through; anything else (strings, mixed types,
+    # ragged lists) is laid out the way pd.DataFrame(data) would do it.
+    # Empty data gets one (empty) column per feature.
+    if not isinstance(data, pd.DataFrame):
+        try:
+            arr = np.asarray(data)
+        except ValueError:
+            arr = None
+        if arr is not None and arr.ndim <= 1 and arr.size == 0:
+            return arr.reshape(0, n_features)
+        if arr is not None and arr.dtype.kind in 'biufc' and arr.ndim <= 2:
+            return arr.reshape(len(arr), -1) if arr.ndim == 1 else arr
+    return pd.DataFrame(data).values
+
+
+def _merge_feature_dfs(dfs, keys, metadata, flatten_columns):
+    # Merges the to_df() outputs of results bound to the same Stim; see
+    # ExtractorResult.merge_features()
+    extra_columns = ['onset', 'duration', 'class', 'filename', 'history',
+                     'stim_name', 'source_file']
+
+    # If onsets are all NaN
+    if all([r['onset'].isnull().all() for r in dfs]):
+        if len(set([len(r) for r in dfs])) > 1:
+            raise ValueError("If ExtractorResults do not specify onsets, "
+                             "all ExtractorResults to merge must have "
+                             "identical numbers of rows.")
+        feature_dfs = [r.drop(extra_columns, axis=1, errors='ignore')
+                       for r in dfs]
+        result = pd.concat(feature_dfs, axis=1, keys=keys)
+        result.insert(0, 'onset', np.nan)
+
+    # If onsets are specified
+    elif all([r['onset'].notnull().all() for r in dfs]):
+        feature_dfs = [r.set_index('onset').sort_index() for r in dfs]
+        feature_dfs = [r.drop(extra_columns, axis=1, errors='ignore') for r in feature_dfs]
+        result = pd.concat(feature_dfs, axis=1, keys=keys).reset_index()
+
+    else:
+        raise ValueError("To merge a list of ExtractorResults, all "
+                         "instances must either contain onsets, or lack "
+                         "onsets and have the same number of rows. It is "
+                         "not possible to merge mismatched instances.")
+
+    extra_columns.remove('onset')
+    if not metadata:
+        extra_columns = ['duration']
+    for col in extra_columns:
+        result.insert(0, col, dfs[0][col].iloc[0])
+
+    result = result.sort_values(['onset']).reset_index(drop=True)
+    if flatten_columns and isinstance(result.columns, pd.MultiIndex):
+        result.columns = ['_'.join(str(lvl) for lvl in col).strip('_') for col in result.columns.values]
+    return result
+
+
+class _Buffer(object):
+
+    ''' A growable array that doubles its capacity as rows are appended. If
+    a directory is given, numeric values are kept in a memory-mapped file
+    there rather than in memory. '''
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.size = 0
+        self._data = None
+        self._file = None
+
+    @property
+    def values(self):
+        return self._data[:self.size]
+
+    def append(self, values):
+        n = len(values)
+        if self._data is None:
+            self._allocate(max(n, 16), values.dtype, values.shape[1:])
+        else:
+            dtype = np.promote_types(self._data.dtype, values.dtype)
+            capacity = len(self._data)
+            if self.size + n > capacity:
+                capacity = max(2 * capacity, self.size + n)
+            if dtype != self._data.dtype or capacity != len(self._data):
+                self._allocate(capacity, dtype, self._data.shape[1:])
+        self._data[self.size:self.size + n] = values
+        self.size += n
+
+    def _allocate(self, capacity, dtype, shape):
+        old, old_file = self._data, self._file
+        shape = (capacity,) + tuple(shape)
+        if self.directory is None or dtype.hasobject:
+            self._data, self._file = np.empty(shape, dtype), None
+        else:
+            fd, self._file = tempfile.mkstemp(dir=self.directory)
+            os.close(fd)
+            self._data = np.memmap(self._file, dtype, 'w+', shape=shape)
+        if old is not None:
+            self._data[:self.size] = old[:self.size]
+        if old_file is not None:
+            del old
+            os.remove(old_file)
+
+
+class _Table(object):
+
+    ''' Buffered rows of all results from one Extractor with one set of
+    features. '''
+
+    def __init__(self, name, columns, rank, directory=None):
+        self.name = name
+        self.columns = columns
+        # Position of the first result, which determines column order
+        self.rank = rank
+        self.stims = set()
+        self.stim = _Buffer()
+        self.seq = _Buffer()
+        self.onset = _Buffer()
+        self.data = _Buffer(directory)
+
+
+class ResultAccumulator(object):
+
+    ''' Collects ExtractorResults as they arrive and merges them into a
+    single DataFrame (the same one merge_results() returns). Onsets and
+    feature values are copied into NumPy buffers--one per Extractor and set
+    of features--so results (and their Stims) need not be kept around, and
+    the DataFrame is built in one pass rather than from one DataFrame per
+    result.
+    Args:
+        metadata, extractor_names, flatten_columns: See
+            ExtractorResult.merge_features().
+        buffer_dir (str): If given, numeric feature values are buffered in
+            memory-mapped files in a temporary subdirectory of this directory
+            (removed by close()) instead of in memory.
+    '''
+
+    _meta_columns = ['source_file', 'stim_name', 'history', 'filename',
+                     'class']
+
+    def __init__(self, metadata=True, extractor_names=True,
+                 flatten_columns=False, buffer_dir=None):
+        self.metadata = metadata
+        self.extractor_names = extractor_names
+        self.flatten_columns = flatten_columns
+        self._dir = None
+        if buffer_dir is not None:
+            self._dir = tempfile.mkdtemp(prefix='pliers_merge_',
+                                         dir=buffer_dir)
+        self._stims = {}
+        self._stim_info = []
+        self._n_results = []
+        self._tables = OrderedDict()
+
+    def add(self, result):
+        ''' Adds an ExtractorResult. '''
+        digest = result.stim.digest
+        if digest not in self._stims:
+            self._stims[digest] = len(self._stim_info)
+            self._stim_info.append(self._get_stim_info(result))
+            self._n_results.append(0)
+        stim = self._stims[digest]
+        seq = self._n_results[stim]
+        self._n_results[stim] += 1
+
+        data = result.to_numpy()
+        n = len(data)
+        columns = result._get_columns()
+        if len(columns) != data.shape[1]:
+            raise ValueError("%s returned %d features for data with %d "
+                             "columns." % (result.extractor.name,
+                                           len(columns), data.shape[1]))
+
+        # Repeated Extractors get a table of their own, so that each table
+        # holds at most one result per Stim
+        key = (result.extractor.name, columns, 0)
+        while key in self._tables and stim in self._tables[key].stims:
+            key = key[:2] + (key[2] + 1,)
+        table = self._tables.get(key)
+        if table is None:
+            table = _Table(key[0], columns, (stim, seq), self._dir)
+            self._tables[key] = table
+        table.stims.add(stim)
+        table.rank = min(table.rank, (stim, seq))
+
+        table.stim.append(np.full(n, stim, dtype=np.int64))
+        table.seq.append(np.full(n, seq, dtype=np.int64))
+        table.onset.append(result.onsets)
+        table.data.append(data)
+
+    def _get_stim_info(self, result):
+        durations = result.durations
+        info = {'duration': durations[0] if len(durations) else np.nan}
+        if self.metadata:
+            stim = result.stim
+            # The file the Stim was ultimately derived from
+            history = result.history
+            while history is not None and history.parent:
+                history = history.parent
+            info['source_file'] = history.source_file if history else None
+            info['stim_name'] = stim.name
+            info['history'] = str(stim.history)
+            info['filename'] = stim.filename
+            info['class'] = stim.__class__.__name__
+        return info
+
+    def to_df(self):
+        ''' Returns the merged DataFrame of all results added so far. '''
+        if not self._tables:
+            return pd.DataFrame()
+        tables = sorted(self._tables.values(), key=lambda t: t.rank)
+        df = self._merge(tables)
+        return self._merge_legacy(tables) if df is None else df
+
+    def _merge(self, tables):
+        # Returns None if the results can't be merged column-wise.
+        # Column labels (and MultiIndex levels) are taken from a merge of
+        # placeholder DataFrames, to match those of DataFrames merged by
+        # pandas.
+        header = self._merge_frames([(t.name, self._frame(t.columns))
+                                     for t in tables]).columns
+        if not header.is_unique:
+            return None
+
+        n_stims = len(self._stim_info)
+        stims = [t.stim.values for t in tables]
+        onsets = [t.onset.values for t in tables]
+        all_stims = np.concatenate(stims)
+
+        # Per Stim, onsets must either all be given or all be missing
+        missing = np.concatenate([np.isnan(o) for o in onsets])
+        n_missing = np.bincount(all_stims, missing, n_stims)
+        n_rows = np.bincount(all_stims, minlength=n_stims)
+        if ((n_missing > 0) & (n_missing < n_rows)).any():
+            raise ValueError("To merge a list of ExtractorResults, all "
+                             "instances must either contain onsets, or lack "
+                             "onsets and have the same number of rows. It is "
+                             "not possible to merge mismatched instances.")
+        no_onsets = n_missing > 0
+        counts = np.array([np.bincount(s, minlength=n_stims) for s in stims])
+        lengths = np.where(counts > 0, counts, counts.max(0))
+        if (no_onsets & (lengths.min(0) != counts.max(0))).any():
+            raise ValueError("If ExtractorResults do not specify onsets, "
+                             "all ExtractorResults to merge must have "
+                             "identical numbers of rows.")
+
+        # Rows are matched on onset, or on position for Stims without onsets
+        keys = []
+        for s, o in zip(stims, onsets):
+            # Each table holds at most one result per Stim
+            index = np.arange(len(s))
+            starts = np.r_[True, s[1:] != s[:-1]]
+            position = index - np.maximum.accumulate(np.where(starts, index,
+                                                              0))
+            keys.append(np.where(np.isnan(o), position, o))
+            order = np.lexsort((keys[-1], s))
+            sorted_stims, sorted_keys = s[order], keys[-1][order]
+            if ((sorted_stims[1:] == sorted_stims[:-1]) &
+                    (sorted_keys[1:] == sorted_keys[:-1])).any():
+                # Repeated onsets
+                return None
+        all_keys = np.concatenate(keys)
+        order = np.lexsort((all_keys, all_stims))
+        sorted_stims, sorted_keys = all_stims[order], all_keys[order]
+        new = np.ones(len(order), dtype=bool)
+        new[1:] = ((sorted_stims[1:] != sorted_stims[:-1]) |
+                   (sorted_keys[1:] != sorted_keys[:-1]))
+        row = np.empty(len(order), dtype=np.int64)
+        row[order] = np.cumsum(new) - 1
+        row_stims, row_keys = sorted_stims[new], sorted_keys[new]
+
+        # Sort rows by onset, then by Stim and position
+        row_onsets = np.where(no_onsets[row_stims], np.nan, row_keys)
+        final = np.lexsort((row_keys, row_stims,
+                            np.where(no_onsets[row_stims], np.inf,
+                                     row_keys)))
+        n = len(final)
+        rank = np.empty(n, dtype=np.int64)
+        rank[final] = np.arange(n)
+        final_stims = row_stims[final]
+        row_onsets = row_onsets[final]
+        if not no_onsets.any() and all(o.dtype.kind in 'biu'
+                                       for o in onsets):
+            row_onsets = row_onsets.astype(np.int64)
+
+        arrays = []
+        if self.metadata:
+            for col in self._meta_columns:
+                values = [info[col] for info in self._stim_info]
+                values = np.array(values, dtype=object)[final_stims]
+                arrays.append(pd.Series(values).infer_objects().values)
+        durations = [info['duration'] for info in self._stim_info]
+        arrays.append(np.array(durations)[final_stims])
+        arrays.append(row_onsets)
+
+        offsets = np.cumsum([0] + [len(s) for s in stims])
+        for i, t in enumerate(tables):
+            positions = rank[row[offsets[i]:offsets[i + 1]]]
+            data = t.data.values
+            for j in range(len(t.columns)):
+                arrays.append(self._fill(data[:, j], positions, n))
+
+        df = pd.DataFrame(dict(enumerate(arrays)), columns=range(len(arrays)))
+        df.columns = header
+        return df
+
+    @staticmethod
+    def _fill(values, positions, n):
+        # Scatters a column's values into the rows it has values for
+        if len(positions) == n:
+            column = np.empty(n, dtype=values.dtype)
+        else:
+            kind = values.dtype.kind
+            dtype = float if kind in 'iuf' else \
+                values.dtype if kind == 'c' else object
+            column = np.full(n, np.nan, dtype=dtype)
+        column[positions] = values
+        if column.dtype.hasobject:
+            column = pd.Series(column).infer_objects().values
+        return column
+
+    def _frame(self, columns, data=None, onsets=np.nan, info=None):
+        # Lays out the DataFrame a result's to_df() would return
+        if data is None:
+            data = np.full((1, len(columns)), np.nan)
+        df = pd.DataFrame(data)
+        df.columns = list(columns)
+        df.insert(0, 'duration', info['duration'] if info else np.nan)
+        df.insert(0, 'onset', onsets)
+        if self.metadata:
+            for col in self._meta_columns[::-1]:
+                df[col] = info[col] if info else None
+        return df
+
+    def _merge_frames(self, results):
+        keys = [r[0] for r in results] if self.extractor_names else None
+        return _merge_feature_dfs([r[1] for r in results], keys,
+                                  self.metadata, self.flatten_columns)
+
+    def _merge_legacy(self, tables):
+        # Rebuilds one DataFrame per result and merges them with pandas
+        frames = []
+        for stim, info in enumerate(self._stim_info):
+            results = []
+            for t in tables:
+                rows = np.flatnonzero(t.stim.values == stim)
+                if len(rows):
+                    data = pd.DataFrame(t.data.values[rows]).infer_objects()
+                    df = self._frame(t.columns, data, t.onset.values[rows],
+                                     info)
+                    results.append((t.seq.values[rows[0]], t.name, df))
+            results.sort(key=lambda r: r[0])
+            frames.append(self._merge_frames([r[1:] for r in results]))
+        return frames[0] if len(frames) == 1 else \
+            ExtractorResult.merge_stims(frames)
+
+    def close(self):
+        ''' Removes any files used to buffer values. '''
+        if self._dir is not None:
+            self._tables.clear()
+            shutil.rmtree(self._dir, ignore_errors=True)
+            self._dir = None
+
+
+def merge_results(results, buffer_dir=None, **merge_feature_args):
     ''' Merges a list of ExtractorResults instances and returns a pandas DF.
     Args:
         results (list, tuple): A list of ExtractorResult instances to merge.
+            Any iterable works; results are consumed one at a time, so a
+            generator need never hold all of them at once.
+        buffer_dir (str): Optional directory in which to buffer feature
+            values on disk while merging; see ResultAccumulator.
         merge_feature_args (kwargs): Additional argument settings to use
             when merging across features.
 
     Returns: a pandas DataFrame with features concatenated along the column
         axis and stims concatenated along the row axis.
     '''
-
-    stims = defaultdict(list)
-
-    for r in results:
-        stims[hash(r.stim)].append(r)
-
-    # First concatenate all features separately for each Stim
-    for k, v in stims.items():
-        stims[k] = ExtractorResult.merge_features(v, **merge_feature_args)
-
-    # Now concatenate all Stims
-    stims = list(stims.values())
-    return stims[0] if len(stims) == 1 else \
-        ExtractorResult.merge_stims(stims)
+    accumulator = ResultAccumulator(buffer_dir=buffer_dir,
+                                    **merge_feature_args)
+    try:
+        for r in results:
+            accumulator.add(r)
+        return accumulator.to_df()
+    finally:
+        accumulator.close()
@@ -3,11 +3,13 @@ Extractors that operate primarily or exclusively on Image stimuli.
 '''
 
 from pliers.stimuli.image import ImageStim
+from pliers.stimuli.video import VideoFrameCollectionStim
 from pliers.extractors.base import Extractor, ExtractorResult
-from pliers.utils import attempt_to_import, verify_dependencies
+from pliers.transformers import BatchTransformerMixin
+from pliers.utils import isiterable
+from abc import abstractmethod
 import numpy as np
-
-cv2 = attempt_to_import('cv2')
+import sys
 
 
 class ImageExtractor(Extractor):
@@ -17,50 +19,125 @@ class ImageExtractor(Extractor):
     _input_type = ImageStim
 
 
-class BrightnessExtractor(ImageExtractor):
+class BatchImageExtractor(BatchTransformerMixin, ImageExtractor):
+
+    ''' Base class for Image Extractors that compute a single value per
+    image, and can compute it for a whole stack of images--an (N, H, W, 3)
+    array--at once. Images of the same size within a batch are stacked and
+    processed in one vectorized call.
+    Args:
+        merge_frames (bool): If True, a VideoFrameCollectionStim is processed
+            as a whole, with its frames streamed through in batches, and a
+            single ExtractorResult is returned with one row (and onset) per
+            frame. Otherwise the video is converted to frames first, and one
+            ExtractorResult is returned per frame.
+    '''
+
+    _log_attributes = ('merge_frames',)
+    _batch_size = sys.maxsize
+    # Bounds the memory used by intermediate arrays
+    _batch_bytes = 2**24
+    _feature = None
+
+    def __init__(self, merge_frames=False):
+        self.merge_frames = merge_frames
+        super(BatchImageExtractor, self).__init__()
+
+    def _stim_matches_input_types(self, stim):
+        if self.merge_frames and isinstance(stim, VideoFrameCollectionStim):
+            return True
+        return super(BatchImageExtractor, self)._stim_matches_input_types(stim)
+
+    @abstractmethod
+    def _compute(self, images):
+        ''' Returns one value for each image in an (N, H, W, C) array. '''
+        pass
+
+    def _compute_all(self, images):
+        values = np.zeros(len(images))
+        shapes = {}
+        for i, image in enumerate(images):
+            shapes.setdefault(image.shape, []).append(i)
+        for indices in shapes.values():
+            values[indices] = self._compute(np.stack([images[i]
+                                                      for i in indices]))
+        return values
+
+    def _extract(self, stims):
+        if not isiterable(stims):
+            return self._extract([stims])[0]
+        results = [None] * len(stims)
+        images = [i for i, s in enumerate(stims)
+                  if not isinstance(s, VideoFrameCollectionStim)]
+        values = self._compute_all([stims[i].data for i in images])
+        for i, value in zip(images, values):
+            results[i] = ExtractorResult(np.array([[value]]), stims[i], self,
+                                         features=[self._feature])
+        for i, stim in enumerate(stims):
+            if results[i] is None:
+                results[i] = self._extract_frames(stim)
+        return results
+
+    def _extract_frames(self, video):
+        values, onsets, durations = [], [], []
+        for frames in self._iter_batches(video):
+            values.append(self._compute_all([f.data for f in frames]))
+            onsets.extend(f.onset for f in frames)
+            durations.extend(f.duration for f in frames)
+        data = np.concatenate(values)[:, None] if values else \
+            np.zeros((0, 1))
+        return ExtractorResult(data, video, self, features=[self._feature],
+                               onsets=onsets, durations=durations)
+
+
+class BrightnessExtractor(BatchImageExtractor):
 
     ''' Gets the average luminosity of the pixels in the image '''
 
     VERSION = '1.0'
+    _feature = 'brightness'
 
-    def _extract(self, stim):
-        data = stim.data
-        brightness = np.amax(data, 2).mean() / 255.0
-
-        return ExtractorResult(np.array([[brightness]]), stim, self,
-                               features=['brightness'])
+    def _compute(self, images):
+        return images.max(axis=3).reshape(len(images), -1).mean(axis=1) / 255.0
 
 
-class SharpnessExtractor(ImageExtractor):
+class SharpnessExtractor(BatchImageExtractor):
 
     ''' Gets the degree of blur/sharpness of the image '''
 
     VERSION = '1.0'
+    _feature = 'sharpness'
 
-    def _extract(self, stim):
-        verify_dependencies(['cv2'])
+    def _compute(self, images):
         # Taken from
         # http://stackoverflow.com/questions/7765810/is-there-a-way-to-detect-if-an-image-is-blurry?lq=1
-        data = stim.data
-        gray_image = cv2.cvtColor(data, cv2.COLOR_BGR2GRAY)
+        # Computes the same as OpenCV's cvtColor(COLOR_BGR2GRAY), Laplacian()
+        # (into int16) and convertScaleAbs(), for all images at once
+        images = images.astype(np.int32)
+        gray = (images[..., 0] * 1868 + images[..., 1] * 9617 +
+                images[..., 2] * 4899 + 8192) >> 14
+        padded = np.pad(gray, ((0, 0), (1, 1), (1, 1)), mode='reflect')
+        laplacian = (padded[:, :-2, 1:-1] + padded[:, 2:, 1:-1] +
+                     padded[:, 1:-1, :-2] + padded[:, 1:-1, 2:] - 4 * gray)
+        laplacian = np.abs(laplacian).reshape(len(images), -1).max(axis=1)
+        return np.minimum(laplacian, 255) / 255.0
 
-        sharpness = np.max(
-            cv2.convertScaleAbs(cv2.Laplacian(gray_image, 3))) / 255.0
-        return ExtractorResult(np.array([[sharpness]]), stim, self,
-                               features=['sharpness'])
 
-
-class VibranceExtractor(ImageExtractor):
+class VibranceExtractor(BatchImageExtractor):
 
     ''' Gets the variance of color channels of the image '''
 
     VERSION = '1.0'
-
-    def _extract(self, stim):
-        data = stim.data
-        vibrance = np.var(data, 2).mean()
-        return ExtractorResult(np.array([[vibrance]]), stim, self,
-                               features=['vibrance'])
+    _feature = 'vibrance'
+
+    def _compute(self, images):
+        # n ** 2 times the variance across the n channels, in integers
+        n = images.shape[3]
+        images = images.astype(np.int32)
+        scaled = n * (images ** 2).sum(axis=3) - images.sum(axis=3) ** 2
+        scaled = scaled.reshape(len(images), -1)
+        return scaled.sum(axis=1, dtype=np.int64) / \
+            float(n ** 2 * scaled.shape[1])
 
 
 class SaliencyExtractor(ImageExtractor):
@@ -3,14 +3,15 @@
 import os
 import tempfile
 import tarfile
-import subprocess
-import re
-import requests
+import numpy as np
+from pliers import http_session
 from pliers.extractors.image import ImageExtractor
 from pliers.extractors.base import ExtractorResult
+from pliers.transformers import BatchTransformerMixin
+from pliers.utils import attempt_to_import, verify_dependencies
 
 
-class TensorFlowInceptionV3Extractor(ImageExtractor):
+class TensorFlowInceptionV3Extractor(BatchTransformerMixin, ImageExtractor):
 
     ''' Labels objects in images using a pretrained Inception V3 architecture
      implemented in TensorFlow.
@@ -22,14 +23,22 @@ class TensorFlowInceptionV3Extractor(ImageExtractor):
             TensoryFlow tutorials.
         num_predictions (int): Number of top predicted labels to retain for
             each image.
+        batch_size (int): Number of images passed to the extractor at once.
+
+    The model is loaded into an in-process TensorFlow session the first time
+    the extractor is applied, and reused for all subsequent images.
      '''
 
     _log_attributes = ('model_dir', 'data_url', 'num_predictions')
-    VERSION = '1.0'
+    _batch_size = 64
+    VERSION = '1.1'
 
-    def __init__(self, model_dir=None, data_url=None, num_predictions=5):
+    def __init__(self, model_dir=None, data_url=None, num_predictions=5,
+                 batch_size=None):
 
-        super(TensorFlowInceptionV3Extractor, self).__init__()
+        super(TensorFlowInceptionV3Extractor, self).__init__(
+            batch_size=batch_size)
+        self._session = None
 
         if model_dir is None:
             model_dir = os.path.join(tempfile.gettempdir(), 'TFInceptionV3')
@@ -55,31 +64,68 @@ class TensorFlowInceptionV3Extractor(ImageExtractor):
             os.makedirs(self.model_dir)
         filename = os.path.basename(self.model_file)
         if not os.path.exists(self.model_file):
-            r = requests.get(self.data_url)
-            with open(self.model_file, 'wb') as f:
-                f.write(r.content)
+            http_session.download(self.data_url, self.model_file)
             size = os.stat(self.model_file).st_size
             print('\tSuccesfully downloaded', filename, size, 'bytes.')
             tarfile.open(self.model_file, 'r:gz').extractall(self.model_dir)
 
-    def _extract(self, stim):
-        from pliers.external import tensorflow as tf
-        tf_dir = os.path.dirname(tf.__file__)
-        script = os.path.join(tf_dir, 'classify_image.py')
-
-        with stim.get_filename() as filename:
-            args = ' --image_file %s --model_dir %s --num_top_prediction %d' % \
-                (filename, self.model_dir, self.num_predictions)
-            cmd = ('python ' + script + args).split()
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-            output, errors = process.communicate()
-            hits = output.decode('utf-8').splitlines()[-self.num_predictions:]
-
-        values, features = [], []
-        for i, h in enumerate(hits):
-            m = re.search('(.*?)\s\(score\s\=\s([0-9\.]+)\)', h.strip())
-            extraction = m.groups()
-            features.append(extraction[0])
-            values.append(float(extraction[1]))
-
-        return ExtractorResult([values], stim, self, features=features)
+    def _load_model(self):
+        tf = attempt_to_import('tensorflow')
+        verify_dependencies(['tensorflow'])
+        from pliers.external.tensorflow.classify_image import NodeLookup
+
+        graph = tf.Graph()
+        with graph.as_default():
+            graph_def = tf.GraphDef()
+            graph_file = os.path.join(self.model_dir,
+                                      'classify_image_graph_def.pb')
+            with open(graph_file, 'rb') as f:
+                graph_def.ParseFromString(f.read())
+            tf.import_graph_def(graph_def, name='')
+        self._session = tf.Session(graph=graph)
+        # Feeding the decoded image skips the graph's JPEG decoder
+        self._input = graph.get_tensor_by_name('DecodeJpeg:0')
+        self._softmax = graph.get_tensor_by_name('softmax:0')
+
+        lookup = NodeLookup(
+            os.path.join(self.model_dir,
+                         'imagenet_2012_challenge_label_map_proto.pbtxt'),
+            os.path.join(self.model_dir,
+                         'imagenet_synset_to_human_label_map.txt'))
+        n_labels = int(self._softmax.get_shape()[-1])
+        self._labels = np.array([lookup.id_to_string(i)
+                                 for i in range(n_labels)], dtype=object)
+
+    @staticmethod
+    def _prepare_image(data):
+        data = np.asarray(data)
+        if data.ndim == 2:
+            data = np.dstack([data] * 3)
+        data = data[:, :, :3]
+        if data.dtype != np.uint8:
+            data = data.astype(np.uint8)
+        return data
+
+    def _extract(self, stims):
+        if self._session is None:
+            self._load_model()
+
+        # The pretrained graph has a fixed batch dimension of 1, so images
+        # are run one at a time through the same session
+        scores = np.vstack([
+            self._session.run(self._softmax,
+                              {self._input: self._prepare_image(s.data)})
+            for s in stims])
+        top = np.argsort(scores, axis=1)[:, ::-1][:, :self.num_predictions]
+        top_scores = scores[np.arange(len(stims))[:, None], top]
+
+        return [ExtractorResult(top_scores[i:i+1], s, self,
+                                features=list(self._labels[top[i]]))
+                for i, s in enumerate(stims)]
+
+    def __getstate__(self):
+        # Sessions can't be pickled; the model is reloaded on first use
+        d = dict((k, v) for k, v in self.__dict__.items()
+                 if k not in ('_input', '_softmax', '_labels'))
+        d['_session'] = None
+        return d
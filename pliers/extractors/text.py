@@ -4,20 +4,23 @@ Extractors that operate primarily or exclusively on Text stimuli.
 
 from pliers.stimuli.text import TextStim, ComplexTextStim
 from pliers.extractors.base import Extractor, ExtractorResult
+from pliers.stimuli.base import _log_transformation
 from pliers.support.exceptions import PliersError
 from pliers.support.decorators import requires_nltk_corpus
-from pliers.datasets.text import fetch_dictionary
+from pliers.datasets.text import (fetch_dictionaries, convert_embeddings,
+                                  load_embeddings)
+from pliers import config
+from pliers.cache import get_cache
 from pliers.transformers import BatchTransformerMixin
 from pliers.utils import attempt_to_import, verify_dependencies
 import numpy as np
 import pandas as pd
 import nltk
+import os
 from nltk.sentiment.vader import SentimentIntensityAnalyzer
 import sys
 from six import string_types
 
-keyedvectors = attempt_to_import('gensim.models.keyedvectors', 'keyedvectors',
-                                 ['KeyedVectors'])
 sklearn_text = attempt_to_import('sklearn.feature_extraction.text', 'sklearn_text',
                                  ['VectorizerMixin', 'CountVectorizer'])
 
@@ -43,10 +46,12 @@ class ComplexTextExtractor(Extractor):
         return ExtractorResult(vals, stim, self, ['word'], onsets, durations)
 
 
-class DictionaryExtractor(TextExtractor):
+class DictionaryExtractor(BatchTransformerMixin, TextExtractor):
 
     ''' A generic dictionary-based extractor that supports extraction of
-    arbitrary features contained in a lookup table.
+    arbitrary features contained in a lookup table. All of the words in a
+    batch are looked up at once; if the dictionary has several entries for a
+    word, the first is used.
     Args:
         dictionary (str, DataFrame): The dictionary containing the feature
             values. Either a string giving the path to the dictionary file,
@@ -60,6 +65,7 @@ class DictionaryExtractor(TextExtractor):
     '''
 
     _log_attributes = ('dictionary', 'variables', 'missing')
+    _batch_size = sys.maxsize
     VERSION = '1.0'
 
     def __init__(self, dictionary, variables=None, missing=np.nan):
@@ -74,18 +80,19 @@ class DictionaryExtractor(TextExtractor):
         else:
             self.data = self.data[variables]
         self.variables = variables
+        # Lookups need a unique index; pandas builds its hash table once
+        if not self.data.index.is_unique:
+            self.data = self.data[~self.data.index.duplicated()]
         # Set up response when key is missing
         self.missing = missing
         super(DictionaryExtractor, self).__init__()
 
-    def _extract(self, stim):
-        if stim.text not in self.data.index:
-            vals = pd.Series(self.missing, self.variables)
-        else:
-            vals = self.data.loc[stim.text].fillna(self.missing)
-        vals = vals.to_dict()
-        return ExtractorResult(np.array([list(vals.values())]), stim, self,
-                               features=list(vals.keys()))
+    def _extract(self, stims):
+        vals = self.data.reindex([s.text for s in stims])
+        vals = vals.fillna(self.missing).values
+        features = list(self.data.columns)
+        return [ExtractorResult(vals[i:i + 1], stim, self, features=features)
+                for i, stim in enumerate(stims)]
 
 
 class PredefinedDictionaryExtractor(DictionaryExtractor):
@@ -127,17 +134,7 @@ class PredefinedDictionaryExtractor(DictionaryExtractor):
                     _vars[v[0]].append(v[1])
             variables = _vars
 
-        dicts = []
-        for k, v in variables.items():
-            d = fetch_dictionary(k)
-            if not case_sensitive:
-                d.index = d.index.str.lower()
-            if v:
-                d = d[v]
-            d.columns = ['%s_%s' % (k, c) for c in d.columns]
-            dicts.append(d)
-
-        dictionary = pd.concat(dicts, axis=1, join='outer')
+        dictionary = fetch_dictionaries(variables, case_sensitive)
         super(PredefinedDictionaryExtractor, self).__init__(
             dictionary, missing=missing)
 
@@ -181,66 +178,126 @@ class NumUniqueWordsExtractor(TextExtractor):
 
 class PartOfSpeechExtractor(BatchTransformerMixin, TextExtractor):
 
-    ''' Tags parts of speech in text with nltk. '''
+    ''' Tags parts of speech in text with nltk. Several ComplexTextStims can
+    be tagged at once by passing them in a list; each is tagged as a
+    separate sequence, but in a single call to the tagger. '''
 
     _batch_size = sys.maxsize
+    # Tag long texts in chunks rather than all at once
+    _batch_bytes = 2**24
     VERSION = '1.0'
 
-    @requires_nltk_corpus
-    def _extract(self, stims):
-        words = [w.text for w in stims]
-        pos = nltk.pos_tag(words)
-        if len(words) != len(pos):
+    # The UPenn tagset and the column of each tag, loaded on first use
+    _tagset = None
+
+    @classmethod
+    def _get_tagset(cls):
+        if PartOfSpeechExtractor._tagset is None:
+            tags = list(nltk.data.load('help/tagsets/upenn_tagset.pickle'))
+            PartOfSpeechExtractor._tagset = (
+                tags, dict((t, i) for i, t in enumerate(tags)))
+        return PartOfSpeechExtractor._tagset
+
+    def _one_hot(self, tags):
+        features, columns = self._get_tagset()
+        # Tags outside the tagset get columns of their own
+        extra = sorted(set(tags) - set(columns))
+        if extra:
+            features = features + extra
+            columns = dict(columns, **dict((t, len(columns) + i)
+                                           for i, t in enumerate(extra)))
+        data = np.zeros((len(tags), len(features)), dtype=int)
+        data[np.arange(len(tags)), [columns[t] for t in tags]] = 1
+        return data, features
+
+    def _to_results(self, stims, pos):
+        if len(stims) != len(pos):
             raise PliersError(
                 "The number of words does not match the number of tagged words"
                 "returned by nltk's part-of-speech tagger.")
+        data, features = self._one_hot([p[1] for p in pos])
+        return [ExtractorResult(data[i:i + 1], s, self, features=features)
+                for i, s in enumerate(stims)]
 
-        results = []
-        tagset = nltk.data.load('help/tagsets/upenn_tagset.pickle').keys()
-        for i, s in enumerate(stims):
-            pos_vector = dict.fromkeys(tagset, 0)
-            pos_vector[pos[i][1]] = 1
-            results.append(ExtractorResult([pos_vector.values()], s, self,
-                                           features=list(pos_vector.keys())))
+    @requires_nltk_corpus
+    def _extract(self, stims):
+        return self._to_results(stims, nltk.pos_tag([w.text for w in stims]))
 
+    def _iterate(self, stims, *args, **kwargs):
+        stims = list(stims)
+        if stims and all(isinstance(s, ComplexTextStim) for s in stims):
+            return self._tag_transcripts(stims)
+        return super(PartOfSpeechExtractor, self)._iterate(stims, *args,
+                                                           **kwargs)
+
+    @requires_nltk_corpus
+    def _tag_transcripts(self, stims):
+        # Returns, for each ComplexTextStim, the same list of results (logged
+        # against its elements) that transforming it on its own would
+        results, keys = [None] * len(stims), [None] * len(stims)
+        cache = get_cache() if config.cache_transformers else None
+        if cache is not None:
+            for i, stim in enumerate(stims):
+                keys[i] = self._get_cache_key(stim)
+                try:
+                    results[i] = cache.get(keys[i], self, stim)
+                except KeyError:
+                    pass
+        todo = [i for i, r in enumerate(results) if r is None]
+        elements = [list(self._validate(stims[i])) for i in todo]
+        tagged = nltk.pos_tag_sents([[e.text for e in elems]
+                                     for elems in elements])
+        for i, elems, pos in zip(todo, elements, tagged):
+            results[i] = [_log_transformation(e, r, self) for e, r in
+                          zip(elems, self._to_results(elems, pos))]
+            if cache is not None:
+                cache.set(keys[i], results[i], self, stims[i])
         return results
 
 
-class WordEmbeddingExtractor(TextExtractor):
+class WordEmbeddingExtractor(BatchTransformerMixin, TextExtractor):
 
     ''' An extractor that uses a word embedding file to look up embedding
-    vectors for text.
+    vectors for text. The file is converted to a memory-mapped store the
+    first time it is used (see pliers.datasets.text.convert_embeddings), so
+    later instances--including those in other processes--load it almost
+    instantly and share its memory.
 
     Args:
         embedding_file (str): path to a word embedding file. Assumed to be in
-            word2vec format compatible with gensim.
+            word2vec format compatible with gensim, unless it is a directory
+            created by convert_embeddings().
         binary (bool): flag indicating whether embedding file is saved in a
             binary format
         prefix (str): prefix for feature names in the ExtractorResult.
     '''
 
-    _log_attributes = ('wvModel', 'prefix')
+    # The store's name identifies the embedding file's contents (see
+    # convert_embeddings), so cached results are keyed on it, not on the path
+    _log_attributes = ('store', 'prefix')
+    _batch_size = sys.maxsize
 
     def __init__(self, embedding_file, binary=False,
                  prefix='embedding_dim'):
-        verify_dependencies(['keyedvectors'])
-        self.wvModel = keyedvectors.KeyedVectors.load_word2vec_format(embedding_file,
-                                                                      binary=binary)
+        self.embedding_file = embedding_file
+        self.binary = binary
+        if os.path.isdir(embedding_file):
+            self.store = embedding_file
+        else:
+            self.store = convert_embeddings(embedding_file, binary=binary)
         self.prefix = prefix
         super(WordEmbeddingExtractor, self).__init__()
 
-    def _extract(self, stim):
-        num_dims = self.wvModel.vector_size
-        if stim.text in self.wvModel:
-            embedding_vector = self.wvModel[stim.text]
-        else:
-            # UNKs will have zeroed-out vectors
-            embedding_vector = np.zeros(num_dims)
-        features = ['%s%d' % (self.prefix, i) for i in range(num_dims)]
-        return ExtractorResult([embedding_vector],
-                               stim,
-                               self,
-                               features=features)
+    def _extract(self, stims):
+        vocab, vectors = load_embeddings(self.store)
+        indices = vocab.get_indexer([s.text for s in stims])
+        embeddings = np.array(vectors[np.maximum(indices, 0)])
+        # UNKs will have zeroed-out vectors
+        embeddings[indices < 0] = 0
+        features = ['%s%d' % (self.prefix, i) for i in range(vectors.shape[1])]
+        return [ExtractorResult(embeddings[i:i + 1], stim, self,
+                                features=features)
+                for i, stim in enumerate(stims)]
 
 
 class TextVectorizerExtractor(BatchTransformerMixin, TextExtractor):
@@ -268,11 +325,14 @@ class TextVectorizerExtractor(BatchTransformerMixin, TextExtractor):
         super(TextVectorizerExtractor, self).__init__()
 
     def _extract(self, stims):
-        mat = self.vectorizer.fit_transform([s.text for s in stims]).toarray()
+        # The vocabulary is fit to all stims at once, so they can't be
+        # chunked; rows are densified one at a time instead
+        mat = self.vectorizer.fit_transform([s.text for s in stims]).tocsr()
+        features = self.vectorizer.get_feature_names()
         results = []
-        for i, row in enumerate(mat):
-            results.append(ExtractorResult([row], stims[i], self,
-                           features=self.vectorizer.get_feature_names()))
+        for i, stim in enumerate(stims):
+            results.append(ExtractorResult(mat[i].toarray(), stim, self,
+                                           features=features))
         return results
 
 
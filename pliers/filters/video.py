@@ -2,6 +2,7 @@
 
 from pliers.stimuli.video import VideoFrameCollectionStim
 from .base import Filter
+import numpy as np
 
 
 class VideoFilter(Filter):
@@ -20,19 +21,36 @@ class FrameSamplingFilter(VideoFilter):
         hertz (int): takes n frames per second
         top_n (int): takes top n frames sorted by the absolute difference
          with the next frame
+        threshold (float): takes frames whose mean absolute difference with
+         the next frame (on a 0-255 scale) is at least this large
+        shots (int): takes n frames per shot, evenly spaced from the start
+         of the shot, so each frame lasts until the next one (or the end of
+         the shot)
+        shot_threshold (float): the histogram difference (from 0 to 1)
+         between consecutive frames that marks the start of a new shot
+
+    Frame differences and shot boundaries are read from the video's motion
+    index (see VideoFrameCollectionStim.get_motion_index), which is only
+    computed once per video.
     '''
 
-    _log_attributes = ('every', 'hertz', 'top_n')
+    _log_attributes = ('every', 'hertz', 'top_n', 'threshold', 'shots',
+                       'shot_threshold')
     VERSION = '1.0'
 
-    def __init__(self, every=None, hertz=None, top_n=None):
-        if every is None and hertz is None and top_n is None:
+    def __init__(self, every=None, hertz=None, top_n=None, threshold=None,
+                 shots=None, shot_threshold=0.3):
+        if every is None and hertz is None and top_n is None and \
+                threshold is None and shots is None:
             raise ValueError("When initializing the FrameSamplingFilter, "
-                             "one of the 'every', 'hertz', or 'top_n' must "
-                             "be specified.")
+                             "one of the 'every', 'hertz', 'top_n', "
+                             "'threshold' or 'shots' must be specified.")
         self.every = every
         self.hertz = hertz
         self.top_n = top_n
+        self.threshold = threshold
+        self.shots = shots
+        self.shot_threshold = shot_threshold
         super(FrameSamplingFilter, self).__init__()
 
     def _filter(self, video):
@@ -41,21 +59,32 @@ class FrameSamplingFilter(VideoFilter):
         elif self.hertz is not None:
             interval = int(video.fps / self.hertz)
             new_idx = range(int(video.fps * video.clip.duration))[::interval]
-        elif self.top_n is not None:
-            import cv2
-            diffs = []
-            for i, img in enumerate(video.frames):
-                if i == 0:
-                    last = img
-                    continue
-                diffs.append(sum(cv2.sumElems(cv2.absdiff(last.data, img.data))))
-                last = img
-            new_idx = sorted(range(len(diffs)),
-                             key=lambda i: diffs[i],
-                             reverse=True)[:self.top_n]
-
-        frame_index = sorted(list(set(video.frame_index).intersection(new_idx)))
+        elif self.shots is not None:
+            frames = np.sort(video.frame_index)
+            starts = video.get_shot_boundaries(self.shot_threshold)
+            shot = np.searchsorted(starts, frames, side='right') - 1
+            _, first, counts = np.unique(shot, return_index=True,
+                                         return_counts=True)
+            steps = np.arange(self.shots)
+            picks = first[:, None] + steps * counts[:, None] // self.shots
+            new_idx = frames[np.unique(picks)]
+        else:
+            frames = np.asarray(video.frame_index)
+            motion = video.get_motion_index()
+            scores = np.zeros(len(frames), dtype=motion.dtype)
+            valid = frames < len(motion)
+            scores[valid] = motion[frames[valid]]
+            if self.top_n is not None:
+                n = min(self.top_n, len(frames))
+                top = np.argpartition(-scores, n - 1)[:n] if n else []
+                new_idx = frames[top]
+            else:
+                new_idx = frames[scores >= self.threshold]
+
+        frame_index = sorted(int(i) for i in
+                             set(video.frame_index).intersection(new_idx))
 
         return VideoFrameCollectionStim(filename=video.filename,
                                         frame_index=frame_index,
-                                        onset=video.onset)
+                                        onset=video.onset,
+                                        clip=video.clip)
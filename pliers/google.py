@@ -1,5 +1,6 @@
 import base64
 import os
+import threading
 from pliers.transformers import Transformer, BatchTransformerMixin
 from pliers.utils import (EnvironmentKeyMixin, attempt_to_import,
                           verify_dependencies)
@@ -8,6 +9,7 @@ from pliers.utils import (EnvironmentKeyMixin, attempt_to_import,
 googleapiclient = attempt_to_import('googleapiclient', fromlist=['discovery'])
 oauth_client = attempt_to_import('oauth2client.client', 'oauth_client',
                                  ['GoogleCredentials'])
+httplib2 = attempt_to_import('httplib2')
 
 
 DISCOVERY_URL = 'https://{api}.googleapis.com/$discovery/rest?version={apiVersion}'
@@ -37,12 +39,21 @@ class GoogleAPITransformer(Transformer, EnvironmentKeyMixin):
                                                        credentials=self.credentials,
                                                        discoveryServiceUrl=DISCOVERY_URL)
         self.handle_annotations = handle_annotations
+        self._local = threading.local()
         super(GoogleAPITransformer, self).__init__()
 
+    def _get_http(self):
+        # httplib2 connections can't be shared between threads (e.g., when
+        # requests are sent by transform_async()), so each thread gets its own
+        if not hasattr(self._local, 'http'):
+            self._local.http = self.credentials.authorize(httplib2.Http())
+        return self._local.http
+
     def _query_api(self, request):
         resource = getattr(self.service, self.resource)()
         request = resource.annotate(body={'requests': request})
-        return request.execute(num_retries=self.num_retries)['responses']
+        return request.execute(http=self._get_http(),
+                               num_retries=self.num_retries)['responses']
 
 
 class GoogleVisionAPITransformer(BatchTransformerMixin, GoogleAPITransformer):
@@ -50,6 +61,17 @@ class GoogleVisionAPITransformer(BatchTransformerMixin, GoogleAPITransformer):
     api_name = 'vision'
     resource = 'images'
     _batch_size = 10
+    # Requests are limited to 10MB; leave room for the rest of the JSON
+    _batch_bytes = 8 * 2**20
+
+    def _get_stim_size(self, stim):
+        # Images are sent base64-encoded, as stored on disk if possible (see
+        # _build_request); otherwise, the raw pixels are an upper bound
+        if stim.filename is not None and os.path.exists(stim.filename):
+            size = os.path.getsize(stim.filename)
+        else:
+            size = stim.data.nbytes
+        return size * 4 // 3
 
     def _build_request(self, stims):
         request = []
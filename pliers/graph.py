@@ -1,14 +1,46 @@
+from pliers import config
 from pliers.extractors.base import Extractor, merge_results
-from pliers.transformers import get_transformer
-from pliers.utils import (listify, flatten, isgenerator, attempt_to_import,
-                          verify_dependencies)
+from pliers.parallel import parallel_transform
+from pliers.transformers import get_transformer, BatchTransformerMixin
+from pliers.utils import (listify, flatten, isgenerator, isiterable,
+                          attempt_to_import, verify_dependencies)
 from itertools import chain
 from six import string_types
 from collections import OrderedDict
 
 import json
+import logging
+import pandas as pd
+import time
 
 pgv = attempt_to_import('pygraphviz', 'pgv')
+futures = attempt_to_import('concurrent.futures', 'futures',
+                            ['ThreadPoolExecutor'])
+
+
+def _run_transformer(transformer, stim, in_pool=False):
+    ''' Applies a node's Transformer to its input; returns the result (with
+    generators expanded, so it can be handed to several children) and the
+    wall time taken. If in_pool is True, stims are transformed in the
+    worker pool from pliers.parallel. '''
+    start = time.time()
+    result = None
+    if in_pool and not isinstance(transformer, BatchTransformerMixin):
+        try:
+            result = list(parallel_transform(transformer, listify(stim)))
+        except Exception as err:
+            logging.warning("Unable to parallelize %s; transforming stims "
+                            "serially instead (%s)." % (transformer.name, err))
+        else:
+            if not isiterable(stim):
+                result = result[0]
+            elif config.drop_bad_extractor_results:
+                result = [r for r in result if r is not None]
+    if result is None:
+        result = transformer.transform(stim)
+    if isgenerator(result):
+        result = list(result)
+    return result, time.time() - start
 
 
 class Node(object):
@@ -30,6 +62,8 @@ class Node(object):
         if name is not None:
             self.transformer.name = name
         self.id = id(transformer)
+        # Seconds spent in the Transformer during the last Graph run
+        self.wall_time = None
 
     def add_child(self, node):
         ''' Append a child to the list of children. '''
@@ -120,20 +154,72 @@ class Graph(object):
 
         g.draw(filename, prog='dot')
 
-    def run(self, stim, merge=True):
-        results = list(chain(*[self.run_node(n, stim) for n in self.roots]))
+    def run(self, stim, merge=True, executor=None, n_jobs=None):
+        ''' Executes the graph on the passed stim(s).
+        Args:
+            stim (Stim, list): The Stim(s) to pass to the root nodes.
+            merge (bool): If True, returns a single merged DataFrame;
+                otherwise, returns a list of ExtractorResults.
+            executor (str, Executor): If None, nodes are run one at a time,
+                depth-first. Otherwise, every node runs as soon as its parent
+                has finished, concurrently with any other node that is
+                ready, so independent branches overlap. Valid values are
+                'thread' (a thread pool; suits API and other I/O-bound
+                Transformers), 'process' (a thread pool that hands the stims
+                of each node to the worker pool in pliers.parallel), or an
+                instance of concurrent.futures.Executor.
+            n_jobs (int): Number of threads used by the 'thread' and
+                'process' executors. Defaults to the number of nodes.
+        '''
+        for node in self.nodes.values():
+            node.wall_time = None
+        if executor is None:
+            results = list(chain(*[self.run_node(n, stim)
+                                   for n in self.roots]))
+        else:
+            results = self._run_scheduled(stim, executor, n_jobs)
+        return self._finish(results, merge)
+
+    transform = run
+
+    def run_async(self, stim, merge=True, **kwargs):
+        ''' Coroutine version of run(). Every node runs as soon as its parent
+        has finished. Nodes with API Transformers are applied with
+        Transformer.transform_async(), so their requests overlap (and are
+        rate limited and retried); all other nodes run in the event loop's
+        default executor. Requires Python 3.5+.
+        Args:
+            stim (Stim, list): The Stim(s) to pass to the root nodes.
+            merge (bool): If True, returns a single merged DataFrame;
+                otherwise, returns a list of ExtractorResults.
+            kwargs: Optional keyword arguments passed on to
+                Transformer.transform_async() (e.g., max_in_flight).
+        '''
+        from pliers.asynchronous import run_graph
+        return run_graph(self, stim, merge, **kwargs)
+
+    def _finish(self, results, merge):
         results = list(flatten(results))
         self._results = results  # For use in plotting
         return merge_results(results) if merge else results
 
-    transform = run
+    def _ordered_outputs(self, outputs):
+        # Returns the outputs of Extractor nodes (a dict keyed by node) in
+        # the same depth-first order as a serial run
+        def collect(node):
+            if node in outputs:
+                return outputs[node]
+            return chain(*[collect(c) for c in node.children])
+        return list(chain(*[collect(n) for n in self.roots]))
 
     def run_node(self, node, stim):
 
         if isinstance(node, string_types):
             node = self.nodes[node]
 
+        start = time.time()
         result = node.transformer.transform(stim)
+        node.wall_time = time.time() - start
         if isinstance(node.transformer, Extractor):
             return listify(result)
 
@@ -144,6 +230,57 @@ class Graph(object):
             stim = list(stim)
         return list(chain(*[self.run_node(c, stim) for c in node.children]))
 
+    def _run_scheduled(self, stim, executor, n_jobs=None):
+        verify_dependencies(['futures'])
+        in_pool = executor == 'process'
+        if isinstance(executor, string_types):
+            if executor not in ('thread', 'process'):
+                raise ValueError("Unknown executor '%s'. Valid values are "
+                                 "'thread' and 'process'." % executor)
+            pool = futures.ThreadPoolExecutor(n_jobs or len(self.nodes) or 1)
+        else:
+            pool = executor
+
+        outputs = {}
+        pending = {}
+
+        def submit(node, stim):
+            future = pool.submit(_run_transformer, node.transformer, stim,
+                                 in_pool)
+            pending[future] = node
+
+        try:
+            for root in self.roots:
+                submit(root, stim)
+            while pending:
+                done, _ = futures.wait(list(pending),
+                                       return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    node = pending.pop(future)
+                    result, node.wall_time = future.result()
+                    if isinstance(node.transformer, Extractor):
+                        outputs[node] = listify(result)
+                    else:
+                        for child in node.children:
+                            submit(child, result)
+        finally:
+            for future in pending:
+                future.cancel()
+            if pool is not executor:
+                pool.shutdown()
+
+        return self._ordered_outputs(outputs)
+
+    def get_timings(self):
+        ''' Returns a DataFrame with the wall time (in seconds) each node's
+        Transformer took during the last run, in the order the nodes were
+        added. Time spent waiting for inputs is not included; in serial runs,
+        lazily generated outputs are partly timed by the consuming node. '''
+        rows = [(n.transformer.name, n.transformer.__class__.__name__,
+                 n.wall_time) for n in self.nodes.values()]
+        return pd.DataFrame(rows, columns=['node', 'transformer',
+                                           'wall_time'])
+
     @staticmethod
     def _parse_node_args(node):
 
@@ -0,0 +1,97 @@
+''' Shared HTTP sessions for everything in pliers that fetches URLs directly:
+URL-based Stims, dataset and model downloads, and API Converters that don't
+come with their own client library. Connections are kept alive and reused,
+and timeouts and retries are configured in one place (see config). '''
+
+from pliers import config
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import os
+import requests
+import threading
+
+_local = threading.local()
+
+
+def _create_session():
+    retry = Retry(total=config.http_max_retries,
+                  backoff_factor=config.http_retry_backoff,
+                  status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=config.http_pool_size,
+                          pool_maxsize=config.http_pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    ''' Returns the requests.Session for the current thread (Sessions aren't
+    guaranteed to be thread-safe), creating it if needed. Sessions are
+    configured when they are created, so changes to the http_* settings in
+    config only apply to new threads, or after reset_sessions() is called.
+    '''
+    # Forked processes must not share sockets with their parent
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.session, _local.pid = _create_session(), os.getpid()
+    return _local.session
+
+
+def reset_sessions():
+    ''' Discards the current thread's session, so the next request uses a
+    new one with the current config settings. '''
+    _local.pid = None
+
+
+def request(method, url, **kwargs):
+    ''' Sends a request through the shared session and returns the response,
+    raising a requests.HTTPError if the request ultimately fails.
+    Args:
+        method (str): The HTTP method; e.g., 'GET'.
+        url (str): The URL to request.
+        kwargs: Optional keyword arguments passed on to
+            requests.Session.request(). Unless a timeout is passed,
+            config.http_timeout is used.
+    '''
+    kwargs.setdefault('timeout', config.http_timeout)
+    response = get_session().request(method, url, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def get(url, **kwargs):
+    ''' Sends a GET request; see request(). '''
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    ''' Sends a POST request; see request(). '''
+    return request('POST', url, **kwargs)
+
+
+def decode_text(response):
+    ''' Returns the body of a response as text. requests assumes ISO-8859-1
+    for text responses that don't declare a charset, so their bodies are
+    instead decoded as UTF-8, falling back on the encoding detected from the
+    content. '''
+    content_type = response.headers.get('Content-Type', '')
+    if 'charset=' in content_type.lower():
+        return response.text
+    try:
+        return response.content.decode('utf-8')
+    except UnicodeDecodeError:
+        return response.content.decode(response.apparent_encoding or
+                                       'iso-8859-1', 'replace')
+
+
+def download(url, path, chunk_size=2**20):
+    ''' Streams the body of a URL into a local file, without holding it in
+    memory. '''
+    response = get(url, stream=True)
+    try:
+        with open(path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+    finally:
+        response.close()
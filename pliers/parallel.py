@@ -0,0 +1,311 @@
+''' A persistent process pool for applying Transformers to many Stims.
+
+The pool is created on first use and reused by all subsequent calls (and
+Graph nodes). Transformers are pickled once per call and loaded at most once
+per worker process; the VideoStims that frames are drawn from are shared the
+same way. Tasks carry only lightweight references: images loaded from files
+are pickled as their paths (and re-read by the workers; see
+ImageStim.__getstate__), and large arrays--e.g., the pixels of video
+frames--are passed in shared memory blocks, which are released once the
+result is back. Results are sent back without the Transformer or the input
+Stim, which are re-attached in the calling process. '''
+
+from pliers import config
+from pliers.cache import get_cache
+from pliers.stimuli.base import Stim
+from pliers.stimuli.video import VideoFrameCollectionStim
+from pliers.utils import batch_iterable, isgenerator, attempt_to_import
+from collections import OrderedDict
+import numpy as np
+import atexit
+import hashlib
+import io
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+
+shared_memory = attempt_to_import('multiprocessing.shared_memory',
+                                  'shared_memory', ['SharedMemory'])
+
+_pool = None
+_pool_size = None
+_pool_dir = None
+_pool_lock = threading.RLock()
+
+# Transformers and shared Stims loaded by the current worker process, most
+# recently used last
+_worker_objects = OrderedDict()
+_max_worker_objects = 32
+
+# Arrays at least this large (in bytes) are passed in shared memory
+_min_shared_bytes = 2**16
+
+
+class _RefPickler(pickle.Pickler):
+
+    ''' Pickles an object, replacing the passed references and any shared
+    objects with persistent IDs. '''
+
+    def __init__(self, file, refs=(), share=None):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self._refs = refs
+        self._share = share
+
+    def persistent_id(self, obj):
+        for name, ref in self._refs:
+            if obj is ref:
+                return name
+        return self._share(obj) if self._share is not None else None
+
+
+class _RefUnpickler(pickle.Unpickler):
+
+    ''' Restores an object pickled by _RefPickler. '''
+
+    def __init__(self, file, refs=None, load_shared=None):
+        pickle.Unpickler.__init__(self, file)
+        self._refs = refs or {}
+        self._load_shared = load_shared
+        self.shared = {}
+
+    def persistent_load(self, pid):
+        if isinstance(pid, tuple) and pid[0] == 'array':
+            return _read_array(*pid[1:])
+        if isinstance(pid, tuple):
+            obj = self._load_shared(pid[1])
+            self.shared[id(obj)] = pid
+            return obj
+        return self._refs[pid]
+
+
+def _dumps(obj, refs=(), share=None):
+    f = io.BytesIO()
+    _RefPickler(f, refs, share).dump(obj)
+    return f.getvalue()
+
+
+def _loads(data, refs=None, load_shared=None):
+    unpickler = _RefUnpickler(io.BytesIO(data), refs, load_shared)
+    return unpickler.load(), unpickler.shared
+
+
+def _write_array(arr):
+    # Copies an array into a new shared memory block
+    block = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, arr.dtype, block.buf)[...] = arr
+    return block
+
+
+def _read_array(name, shape, dtype):
+    # Copies an array out of a shared memory block, which the caller
+    # releases once the task is done
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype, block.buf).copy()
+    finally:
+        block.close()
+
+
+def _release(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+
+def _init_worker(pool_dir):
+    global _pool_dir
+    _pool_dir = pool_dir
+
+
+def _load_shared(key):
+    if key in _worker_objects:
+        obj = _worker_objects.pop(key)
+    else:
+        with open(os.path.join(_pool_dir, key), 'rb') as f:
+            obj = pickle.load(f)
+        if len(_worker_objects) >= _max_worker_objects:
+            _worker_objects.popitem(last=False)
+    _worker_objects[key] = obj
+    return obj
+
+
+def _run_task(task):
+    settings, transformer_key, data, args, kwargs = task
+    for name, value in settings.items():
+        setattr(config, name, value)
+    transformer = _load_shared(transformer_key)
+    stim, shared = _loads(data, load_shared=_load_shared)
+    result = transformer.transform(stim, *args, **kwargs)
+    if isgenerator(result):
+        result = list(result)
+    refs = [('transformer', transformer), ('stim', stim)]
+    return _dumps(result, refs, lambda obj: shared.get(id(obj)))
+
+
+def _get_context():
+    # Forked workers would inherit every open file descriptor--including
+    # the pipes of ffmpeg readers held by clips, which then never see EOF
+    try:
+        return multiprocessing.get_context('forkserver')
+    except (AttributeError, ValueError):
+        return multiprocessing
+
+
+def get_pool(n_jobs=None):
+    ''' Returns the process-wide worker pool, creating it if needed.
+    Args:
+        n_jobs (int): Number of worker processes. If None, the value of
+            config.n_jobs is used (defaulting to the number of CPUs). The
+            pool is re-created if the number changes.
+    '''
+    global _pool, _pool_size, _pool_dir
+    if n_jobs is None:
+        n_jobs = config.n_jobs or multiprocessing.cpu_count()
+    with _pool_lock:
+        if _pool is not None and _pool_size != n_jobs:
+            _shutdown()
+        if _pool is None:
+            _pool_dir = tempfile.mkdtemp(prefix='pliers_pool_')
+            _pool = _get_context().Pool(n_jobs, _init_worker, (_pool_dir,))
+            _pool_size = n_jobs
+    return _pool
+
+
+def _shutdown():
+    global _pool, _pool_size, _pool_dir
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+        shutil.rmtree(_pool_dir, ignore_errors=True)
+    _pool, _pool_size, _pool_dir = None, None, None
+
+
+def shutdown_pool():
+    ''' Terminates the worker pool and removes its shared files. A new pool
+    is created the next time one is needed. '''
+    with _pool_lock:
+        _shutdown()
+
+
+atexit.register(shutdown_pool)
+
+
+class _Context(object):
+
+    ''' Calling-process side of a parallel transformation. Writes shared
+    objects to the pool directory once each, and restores references in the
+    results that come back. '''
+
+    def __init__(self, transformer, pool_dir):
+        self.transformer = transformer
+        self.pool_dir = pool_dir
+        self.objects = {}
+        self._keys = {}
+        self.transformer_key = self.share(transformer)
+
+        # Workers mirror the caller's config, but never nest pools, and
+        # leave in-memory caching to the caller
+        self.settings = dict((k, v) for k, v in vars(config).items()
+                             if not k.startswith('_'))
+        self.settings['parallelize'] = False
+        self.settings['progress_bar'] = False
+        if not get_cache().persistent:
+            self.settings['cache_transformers'] = False
+
+    def share(self, obj):
+        if id(obj) not in self._keys:
+            data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            key = hashlib.sha1(data).hexdigest()
+            path = os.path.join(self.pool_dir, key)
+            if not os.path.exists(path):
+                fd, tmp = tempfile.mkstemp(dir=self.pool_dir)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.rename(tmp, path)
+            self._keys[id(obj)] = key
+            self.objects[key] = obj
+        return self._keys[id(obj)]
+
+    def _share_id(self, obj, blocks):
+        # Frames carry a reference to their source video, whose clip would
+        # otherwise be reloaded every time a frame is unpickled
+        if isinstance(obj, VideoFrameCollectionStim):
+            return ('shared', self.share(obj))
+        if shared_memory is not None and type(obj) is np.ndarray and \
+                not obj.dtype.hasobject and obj.nbytes >= _min_shared_bytes:
+            block = _write_array(obj)
+            blocks.append(block)
+            return ('array', block.name, obj.shape, obj.dtype.str)
+        return None
+
+    def dump_task(self, stim, args, kwargs):
+        ''' Returns the task for a stim, along with the shared memory blocks
+        that hold its arrays; pass these to _release() once the result is
+        back. '''
+        blocks = []
+        data = _dumps(stim, share=lambda obj: self._share_id(obj, blocks))
+        return (self.settings, self.transformer_key, data, args,
+                kwargs), blocks
+
+    def load_result(self, data, stim):
+        refs = {'transformer': self.transformer, 'stim': stim}
+        return _loads(data, refs, self.objects.get)[0]
+
+
+def parallel_transform(transformer, stims, *args, **kwargs):
+    ''' Applies a Transformer to each of several Stims in the worker pool.
+    Returns a generator that yields results in the order of the input, as
+    they arrive. Results are memoized in the calling process the same way
+    as when stims are transformed one at a time.
+    Args:
+        transformer (Transformer): The Transformer to apply.
+        stims (iterable): The Stims to transform. Stims are read (and
+            pickled) in bounded windows, so generators are not exhausted up
+            front.
+        args, kwargs: Optional arguments passed on to transform().
+
+    Raises an error right away (rather than on iteration) if the Transformer
+    can't be pickled.
+    '''
+    with _pool_lock:
+        pool, n_jobs = get_pool(), _pool_size
+        context = _Context(transformer, _pool_dir)
+    return _iter_results(pool, n_jobs, context, stims, args, kwargs)
+
+
+def _iter_results(pool, n_jobs, context, stims, args, kwargs):
+    transformer = context.transformer
+    chunk_size = config.parallel_chunk_size
+    cache = get_cache() if config.cache_transformers else None
+    for batch in batch_iterable(stims, chunk_size * n_jobs * 2):
+        results, keys = [None] * len(batch), [None] * len(batch)
+        if cache is not None:
+            for i, stim in enumerate(batch):
+                if isinstance(stim, Stim):
+                    keys[i] = transformer._get_cache_key(stim)
+                    try:
+                        results[i] = cache.get(keys[i], transformer, stim)
+                    except KeyError:
+                        pass
+        todo = [i for i, r in enumerate(results) if r is None]
+        tasks, blocks = [], {}
+        try:
+            for i in todo:
+                task, blocks[i] = context.dump_task(batch[i], args, kwargs)
+                tasks.append(task)
+            done = pool.imap(_run_task, tasks, chunk_size)
+            for i, stim in enumerate(batch):
+                if i in blocks:
+                    results[i] = context.load_result(next(done), stim)
+                    _release(blocks.pop(i))
+                    # Persistent caches are written to by the workers
+                    # directly
+                    if keys[i] is not None and not cache.persistent:
+                        cache.set(keys[i], results[i], transformer, stim)
+                yield results[i]
+        finally:
+            for b in blocks.values():
+                _release(b)
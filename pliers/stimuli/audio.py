@@ -1,12 +1,62 @@
 ''' Classes that represent audio clips. '''
 
-from .base import Stim
+from .base import Stim, array_digest, file_fingerprint
+from pliers import config
+from pliers.cache import estimate_size
 from moviepy.audio.io.AudioFileClip import AudioFileClip
+from collections import OrderedDict
+import numpy as np
+import os
+import tempfile
+import threading
+
+
+def _get_audio_cache_path():
+    dir_path = config.audio_cache_dir or \
+        os.path.join(tempfile.gettempdir(), 'pliers_audio')
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    return dir_path
+
+
+def _trim_audio_cache(keep):
+    ''' Removes the least recently used decoded files (other than keep) until
+    all of them take up no more than config.audio_cache_max_bytes. Files
+    that are still memory-mapped remain readable until they are released.
+    '''
+    max_bytes = config.audio_cache_max_bytes
+    if max_bytes is None:
+        return
+    dir_path = os.path.dirname(keep)
+    files = []
+    for name in os.listdir(dir_path):
+        path = os.path.join(dir_path, name)
+        if not name.endswith('.f32') or path == keep:
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:  # Removed by another process
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    n_bytes = os.path.getsize(keep) + sum(f[1] for f in files)
+    for _, size, path in sorted(files):
+        if n_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        n_bytes -= size
 
 
 class AudioStim(Stim):
 
-    ''' Represents an audio clip.
+    ''' Represents an audio clip. Samples are decoded lazily, the first time
+    data (or read()) is accessed, into a mono float32 file that is then
+    memory-mapped; clips loaded from local files share the decoded file
+    across instances and processes. Decoded files are kept in
+    config.audio_cache_dir, and the least recently used ones are removed
+    once they take up more than config.audio_cache_max_bytes.
     Args:
         filename (str): Path to audio file.
         onset (float): Optional onset of the audio file (in seconds) with
@@ -17,6 +67,8 @@ class AudioStim(Stim):
     '''
 
     _default_file_extension = '.wav'
+    # Number of samples to decode at once
+    _chunk_size = 50000
 
     def __init__(self, filename=None, onset=None, sampling_rate=44100, url=None, clip=None):
         if url is not None:
@@ -24,34 +76,147 @@ class AudioStim(Stim):
         self.filename = filename
         self.sampling_rate = sampling_rate
         self.clip = clip
+        self._data = None
+        self._data_file = None
+        self._derivatives = OrderedDict()
+        # Sibling Graph nodes may access the samples from several threads
+        self._lock = threading.RLock()
+        self._from_file = clip is None and filename is not None and \
+            os.path.exists(filename)
 
         if self.clip is None:
             self._load_clip()
 
-        # Small default buffer isn't ideal, but moviepy has persistent issues
-        # with some files otherwise; see
-        # https://github.com/Zulko/moviepy/issues/246
-        self.data = self.clip.to_soundarray(buffersize=1000)
         duration = self.clip.duration
 
-        if self.data.ndim > 1:
-            # Average channels to make data mono
-            self.data = self.data.mean(axis=1)
-
         super(AudioStim, self).__init__(
             filename, onset=onset, duration=duration)
 
     def _load_clip(self):
         self.clip = AudioFileClip(self.filename, fps=self.sampling_rate)
 
+    @property
+    def data(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    self._data = self._decode()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        with self._lock:
+            self._data = data
+            self._data_file = None
+            self._derivatives = OrderedDict()
+            self._from_file = False
+            self._content_digest = None
+
+    def get_derivative(self, key, func):
+        ''' Returns a quantity derived from the samples (e.g., a spectrogram),
+        computing it the first time it is requested. Derivatives are shared
+        by all Extractors applied to the stim, and are discarded whenever
+        the samples change; the least recently used ones are also discarded
+        once all of them take up more than config.derivative_max_bytes.
+        Args:
+            key (tuple): A hashable key that uniquely identifies the
+                derivative, including any parameters used to compute it.
+            func (callable): Called with no arguments to compute the
+                derivative if it isn't already stored.
+        '''
+        with self._lock:
+            if key in self._derivatives:
+                # Re-insert to mark as most recently used
+                value = self._derivatives.pop(key)
+                self._derivatives[key] = value
+                return value
+            value = func()
+            max_bytes = config.derivative_max_bytes
+            if max_bytes is None:
+                self._derivatives[key] = value
+            elif estimate_size(value) <= max_bytes:
+                self._derivatives[key] = value
+                n_bytes = sum(estimate_size(v)
+                              for v in self._derivatives.values())
+                while n_bytes > max_bytes:
+                    n_bytes -= estimate_size(
+                        self._derivatives.popitem(False)[1])
+            return value
+
+    def read(self, start=None, stop=None):
+        ''' Returns the samples between two time points without loading the
+        rest of the clip into memory.
+        Args:
+            start (float): Start of the window, in seconds from the beginning
+                of the clip. Defaults to the beginning.
+            stop (float): End of the window, in seconds from the beginning of
+                the clip. Defaults to the end.
+        '''
+        start = 0 if start is None else int(round(start * self.sampling_rate))
+        if stop is not None:
+            stop = int(round(stop * self.sampling_rate))
+        return self.data[start:stop]
+
+    def _decode(self):
+        if self._from_file:
+            path = os.path.join(_get_audio_cache_path(),
+                                self.content_digest + '.f32')
+            try:
+                # Mark as recently used
+                os.utime(path, None)
+            except OSError:
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+                with os.fdopen(fd, 'wb') as f:
+                    self._write_samples(f)
+                os.rename(tmp, path)
+                _trim_audio_cache(path)
+            self._data_file = path
+        else:
+            # Anonymous file; removed once the memory map is released
+            path = tempfile.TemporaryFile()
+            self._write_samples(path)
+            path.flush()
+
+        if self.clip.duration == 0:
+            return np.zeros(0, dtype='float32')
+        # Copy-on-write, so extractors can't alter the shared file
+        return np.memmap(path, dtype='float32', mode='c')
+
+    def _write_samples(self, f):
+        # Small chunks avoid persistent moviepy issues with some files; see
+        # https://github.com/Zulko/moviepy/issues/246
+        chunks = self.clip.iter_chunks(chunksize=self._chunk_size,
+                                       fps=self.sampling_rate)
+        for chunk in chunks:
+            if chunk.ndim > 1:
+                # Average channels to make data mono
+                chunk = chunk.mean(axis=1)
+            f.write(chunk.astype('float32').tobytes())
+
+    def _get_content_digest(self):
+        if self._from_file:
+            digest = file_fingerprint(self.filename)
+        else:
+            digest = array_digest(self.data)
+        return digest + '@%d' % self.sampling_rate
+
     def __getstate__(self):
         d = self.__dict__.copy()
         d['clip'] = None
+        d['_derivatives'] = OrderedDict()
+        del d['_lock']
+        if self._from_file:
+            # Re-map the shared decoded file rather than pickling samples
+            d['_data'] = None
+        else:
+            d['_data'] = np.asarray(self.data)
         return d
 
     def __setstate__(self, d):
         self.__dict__ = d
-        self._load_clip()
+        self._lock = threading.RLock()
+        if self.filename is not None:
+            self._load_clip()
 
     def save(self, path):
         self.clip.write_audiofile(path)
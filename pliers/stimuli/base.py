@@ -5,13 +5,14 @@ from abc import ABCMeta, abstractmethod
 from os.path import exists, isdir, join, basename
 from glob import glob
 from six import with_metaclass, string_types
-from six.moves.urllib.request import urlopen
 from six.moves.urllib.parse import urlparse
 from collections import namedtuple
 from contextlib import contextmanager
-from pliers import config
+from pliers import config, http_session
 from pliers.utils import isiterable
+import numpy as np
 import pandas as pd
+import hashlib
 import os
 import tempfile
 
@@ -63,8 +64,60 @@ class Stim(with_metaclass(ABCMeta)):
     def history(self, history):
         self._history = history
 
+    @property
+    def content_digest(self):
+        ''' A hex digest of the Stim's content (pixels, samples, text, or a
+        fingerprint of the source file). Computed on first access and then
+        reused. '''
+        if getattr(self, '_content_digest', None) is None:
+            self._content_digest = self._get_content_digest()
+        return self._content_digest
+
+    def _get_content_digest(self):
+        # Fallback for Stims without a more specific notion of content
+        if self.filename is not None and os.path.exists(self.filename):
+            return file_fingerprint(self.filename)
+        return _digest(repr((self.filename, str(self.history))).encode('utf-8'))
+
+    @property
+    def digest(self):
+        ''' A hex digest identifying the Stim that is stable across processes;
+        combines the content digest with the Stim's name and timing. Used to
+        key cached Transformer outputs and to group ExtractorResults. '''
+        key = (self.__class__.__name__, self.content_digest, self.name,
+               self.onset, self.duration)
+        return _digest(repr(key).encode('utf-8'))
+
     def __hash__(self):
-        return hash((self.filename, self.name, self.onset, self.duration, self.history))
+        return hash(self.digest)
+
+
+def _digest(*chunks):
+    h = hashlib.sha1()
+    for c in chunks:
+        h.update(c)
+    return h.hexdigest()
+
+
+def array_digest(data):
+    ''' Returns a hex digest of a numpy array's shape, dtype and contents. '''
+    data = np.ascontiguousarray(data)
+    header = repr((data.shape, data.dtype.str)).encode('utf-8')
+    if data.dtype.hasobject:
+        return _digest(header, repr(data.tolist()).encode('utf-8'))
+    return _digest(header, data.view(np.uint8).reshape(-1))
+
+
+def file_fingerprint(filename, block_size=2**16):
+    ''' Returns a hex digest of a file's size and modification time, plus its
+    first and last block_size bytes. Cheap enough to use on large videos. '''
+    info = os.stat(filename)
+    with open(filename, 'rb') as f:
+        head = f.read(block_size)
+        f.seek(max(info.st_size - block_size, 0))
+        tail = f.read(block_size)
+    header = repr((info.st_size, info.st_mtime)).encode('utf-8')
+    return _digest(header, head, tail)
 
 
 def _get_stim_class(name):
@@ -98,6 +151,7 @@ def load_stims(source, dtype=None, fail_silently=False):
     Returns: A list of Stims.
     """
     from .video import VideoStim, ImageStim
+    from .image import _read_image
     from .audio import AudioStim
     from .text import TextStim
 
@@ -127,13 +181,24 @@ def load_stims(source, dtype=None, fail_silently=False):
             stims.append(s)
 
     def load_url(source):
+        # The body is only read (once) for Stims built from it; audio and
+        # video are streamed by ffmpeg itself
+        response = http_session.get(source, stream=True)
         try:
-            main_type = urlopen(source).info().get_content_maintype()  # Py3
-        except:
-            main_type = urlopen(source).info().getmaintype()  # Py2
-        if main_type in stim_map.keys():
-            s = stim_map[main_type](url=source)
-            stims.append(s)
+            main_type = response.headers.get('Content-Type', '')
+            main_type = main_type.split('/')[0].strip()
+            if main_type == 'image':
+                s = ImageStim(source, data=_read_image(response.content))
+            elif main_type == 'text':
+                s = TextStim(source,
+                             text=http_session.decode_text(response))
+            elif main_type in stim_map.keys():
+                s = stim_map[main_type](url=source)
+            else:
+                return
+        finally:
+            response.close()
+        stims.append(s)
 
     for s in source:
         if bool(urlparse(s).scheme):
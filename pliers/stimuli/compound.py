@@ -3,7 +3,7 @@
 
 from six import string_types
 from pliers.utils import listify
-from .base import _get_stim_class
+from .base import _get_stim_class, _digest
 from .audio import AudioStim
 from .text import ComplexTextStim
 
@@ -72,6 +72,12 @@ class CompoundStim(object):
             return [] if return_all else None
         return matches
 
+    @property
+    def digest(self):
+        ''' A hex digest combining the digests of all constituent elements. '''
+        digests = ''.join(e.digest for e in self.elements)
+        return _digest(digests.encode('utf-8'))
+
     def get_types(self):
         ''' Return tuple of types of all available Stims. '''
         return tuple(set([e.__class__ for e in self.elements]))
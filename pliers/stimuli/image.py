@@ -1,13 +1,28 @@
 ''' Classes that represent images. '''
 
-from .base import Stim
+from .base import Stim, array_digest
+from pliers import http_session
 from scipy.misc import imread
 from PIL import Image
-from six.moves.urllib.request import urlopen
 from scipy.misc import imsave
 import six
 import io
 import numpy as np
+import os
+
+
+def _read_image(content):
+    # Decodes the bytes of an image file into an RGB array
+    img = Image.open(io.BytesIO(content))
+    return np.array(img.convert(mode='RGB'))
+
+
+def _file_stat(filename):
+    try:
+        info = os.stat(filename)
+    except OSError:
+        return None
+    return (info.st_size, info.st_mtime)
 
 
 class ImageStim(Stim):
@@ -26,15 +41,47 @@ class ImageStim(Stim):
     _default_file_extension = '.png'
 
     def __init__(self, filename=None, onset=None, duration=None, data=None, url=None):
-        if data is None and isinstance(filename, six.string_types):
+        from_file = data is None and url is None and \
+            isinstance(filename, six.string_types)
+        if from_file:
             data = imread(filename, mode='RGB')
         if url is not None:
-            img = Image.open(io.BytesIO(urlopen(url).read()))
-            img = img.convert(mode='RGB')
-            data = np.array(img)
+            data = _read_image(http_session.get(url).content)
             filename = url
         self.data = data
+        self._file_stat = _file_stat(filename) if from_file else None
         super(ImageStim, self).__init__(filename, onset=onset, duration=duration)
 
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._file_stat = None
+        self._content_digest = None
+
+    def _get_content_digest(self):
+        if self.data is None:
+            return super(ImageStim, self)._get_content_digest()
+        return array_digest(self.data)
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        # Images loaded from files that haven't changed since are pickled
+        # without their pixels (e.g., when sent to worker processes), and
+        # read again when unpickled. Pixels altered in place aren't detected;
+        # assign a new array to data instead.
+        stat = d.get('_file_stat')
+        if stat is not None and _file_stat(self.filename) == stat:
+            d['_data'] = None
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__ = d
+        if self._data is None and d.get('_file_stat') is not None:
+            self._data = imread(self.filename, mode='RGB')
+
     def save(self, path):
         imsave(path, self.data)
@@ -2,10 +2,10 @@
 
 import re
 import pandas as pd
-from six import string_types
-from six.moves.urllib.request import urlopen
+from six import string_types, text_type
+from pliers import http_session
 from pliers.support.decorators import requires_nltk_corpus
-from .base import Stim
+from .base import Stim, _digest
 
 
 class TextStim(Stim):
@@ -27,7 +27,7 @@ class TextStim(Stim):
         if filename is not None and text is None:
             text = open(filename).read()
         if url is not None:
-            text = urlopen(url).read()
+            text = http_session.decode_text(http_session.get(url))
         self.text = text
         name = 'text[%s]' % text[:40]  # Truncate at 40 chars
         super(TextStim, self).__init__(filename, onset, duration, name)
@@ -36,6 +36,12 @@ class TextStim(Stim):
     def data(self):
         return self.text
 
+    def _get_content_digest(self):
+        text = self.text
+        if isinstance(text, text_type):
+            text = text.encode('utf-8')
+        return _digest(text)
+
     def save(self, path):
         with open(path, 'w') as f:
             f.write(self.text)
@@ -171,6 +177,11 @@ class ComplexTextStim(Stim):
         offset = 0.0 if self.onset is None else self.onset
         elem.onset = offset if elem.onset is None else offset + elem.onset
         self._elements.append(elem)
+        self._content_digest = None
+
+    def _get_content_digest(self):
+        elems = [(e.content_digest, e.onset, e.duration) for e in self._elements]
+        return _digest(repr(elems).encode('utf-8'))
 
     def __iter__(self):
         """ Iterate text elements. """
@@ -1,10 +1,24 @@
 ''' Classes that represent video clips. '''
 
 from __future__ import division
+from collections import OrderedDict
 from math import ceil
 from moviepy.video.io.VideoFileClip import VideoFileClip
-from .base import Stim
+from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
+import moviepy
+from pliers import config
+from pliers.utils import prefetch_iterable
+from .base import Stim, _digest, file_fingerprint
 from .image import ImageStim
+import numpy as np
+import os
+import tempfile
+
+# Per-video indices computed by VideoFrameCollectionStim.get_motion_index(),
+# most recently used last. Indices are also saved to disk, so only a few
+# are kept in memory.
+_motion_indices = OrderedDict()
+_max_motion_indices = 8
 
 
 class VideoFrameStim(ImageStim):
@@ -27,9 +41,9 @@ class VideoFrameStim(ImageStim):
         onset = frame_num * spf
         if video.onset:
             onset += video.onset
-        super(VideoFrameStim, self).__init__(filename, onset, duration, data)
         if data is None:
-            self.data = self.video.get_frame(index=frame_num).data
+            data = video.clip.get_frame(frame_num * spf)
+        super(VideoFrameStim, self).__init__(filename, onset, duration, data)
         self.name += 'frame[%s]' % frame_num
 
 
@@ -45,19 +59,25 @@ class VideoFrameCollectionStim(Stim):
             respect to some more general context or timeline the user wishes
             to keep track of.
         url (str): Optional url source for a video.
+        clip (VideoFileClip): Optional clip already loaded from the same
+            file, to share rather than opening the file again.
     '''
 
     _default_file_extension = '.mp4'
 
-    def __init__(self, filename=None, frame_index=None, onset=None, url=None):
+    def __init__(self, filename=None, frame_index=None, onset=None, url=None,
+                 clip=None):
         if url is not None:
             filename = url
         self.filename = filename
-        self._load_clip()
+        if clip is None:
+            self._load_clip()
+        else:
+            self.clip = clip
         self.fps = self.clip.fps
         self.width = self.clip.w
         self.height = self.clip.h
-        if frame_index:
+        if frame_index is not None:
             self.frame_index = frame_index
         else:
             self.frame_index = range(int(ceil(self.fps * self.clip.duration)))
@@ -70,10 +90,57 @@ class VideoFrameCollectionStim(Stim):
     def _load_clip(self):
         self.clip = VideoFileClip(self.filename)
 
+    def _get_content_digest(self):
+        if os.path.exists(self.filename):
+            source = file_fingerprint(self.filename)
+        else:
+            source = self.filename
+        key = (source, list(self.frame_index))
+        return _digest(repr(key).encode('utf-8'))
+
     def __iter__(self):
         """ Frame iteration. """
-        for i, f in enumerate(self.frame_index):
-            yield self.get_frame(i)
+        return self.iter_frames()
+
+    def iter_frames(self, prefetch=None):
+        ''' Iterates over the frames in frame_index, decoding them in order
+        from a single ffmpeg pipe. Frames that are not in frame_index are
+        skipped without seeking, so memory use does not depend on the length
+        of the video.
+        Args:
+            prefetch (int): Number of decoded frames to buffer ahead of the
+                consumer in a background thread. If None, the value of
+                config.prefetch_frames is used. If 0, frames are decoded on
+                demand in the calling thread.
+        '''
+        if prefetch is None:
+            prefetch = config.prefetch_frames
+        frames = self._decode_frames()
+        if prefetch:
+            frames = prefetch_iterable(frames, prefetch)
+        for i, data in enumerate(frames):
+            yield self._make_frame(i, data)
+
+    def _decode_frames(self):
+        reader = FFMPEG_VideoReader(self.filename)
+        # The reader decodes the first frame on initialization
+        pos, last = 1, reader.lastread
+        try:
+            for frame_num in self.frame_index:
+                if frame_num == pos - 1:
+                    yield last
+                    continue
+                elif frame_num < pos:
+                    # Out-of-order index; fall back on random access
+                    yield self.clip.get_frame(float(frame_num) / self.fps)
+                    continue
+                if frame_num > pos:
+                    reader.skip_frames(frame_num - pos)
+                last = reader.read_frame()
+                pos = frame_num + 1
+                yield last
+        finally:
+            reader.close()
 
     @property
     def frames(self):
@@ -82,11 +149,13 @@ class VideoFrameCollectionStim(Stim):
     def get_frame(self, index=None, onset=None):
         if onset:
             index = int(onset * self.fps)
+        return self._make_frame(index)
 
+    def _make_frame(self, index, data=None):
         frame_num = self.frame_index[index]
         onset = float(frame_num) / self.fps
 
-        if index < self.n_frames - 2:
+        if index < self.n_frames - 1:
             next_frame_num = self.frame_index[index+1]
             end = float(next_frame_num) / self.fps
         else:
@@ -94,9 +163,98 @@ class VideoFrameCollectionStim(Stim):
 
         duration = end - onset if end > onset else 0.0
 
-        return VideoFrameStim(self, frame_num,
-                              data=self.clip.get_frame(onset),
-                              duration=duration)
+        if data is None:
+            data = self.clip.get_frame(onset)
+
+        return VideoFrameStim(self, frame_num, data=data, duration=duration)
+
+    def get_motion_index(self, width=64):
+        ''' Returns the motion index of the source video: for every frame,
+        the mean absolute difference (over pixels and channels, on a 0-255
+        scale) from the next frame. Frames are downsampled to the given width
+        by ffmpeg and scored in a single streaming pass; the last frame
+        scores 0. Indices are computed once per video file and cached in
+        memory and under ~/pliers_data/motion, so later calls--including
+        those on collections derived from the same video--don't decode it
+        again.
+        Args:
+            width (int): Width (in pixels) to downsample frames to.
+        Returns: A float32 array indexed by frame number in the source video.
+        '''
+        return self._get_video_index(width)['motion']
+
+    def get_shot_boundaries(self, threshold=0.3, width=64):
+        ''' Returns the frame numbers at which shots start in the source
+        video (always including frame 0). A shot starts wherever the color
+        histogram of a frame differs from the previous frame's by more than
+        threshold. Histograms are computed in the same pass, and cached the
+        same way, as the motion index (see get_motion_index()).
+        Args:
+            threshold (float): Minimum histogram difference between
+                consecutive frames, ranging from 0 (identical histograms) to
+                1 (no overlap), that marks the start of a new shot.
+            width (int): Width (in pixels) to downsample frames to.
+        '''
+        changes = self._get_video_index(width)['histogram']
+        return np.concatenate([[0], np.flatnonzero(changes > threshold)])
+
+    def _get_video_index(self, width):
+        if os.path.exists(self.filename):
+            key = '%s_%d' % (file_fingerprint(self.filename), width)
+        else:
+            key = '%s_%d' % (self.filename, width)
+        if key in _motion_indices:
+            index = _motion_indices.pop(key)
+        else:
+            path = None
+            if os.path.exists(self.filename):
+                path = os.path.join(_get_motion_path(), key + '.npz')
+            index = None
+            if path is not None and os.path.exists(path):
+                with np.load(path) as f:
+                    index = dict(f)
+                # Indices saved by earlier versions may lack some scores
+                if not all(k in index for k in ('motion', 'histogram')):
+                    index = None
+            if index is None:
+                index = self._scan(width)
+                if path is not None:
+                    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                               suffix='.npz')
+                    with os.fdopen(fd, 'wb') as f:
+                        np.savez(f, **index)
+                    os.rename(tmp, path)
+            if len(_motion_indices) >= _max_motion_indices:
+                _motion_indices.popitem(last=False)
+        _motion_indices[key] = index
+        return index
+
+    def _scan(self, width):
+        n_frames = int(ceil(self.fps * self.clip.duration))
+        # motion[i] compares frame i with frame i + 1, and histogram[i]
+        # compares frame i with frame i - 1
+        motion = np.zeros(n_frames, dtype=np.float32)
+        histogram = np.zeros(n_frames, dtype=np.float32)
+        # moviepy 2 takes target resolutions as (width, height); earlier
+        # versions as (height, width)
+        if int(moviepy.__version__.split('.')[0]) >= 2:
+            resolution = (width, None)
+        else:
+            resolution = (None, width)
+        reader = FFMPEG_VideoReader(self.filename,
+                                    target_resolution=resolution)
+        try:
+            last = reader.lastread.astype(np.int16)
+            last_hist = _color_histogram(last)
+            for i in range(min(reader.n_frames, n_frames) - 1):
+                frame = reader.read_frame().astype(np.int16)
+                hist = _color_histogram(frame)
+                motion[i] = np.abs(frame - last).mean()
+                histogram[i + 1] = np.abs(hist - last_hist).sum() / 2
+                last, last_hist = frame, hist
+        finally:
+            reader.close()
+        return {'motion': motion, 'histogram': histogram}
 
     def __getstate__(self):
         d = self.__dict__.copy()
@@ -112,6 +270,20 @@ class VideoFrameCollectionStim(Stim):
         self.clip.write_videofile(path)
 
 
+def _color_histogram(frame, bins=16):
+    # Normalized histogram of each color channel, concatenated
+    codes = frame[..., :3] * bins // 256 + np.arange(3) * bins
+    hist = np.bincount(codes.ravel(), minlength=3 * bins)
+    return hist / float(codes.size)
+
+
+def _get_motion_path():
+    dir_path = os.path.expanduser(os.path.join('~', 'pliers_data', 'motion'))
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    return dir_path
+
+
 class VideoStim(VideoFrameCollectionStim):
 
     ''' A video.
@@ -15,9 +15,11 @@ from pliers.extractors import (STFTAudioExtractor,
                                MelspectrogramExtractor,
                                MFCCExtractor,
                                TonnetzExtractor,
-                               TempogramExtractor)
+                               TempogramExtractor,
+                               LibrosaMultiFeatureExtractor)
 from pliers.stimuli import (ComplexTextStim, AudioStim, TranscribedAudioCompoundStim)
 import numpy as np
+import pytest
 
 AUDIO_DIR = join(get_test_data_path(), 'audio')
 
@@ -31,6 +33,12 @@ def test_stft_extractor():
     assert df.shape == (557, 5)
     assert df['onset'][0] == 4.2
 
+    ext = STFTAudioExtractor(freq_bins=5)
+    result = ext.transform(stim)
+    assert result.data.shape == (562, 5)
+    assert ext.freq_bins == 5
+    assert np.isfinite(result.data).all()
+
 
 def test_mean_amplitude_extractor():
     audio = AudioStim(join(AUDIO_DIR, "barber_edited.wav"))
@@ -184,6 +192,45 @@ def test_mfcc_extractor():
     assert np.isclose(df['mfcc_14'][2], -7.41533)
 
 
+def test_shared_spectrogram():
+    # Call _extract() directly to bypass memoized results
+    audio = AudioStim(join(AUDIO_DIR, "barber.wav"))
+    SpectralCentroidExtractor()._extract(audio)
+    assert list(audio._derivatives) == [('spectrogram', 2048, 512)]
+    MFCCExtractor()._extract(audio)
+    ChromaSTFTExtractor()._extract(audio)
+    assert len(audio._derivatives) == 2
+
+    # Distinct STFT parameters get their own spectrogram; arguments that
+    # alter the STFT bypass it altogether
+    SpectralCentroidExtractor(hop_length=256)._extract(audio)
+    assert ('spectrogram', 2048, 256) in audio._derivatives
+    SpectralCentroidExtractor(center=False)._extract(audio)
+    assert len(audio._derivatives) == 3
+
+
+def test_librosa_multi_feature_extractor():
+    audio = AudioStim(join(AUDIO_DIR, "barber.wav"), onset=1.0)
+    ext = LibrosaMultiFeatureExtractor(['spectral_centroid', 'mfcc',
+                                        'chroma_stft'])
+    df = ext.transform(audio).to_df()
+    assert df.shape == (4882, 35)
+    assert list(df.columns[:4]) == ['onset', 'duration', 'spectral_centroid',
+                                    'mfcc_0']
+    assert np.isclose(df['onset'][1], 1.01161)
+    mfcc = MFCCExtractor().transform(audio).to_df()
+    assert np.allclose(df['mfcc_3'], mfcc['mfcc_3'])
+
+    ext = LibrosaMultiFeatureExtractor({'mfcc': {'n_mfcc': 5},
+                                        'zero_crossing_rate': {}})
+    df = ext.transform(audio).to_df()
+    assert df.shape == (4882, 8)
+    assert 'mfcc_4' in df.columns and 'zero_crossing_rate' in df.columns
+
+    with pytest.raises(ValueError):
+        LibrosaMultiFeatureExtractor(['mfcc', 'not_a_feature'])
+
+
 def test_tonnetz_extractor():
     audio = AudioStim(join(AUDIO_DIR, "barber.wav"))
     ext = TonnetzExtractor()
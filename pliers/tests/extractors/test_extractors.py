@@ -7,7 +7,8 @@ from pliers.extractors import (LengthExtractor,
 from pliers.stimuli import (ComplexTextStim, ImageStim, VideoStim,
                             AudioStim)
 from pliers.support.download import download_nltk_data
-from pliers.extractors.base import ExtractorResult, merge_results
+from pliers.extractors.base import (ExtractorResult, ResultAccumulator,
+                                    merge_results)
 import numpy as np
 import pytest
 
@@ -73,6 +74,53 @@ def test_implicit_stim_conversion3():
     assert first_word['onset'][0] >= 4.2
 
 
+def test_empty_extractor_result():
+    stim = ImageStim(join(get_test_data_path(), 'image', 'apple.jpg'))
+    result = ExtractorResult([], stim, DummyExtractor(), features=[])
+    assert result.to_numpy().shape == (0, 0)
+    assert result.to_df().shape == (0, 2)
+    result = ExtractorResult([], stim, DummyExtractor(), features=['a', 'b'])
+    df = result.to_df()
+    assert df.shape == (0, 4)
+    assert list(df.columns) == ['onset', 'duration', 'a', 'b']
+    assert merge_results([result]).shape[0] == 0
+
+
+def test_extractor_result_storage():
+    stim = ImageStim(join(get_test_data_path(), 'image', 'apple.jpg'))
+    data = np.random.rand(10, 3)
+    result = ExtractorResult(data, stim, DummyExtractor(),
+                             features=['a', 'b', 'a'], onsets=np.arange(10))
+    assert np.array_equal(result.to_numpy(), data)
+    df = result.to_df()
+    assert df.columns.tolist() == ['onset', 'duration', 'a_1', 'b', 'a_2']
+    assert np.shares_memory(df['b'].values, result.to_numpy())
+    assert np.isnan(df['duration']).all()
+
+    # Results with the same features share their names
+    result2 = ExtractorResult(data, stim, DummyExtractor(),
+                              features=['a', 'b', 'a'])
+    assert result2.features is result.features
+
+    # Non-numeric values keep their per-column types
+    result = ExtractorResult([['cat', 1], ['dog', 2]], stim, DummyExtractor(),
+                             features=['word', 'count'])
+    df = result.to_df()
+    assert df['word'].tolist() == ['cat', 'dog']
+    assert df['count'].dtype == np.int64
+
+
+def test_extractor_result_to_arrow():
+    pytest.importorskip('pyarrow')
+    stim = ImageStim(join(get_test_data_path(), 'image', 'apple.jpg'))
+    result = ExtractorResult(np.random.rand(10, 2), stim, DummyExtractor(),
+                             features=['a', 'b'], onsets=np.arange(10))
+    table = result.to_arrow()
+    assert table.column_names == ['onset', 'duration', 'a', 'b']
+    assert np.array_equal(table.column('b').to_numpy(),
+                          result.to_numpy()[:, 1])
+
+
 def test_merge_extractor_results_by_features():
     np.random.seed(100)
     image_dir = join(get_test_data_path(), 'image')
@@ -126,6 +174,41 @@ def test_merge_extractor_results():
     assert set(df['stim_name'].unique()) == set(['obama.jpg', 'apple.jpg'])
 
 
+def test_result_accumulator(tmpdir):
+    np.random.seed(100)
+    image_dir = join(get_test_data_path(), 'image')
+    stim1 = ImageStim(join(image_dir, 'apple.jpg'))
+    stim2 = ImageStim(join(image_dir, 'obama.jpg'))
+    des = [DummyExtractor(name=name) for name in ['Extractor1', 'Extractor2']]
+    results = [de.transform(s) for s in [stim1, stim2] for de in des]
+    df = merge_results(results)
+    assert (np.diff(df['onset']) >= 0).all()
+
+    # Values end up in the rows for their Stim and onset
+    r = results[3]
+    rows = df[df['stim_name'] == 'obama.jpg'].set_index('onset')
+    values = rows.loc[r.onsets, ('Extractor2', 1)].values
+    assert np.array_equal(values, r.data[:, 1])
+
+    # Incremental mode buffers values on disk as results are added
+    accumulator = ResultAccumulator(buffer_dir=str(tmpdir))
+    for r in results:
+        accumulator.add(r)
+    assert len(tmpdir.listdir()) == 1
+    assert accumulator.to_df().equals(df)
+    accumulator.close()
+    assert len(tmpdir.listdir()) == 0
+
+    # Results without onsets are matched by position
+    results = [ExtractorResult(r.data, r.stim, r.extractor, onsets=np.nan)
+               for r in results]
+    df = merge_results(results)
+    assert df.shape == (200, 13)
+    assert df['onset'].isnull().all()
+    rows = df[df['stim_name'] == 'apple.jpg']
+    assert np.array_equal(rows['Extractor1'].values, results[0].data)
+
+
 def test_merge_extractor_results_flattened():
     np.random.seed(100)
     image_dir = join(get_test_data_path(), 'image')
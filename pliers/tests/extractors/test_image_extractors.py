@@ -5,8 +5,9 @@ from pliers.extractors import (BrightnessExtractor,
                                VibranceExtractor,
                                SaliencyExtractor,
                                TensorFlowInceptionV3Extractor)
-from pliers.stimuli import ImageStim
-from pliers.extractors.base import merge_results
+from pliers.stimuli import ImageStim, VideoStim
+from pliers.extractors.base import merge_results, ExtractorResult
+from pliers.filters import FrameSamplingFilter
 import numpy as np
 import pytest
 
@@ -23,7 +24,6 @@ def test_brightness_extractor():
 
 
 def test_sharpness_extractor():
-    pytest.importorskip('cv2')
     stim = ImageStim(join(IMAGE_DIR, 'apple.jpg'), onset=4.2, duration=1)
     result = SharpnessExtractor().transform(stim).to_df()
     sharpness = result['sharpness'][0]
@@ -41,6 +41,30 @@ def test_vibrance_extractor():
     assert result['duration'][0] == 1
 
 
+def test_batch_image_extractors():
+    stims = [ImageStim(join(IMAGE_DIR, f)) for f in
+             ['apple.jpg', 'obama.jpg', 'apple.jpg']]
+    for ext in [BrightnessExtractor(), SharpnessExtractor(),
+                VibranceExtractor()]:
+        results = ext.transform(stims)
+        assert len(results) == 3
+        single = ext.transform(stims[1]).to_numpy()
+        assert np.allclose(results[1].to_numpy(), single)
+        assert np.allclose(results[0].to_numpy(), results[2].to_numpy())
+
+    # Whole videos give a single result, with one row per frame
+    video = VideoStim(join(get_test_data_path(), 'video', 'small.mp4'))
+    video = FrameSamplingFilter(every=10).transform(video)
+    result = BrightnessExtractor(merge_frames=True).transform(video)
+    assert isinstance(result, ExtractorResult)
+    df = result.to_df()
+    assert df.shape == (video.n_frames, 3)
+    assert np.allclose(df['onset'], [f.onset for f in video])
+    frames = BrightnessExtractor().transform(video)
+    assert len(frames) == video.n_frames
+    assert np.allclose(df['brightness'], [f.to_numpy()[0, 0] for f in frames])
+
+
 def test_saliency_extractor():
     pytest.importorskip('cv2')
     stim = ImageStim(join(IMAGE_DIR, 'apple.jpg'))
@@ -59,7 +83,8 @@ def test_tensor_flow_inception_v3_extractor():
     df = merge_results(results)
     assert len(df) == 2
     assert ('TensorFlowInceptionV3Extractor', 'Granny Smith') in df.columns
-    assert 0.22610 in df[
-        ('TensorFlowInceptionV3Extractor', 'Windsor tie')].values
+    # Images are decoded by pliers rather than by TensorFlow's JPEG decoder
+    assert np.isclose(df[('TensorFlowInceptionV3Extractor', 'Windsor tie')],
+                      0.22610, atol=0.01).any()
     assert 4.2 in df[('onset', '')].values
     assert 1 in df[('duration', '')].values
@@ -7,6 +7,8 @@ from pliers.extractors import (DictionaryExtractor,
                                WordEmbeddingExtractor,
                                VADERSentimentExtractor)
 from pliers.extractors.base import merge_results
+from pliers.datasets import text
+from pliers.datasets.text import load_embeddings
 from pliers.stimuli import TextStim, ComplexTextStim
 from ..utils import get_test_data_path
 
@@ -64,6 +66,14 @@ def test_dictionary_extractor():
     assert 'frequency' in result.columns
     assert np.isnan(result['frequency'][0])
 
+    td = DictionaryExtractor(join(TEXT_DIR, 'test_lexical_dictionary.txt'),
+                             variables=['length'], missing=-1)
+    stims = [TextStim(text=t) for t in ['for', 'some', 'annotation', 'for']]
+    results = td.transform(stims)
+    assert len(results) == 4
+    assert [r.to_df()['length'][0] for r in results] == [3, -1, 10, 3]
+    assert results[0].features is results[1].features
+
 
 def test_predefined_dictionary_extractor():
     stim = TextStim(text='enormous')
@@ -83,15 +93,44 @@ def test_part_of_speech_extractor():
     assert result['NN'].sum() == 1
     assert result['VBD'][3] == 1
 
-
-def test_word_embedding_extractor():
+    # Several transcripts are tagged at once, keeping element onsets
+    stim2 = ComplexTextStim(text='the dog barked')
+    ext = PartOfSpeechExtractor()
+    results = ext.transform([stim, stim2])
+    assert [len(r) for r in results] == [4, 3]
+    result2 = merge_results(results[1], extractor_names=False)
+    assert result2['DT'][0] == 1
+    first = merge_results(results[0], extractor_names=False)
+    assert first['onset'].equals(result['onset'])
+
+    # Results are cached per transcript, as when tagged on their own
+    cached = ext.transform(stim2)
+    assert cached is results[1]
+    assert cached[0].history.string == \
+        'ComplexTextStim->ComplexTextIterator/TextStim->' \
+        'PartOfSpeechExtractor/ExtractorResult'
+
+
+def test_word_embedding_extractor(tmpdir, monkeypatch):
     pytest.importorskip('gensim')
+    monkeypatch.setattr(text, '_get_embedding_path', lambda: str(tmpdir))
     stims = [TextStim(text='this'), TextStim(text='sentence')]
     ext = WordEmbeddingExtractor(join(TEXT_DIR, 'simple_vectors.bin'),
                                  binary=True)
     result = merge_results(ext.transform(stims))
     assert ('WordEmbeddingExtractor', 'embedding_dim99') in result.columns
     assert 0.001091 in result[('WordEmbeddingExtractor', 'embedding_dim0')]
+    assert ext.store.startswith(str(tmpdir))
+
+    # The converted store is reused, and can be passed in directly
+    ext2 = WordEmbeddingExtractor(ext.store)
+    vocab, vectors = load_embeddings(ext.store)
+    assert isinstance(vectors, np.memmap)
+    assert load_embeddings(ext2.store)[1] is vectors
+    results = ext2.transform([TextStim(text='this'), TextStim(text='zzz')])
+    assert np.allclose(results[0].to_numpy(),
+                       vectors[vocab.get_loc('this')])
+    assert not results[1].to_numpy().any()
 
 
 def test_vectorizer_extractor():
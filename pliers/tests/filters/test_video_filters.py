@@ -2,8 +2,9 @@ from os.path import join
 from ..utils import get_test_data_path
 from pliers.filters import FrameSamplingFilter
 from pliers.stimuli import VideoStim, VideoFrameStim
-import pytest
+from pliers.stimuli import video as video_stims
 import math
+import numpy as np
 
 VIDEO_DIR = join(get_test_data_path(), 'video')
 
@@ -38,8 +39,8 @@ def test_frame_sampling_video_filter():
     assert second.onset == 4.4
 
 
-def test_frame_sampling_cv2():
-    pytest.importorskip('cv2')
+def test_frame_sampling_top_n(tmpdir, monkeypatch):
+    monkeypatch.setattr(video_stims, '_get_motion_path', lambda: str(tmpdir))
     filename = join(VIDEO_DIR, 'small.mp4')
     video = VideoStim(filename)
 
@@ -47,3 +48,51 @@ def test_frame_sampling_cv2():
     derived = conv.transform(video)
     assert derived.n_frames == 5
     assert type(next(f for f in derived)) == VideoFrameStim
+    assert derived.clip is video.clip
+
+    motion = video.get_motion_index()
+    assert len(motion) == video.n_frames
+    top = sorted(range(len(motion)), key=lambda i: motion[i])[-5:]
+    assert set(derived.frame_index) == set(top)
+
+    # The index is computed once per video
+    assert VideoStim(filename).get_motion_index() is motion
+    conv = FrameSamplingFilter(threshold=motion[top[0]])
+    derived = conv.transform(video)
+    assert set(derived.frame_index) >= set(top)
+    conv = FrameSamplingFilter(threshold=motion.max() + 1)
+    assert conv.transform(video).n_frames == 0
+
+    # Only a few indices are kept in memory; evicted ones are reloaded
+    monkeypatch.setattr(video_stims, '_max_motion_indices', 1)
+    video.get_motion_index(width=40)
+    assert len(video_stims._motion_indices) == 1
+    reloaded = video.get_motion_index()
+    assert reloaded is not motion
+    assert np.array_equal(reloaded, motion)
+
+
+def test_frame_sampling_shots(tmpdir, monkeypatch):
+    monkeypatch.setattr(video_stims, '_get_motion_path', lambda: str(tmpdir))
+    filename = join(VIDEO_DIR, 'small.mp4')
+    video = VideoStim(filename, onset=1.0)
+
+    # No cuts in this video, so there's a single shot
+    derived = FrameSamplingFilter(shots=1).transform(video)
+    assert derived.frame_index == [0]
+    frame = next(f for f in derived)
+    assert frame.onset == 1.0
+    assert frame.duration == video.duration
+    derived = FrameSamplingFilter(shots=4).transform(video)
+    assert derived.n_frames == 4
+    assert derived.frame_index[0] == 0
+    frames = list(derived)
+    assert frames[0].duration == frames[1].onset - frames[0].onset
+    assert frames[2].duration == frames[3].onset - frames[2].onset
+
+    # Lower thresholds split it up
+    starts = video.get_shot_boundaries(0.015)
+    assert len(starts) > 1
+    conv = FrameSamplingFilter(shots=1, shot_threshold=0.015)
+    derived = conv.transform(video)
+    assert derived.frame_index == list(starts)
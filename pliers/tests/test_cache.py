@@ -0,0 +1,83 @@
+from os.path import join
+from pliers.cache import DiskCache, MemoryCache, estimate_size, get_cache
+from pliers import cache as cache_module
+from pliers.extractors import BrightnessExtractor
+from pliers.stimuli import ImageStim
+from pliers import config
+from .utils import get_test_data_path
+import numpy as np
+import pytest
+
+
+def test_memory_cache_lru_eviction():
+    cache = MemoryCache(max_entries=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache['a'] == 1
+    cache['c'] = 3
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+    with pytest.raises(KeyError):
+        cache['b']
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['evictions'] == 1
+    assert stats['entries'] == 2
+
+
+def test_memory_cache_byte_budget():
+    arr = np.zeros(1000)
+    assert estimate_size(arr) == 8000
+    cache = MemoryCache(max_bytes=20000)
+    cache['a'] = arr
+    cache['b'] = arr.copy()
+    cache['c'] = arr.copy()
+    assert 'a' not in cache
+    assert cache.n_bytes <= 20000
+    # Outputs larger than the whole budget are never stored
+    cache['d'] = np.zeros(5000)
+    assert 'd' not in cache
+
+
+def test_memoize_uses_configured_cache(monkeypatch):
+    monkeypatch.setattr(cache_module, '_caches', {})
+    monkeypatch.setattr(config, 'cache_max_entries', 1)
+    cache = get_cache()
+    image_dir = join(get_test_data_path(), 'image')
+    stim1 = ImageStim(join(image_dir, 'apple.jpg'))
+    stim2 = ImageStim(join(image_dir, 'obama.jpg'))
+    ext = BrightnessExtractor()
+    hits = cache.hits
+    res1 = ext.transform(stim1)
+    assert ext.transform(stim1) is res1
+    assert cache.hits == hits + 1
+    ext.transform(stim2)
+    assert len(cache) == 1
+    assert ext.transform(stim1) is not res1
+
+
+def test_disk_cache_persists_results(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir)
+    monkeypatch.setattr(cache_module, '_caches', {})
+    monkeypatch.setattr(config, 'cache_backend', 'disk')
+    monkeypatch.setattr(config, 'cache_dir', cache_dir)
+    stim = ImageStim(join(get_test_data_path(), 'image', 'apple.jpg'))
+    ext = BrightnessExtractor()
+    res1 = ext.transform(stim)
+    assert len(get_cache()) == 1
+
+    # A fresh cache instance stands in for a new process
+    cache_module._caches.pop('disk')
+    ext2 = BrightnessExtractor()
+    res2 = ext2.transform(stim)
+    cache = get_cache()
+    assert cache.hits == 1 and cache.misses == 0
+    assert res2 is not res1
+    assert res2.extractor is ext2
+    assert res2.stim is stim
+    assert res1.to_df().equals(res2.to_df())
+
+    cache.clear()
+    assert len(cache) == 0
+    assert len(DiskCache(cache_dir)) == 0
@@ -1,4 +1,8 @@
-from pliers.datasets.text import _load_datasets
+from pliers.datasets import text
+from pliers.datasets.text import (_load_datasets, fetch_dictionary,
+                                  fetch_dictionaries)
+import numpy as np
+import pandas as pd
 import requests
 
 
@@ -13,3 +17,27 @@ def test_dicts_exist_at_url_and_initialize():
         # read_excel() is doing some weird things, so disable for the moment
         # data = fetch_dictionary(name, save=False)
         # assert isinstance(data.shape, tuple)
+
+
+def test_fetch_dictionaries(tmpdir, monkeypatch):
+    monkeypatch.setattr(text, '_get_dictionary_path', lambda: str(tmpdir))
+    # Dictionaries saved as CSV files are converted on first load
+    pd.DataFrame({'Word': ['Apple', 'pear'], 'V.Mean.Sum': [5.5, 6.],
+                  'A.Mean.Sum': [3, 4]}).to_csv(tmpdir.join('affect.csv'),
+                                                index=False)
+    data = fetch_dictionary('affect')
+    assert tmpdir.join('affect.npd').check(dir=True)
+    assert isinstance(data['V.Mean.Sum'].values.base, np.memmap)
+    assert data.loc['Apple', 'A.Mean.Sum'] == 3
+    tmpdir.join('affect.csv').remove()
+    assert fetch_dictionary('affect').equals(data)
+
+    merged = fetch_dictionaries({'affect': ['V.Mean.Sum']},
+                                case_sensitive=False)
+    assert list(merged.columns) == ['affect_V.Mean.Sum']
+    assert merged.loc['apple', 'affect_V.Mean.Sum'] == 5.5
+    assert len(tmpdir.join('merged').listdir()) == 1
+    again = fetch_dictionaries({'affect': ['V.Mean.Sum']},
+                               case_sensitive=False)
+    assert again.equals(merged)
+    assert len(tmpdir.join('merged').listdir()) == 1
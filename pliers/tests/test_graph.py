@@ -1,4 +1,5 @@
 import pytest
+from pliers import config
 from pliers.graph import Graph, Node
 from pliers.converters import (TesseractConverter,
                                VideoToAudioConverter,
@@ -6,8 +7,9 @@ from pliers.converters import (TesseractConverter,
 from pliers.filters import FrameSamplingFilter
 from pliers.extractors import (BrightnessExtractor, VibranceExtractor,
                                LengthExtractor, merge_results)
-from pliers.stimuli import (ImageStim, VideoStim)
-from .utils import get_test_data_path, DummyExtractor
+from pliers.stimuli import (ImageStim, VideoStim, TextStim)
+from .utils import (get_test_data_path, DummyExtractor, DummyAPIExtractor,
+                    api_stub)
 from os.path import join, exists
 from numpy.testing import assert_almost_equal
 import tempfile
@@ -101,6 +103,39 @@ def test_small_pipeline2():
     assert_almost_equal(vibrance, 841.577274, 5)
 
 
+def test_graph_executors():
+    default = config.cache_transformers
+    config.cache_transformers = False
+    video = VideoStim(join(get_test_data_path(), 'video', 'small.mp4'))
+    nodes = [(FrameSamplingFilter(every=20), [BrightnessExtractor(),
+                                              VibranceExtractor()]),
+             (FrameSamplingFilter(every=50), ['BrightnessExtractor'])]
+    graph = Graph(nodes)
+    serial = graph.run(video)
+    for executor in ['thread', 'process']:
+        result = graph.run(video, executor=executor)
+        assert result.equals(serial)
+    timings = graph.get_timings()
+    assert timings.shape == (5, 3)
+    assert (timings['wall_time'] > 0).all()
+    with pytest.raises(ValueError):
+        graph.run(video, executor='cluster')
+    config.cache_transformers = default
+
+
+def test_graph_run_async():
+    asyncio = pytest.importorskip('asyncio')
+    stims = [TextStim(text='x' * i) for i in range(1, 6)]
+    with api_stub(delay=0.1, fail_first=0) as server:
+        graph = Graph([DummyAPIExtractor(server.url), LengthExtractor()])
+        loop = asyncio.new_event_loop()
+        result = loop.run_until_complete(graph.run_async(stims))
+        loop.close()
+        assert server.requests == 3
+        assert graph.get_timings()['wall_time'].notnull().all()
+        assert result.equals(graph.run(stims))
+
+
 def test_small_pipeline_json_spec():
     pytest.importorskip('pytesseract')
     filename = join(get_test_data_path(), 'image', 'button.jpg')
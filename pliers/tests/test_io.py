@@ -1,12 +1,15 @@
-from .utils import get_test_data_path
-from pliers.stimuli import (load_stims, AudioStim, ImageStim)
-from pliers.extractors import (STFTAudioExtractor,
+from .utils import get_test_data_path, DummyExtractor, serve_directory
+from pliers.stimuli import (load_stims, AudioStim, ImageStim, TextStim)
+from pliers.extractors import (STFTAudioExtractor, merge_results,
                                GoogleVisionAPIFaceExtractor,
                                ExtractorResult)
-from pliers.export import to_long_format
+from pliers.export import (to_long_format, iter_long_format, ParquetExporter,
+                           HDF5Exporter)
 from pliers.graph import Graph
 from os.path import join
 from six import string_types
+import numpy as np
+import pandas as pd
 import pytest
 
 import pytest
@@ -24,6 +27,38 @@ def test_magic_loader():
     assert stims[2].width == 560
 
 
+def test_load_url_fetches_once():
+    data_dir = get_test_data_path()
+    with serve_directory(data_dir) as server:
+        url = server.url
+        stims = load_stims([url + 'image/apple.jpg',
+                            url + 'text/sample_text.txt'])
+        assert len(server.requests) == 2
+
+    assert isinstance(stims[0], ImageStim)
+    local = ImageStim(join(data_dir, 'image', 'apple.jpg'))
+    assert np.array_equal(stims[0].data, local.data)
+    assert stims[0].filename == url + 'image/apple.jpg'
+    assert isinstance(stims[1], TextStim)
+    with open(join(data_dir, 'text', 'sample_text.txt')) as f:
+        assert stims[1].text == f.read()
+
+
+def test_load_url_decodes_utf8(tmpdir):
+    # text/plain responses that don't declare a charset are read as UTF-8
+    text = u'caf\u00e9 na\u00efve \u2014 \u2615'
+    tmpdir.join('utf8.txt').write_binary(text.encode('utf-8'))
+    tmpdir.join('latin1.txt').write_binary(
+        u'Le caf\u00e9 est tr\u00e8s bon.'.encode('latin-1'))
+
+    with serve_directory(str(tmpdir)) as server:
+        url = server.url
+        assert load_stims(url + 'utf8.txt').text == text
+        assert TextStim(url=url + 'utf8.txt').text == text
+        # Other encodings are detected from the content
+        assert TextStim(url=url + 'latin1.txt').text.startswith('Le caf')
+
+
 def test_magic_loader2():
     text_file = join(get_test_data_path(), 'text', 'sample_text.txt')
     video_url = 'http://www.obamadownloads.com/videos/iran-deal-speech.mp4'
@@ -71,6 +106,88 @@ def test_convert_to_long():
     assert '100_300' not in long_timeline.columns
 
 
+def _get_timeline():
+    image_dir = join(get_test_data_path(), 'image')
+    stims = [ImageStim(join(image_dir, f)) for f in ['apple.jpg', 'obama.jpg']]
+    des = [DummyExtractor(name=name) for name in ['Extractor1', 'Extractor2']]
+    return merge_results([de.transform(s) for s in stims for de in des])
+
+
+def test_iter_long_format():
+    timeline = _get_timeline()
+    long_timeline = to_long_format(timeline)
+    n_features = timeline.shape[1] - 7
+    assert long_timeline.shape == (timeline.shape[0] * n_features, 10)
+    assert isinstance(long_timeline['extractor'].dtype, pd.CategoricalDtype)
+    assert isinstance(long_timeline['feature'].dtype, pd.CategoricalDtype)
+    row = long_timeline.iloc[n_features + 1]
+    assert row['onset'] == timeline['onset'].iloc[1]
+    # Rows missing a feature hold NaN, which np.testing treats as equal
+    np.testing.assert_equal(
+        row['value'], timeline[(row['extractor'], row['feature'])].iloc[1])
+
+    blocks = list(iter_long_format(timeline, chunk_size=100))
+    assert len(blocks) == int(np.ceil(timeline.shape[0] / 100.))
+    assert len(blocks[0]) == 100 * n_features
+    merged = pd.concat(blocks, ignore_index=True)
+    assert isinstance(merged['feature'].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(merged, long_timeline)
+
+
+def test_parquet_exporter(tmpdir):
+    pytest.importorskip('pyarrow')
+    timeline = _get_timeline()
+    path = str(tmpdir.join('timeline.parquet'))
+    ParquetExporter(row_group_size=50).export(timeline, path)
+    df = pd.read_parquet(path)
+    assert df.shape == timeline.shape
+    assert 'Extractor1_0' in df.columns
+    assert np.array_equal(df['onset'], timeline['onset'])
+
+    # Appending adds files to a dataset directory
+    path = str(tmpdir.join('dataset'))
+    exporter = ParquetExporter()
+    exporter.export(timeline, path, append=True)
+    exporter.export(timeline, path, append=True)
+    assert len(tmpdir.join('dataset').listdir()) == 2
+    assert len(pd.read_parquet(path)) == len(timeline) * 2
+
+    # Long format keeps extractor and feature names apart
+    path = str(tmpdir.join('long.parquet'))
+    ParquetExporter(row_group_size=50, long_format=True).export(timeline,
+                                                                path)
+    df = pd.read_parquet(path)
+    long_timeline = to_long_format(timeline)
+    assert df.shape == long_timeline.shape
+    assert set(df['extractor']) == {'Extractor1', 'Extractor2'}
+    np.testing.assert_array_equal(df['value'], long_timeline['value'])
+
+
+def test_hdf5_exporter(tmpdir):
+    pytest.importorskip('tables')
+    timeline = _get_timeline()
+    path = str(tmpdir.join('timeline.h5'))
+    exporter = HDF5Exporter(chunk_size=50)
+    exporter.export(timeline, path)
+    df = pd.read_hdf(path, 'timeline')
+    assert df.shape == timeline.shape
+    assert np.array_equal(df['Extractor2_1'], timeline[('Extractor2', 1)])
+
+    exporter.export(timeline, path, append=True)
+    assert len(pd.read_hdf(path, 'timeline')) == len(timeline) * 2
+    df = pd.read_hdf(path, 'timeline', where='onset < 50')
+    assert (df['onset'] < 50).all()
+    assert len(df) == (timeline['onset'] < 50).sum() * 2
+
+    path = str(tmpdir.join('long.h5'))
+    HDF5Exporter(chunk_size=50, long_format=True).export(timeline, path)
+    df = pd.read_hdf(path, 'timeline', where="extractor == 'Extractor1'")
+    long_timeline = to_long_format(timeline)
+    assert len(df) == (long_timeline['extractor'] == 'Extractor1').sum()
+    assert set(df['feature'].astype(str)) == set(
+        long_timeline['feature'].astype(str))
+
+
 @pytest.mark.skipif("'GOOGLE_APPLICATION_CREDENTIALS' not in os.environ")
 def test_convert_to_long_graph():
     image_dir = join(get_test_data_path(), 'image')
@@ -1,5 +1,6 @@
 from .utils import get_test_data_path
 from pliers.stimuli import (VideoStim, VideoFrameStim, ComplexTextStim,
+                            VideoFrameCollectionStim,
                             AudioStim, ImageStim, CompoundStim,
                             TranscribedAudioCompoundStim,
                             TextStim,
@@ -9,12 +10,17 @@ from pliers.stimuli.base import Stim, _get_stim_class
 from pliers.extractors import BrightnessExtractor, LengthExtractor
 from pliers.extractors.base import Extractor, ExtractorResult
 from pliers.support.download import download_nltk_data
+from pliers.cache import estimate_size
+from pliers import config
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from os.path import join, exists
 import os
 import pandas as pd
+import pickle
 import pytest
 import tempfile
+import time
 
 
 class DummyExtractor(Extractor):
@@ -58,6 +64,31 @@ def test_image_stim(dummy_iter_extractor):
     assert stim.data.shape == (288, 420, 3)
 
 
+def test_stim_digest():
+    # In-memory stims are distinguished by content, not metadata
+    s1 = ImageStim(data=np.zeros((10, 10, 3), dtype='uint8'))
+    s2 = ImageStim(data=np.ones((10, 10, 3), dtype='uint8'))
+    assert s1.digest != s2.digest
+    s2.data = np.zeros((10, 10, 3), dtype='uint8')
+    assert s1.digest == s2.digest
+
+    # The same file loaded through different paths shares a digest
+    filename = join(get_test_data_path(), 'image', 'apple.jpg')
+    s3 = ImageStim(filename)
+    s4 = ImageStim(join(get_test_data_path(), '..', 'data', 'image',
+                        'apple.jpg'))
+    assert s3.digest == s4.digest
+    s4.onset = 2.
+    assert s3.digest != s4.digest
+
+    t1, t2 = TextStim(text='hello'), TextStim(text='world')
+    assert t1.digest != t2.digest
+    complex_stim = ComplexTextStim(elements=[t1])
+    digest = complex_stim.digest
+    complex_stim.add_elem(t2)
+    assert complex_stim.digest != digest
+
+
 def test_video_stim():
     ''' Test VideoStim functionality. '''
     filename = join(get_test_data_path(), 'video', 'small.mp4')
@@ -97,6 +128,26 @@ def test_video_stim():
     assert f3.data.shape == (240, 320, 3)
 
 
+def test_video_frame_streaming():
+    filename = join(get_test_data_path(), 'video', 'small.mp4')
+    video = VideoFrameCollectionStim(filename, frame_index=list(range(0, 168, 10)))
+    streamed = list(video.iter_frames(prefetch=4))
+    unbuffered = list(video.iter_frames(prefetch=0))
+    assert len(streamed) == len(unbuffered) == video.n_frames
+    for i in [0, 5, 11]:
+        f = video.get_frame(index=i)
+        assert streamed[i].frame_num == f.frame_num
+        assert streamed[i].onset == f.onset
+        assert streamed[i].duration == f.duration
+        assert np.array_equal(streamed[i].data, f.data)
+        assert np.array_equal(unbuffered[i].data, f.data)
+
+    # Abandoning iteration early shouldn't leave the decoder hanging
+    frames = video.iter_frames(prefetch=2)
+    next(frames)
+    frames.close()
+
+
 def test_audio_stim(dummy_iter_extractor):
     audio_dir = join(get_test_data_path(), 'audio')
     stim = AudioStim(join(audio_dir, 'barber.wav'), sampling_rate=11025)
@@ -104,6 +155,108 @@ def test_audio_stim(dummy_iter_extractor):
     assert stim.sampling_rate == 11025
 
 
+def test_audio_stim_lazy_loading():
+    audio_dir = join(get_test_data_path(), 'audio')
+    stim = AudioStim(join(audio_dir, 'barber.wav'), sampling_rate=11025)
+    assert stim._data is None
+    window = stim.read(1., 2.)
+    assert window.shape == (11025,)
+    assert isinstance(stim.data, np.memmap)
+    assert stim.data.dtype == np.float32
+    assert np.array_equal(window, stim.data[11025:22050])
+
+    # Decoded samples are shared by stims loaded from the same file
+    stim2 = AudioStim(join(audio_dir, 'barber.wav'), sampling_rate=11025)
+    assert np.array_equal(stim2.data, stim.data)
+    assert stim2._data_file == stim._data_file
+
+    # Derivatives are computed once, and discarded when the data change
+    total = stim.get_derivative(('sum',), lambda: stim.data.sum())
+    assert stim.get_derivative(('sum',), lambda: None) == total
+    stim.data = stim.data[:100]
+    assert stim.get_derivative(('sum',), lambda: None) is None
+
+    # Least recently used derivatives are discarded beyond the byte budget
+    default = config.derivative_max_bytes
+    config.derivative_max_bytes = 250
+    try:
+        stim.data = np.zeros(10, dtype='float32')
+        stim.get_derivative(('a',), lambda: np.zeros(20))
+        stim.get_derivative(('b',), lambda: np.zeros(10))
+        stim.get_derivative(('a',), lambda: None)
+        stim.get_derivative(('c',), lambda: np.zeros(10))
+        assert list(stim._derivatives) == [('a',), ('c',)]
+        assert estimate_size(stim) >= 40 + 160 + 80
+        big = stim.get_derivative(('d',), lambda: np.zeros(100))
+        assert len(big) == 100
+        assert ('d',) not in stim._derivatives
+    finally:
+        config.derivative_max_bytes = default
+
+
+def test_audio_cache_dir(tmpdir):
+    audio_dir = join(get_test_data_path(), 'audio')
+    defaults = config.audio_cache_dir, config.audio_cache_max_bytes
+    config.audio_cache_dir = str(tmpdir)
+    try:
+        stim = AudioStim(join(audio_dir, 'barber.wav'), sampling_rate=11025)
+        data = np.array(stim.data)
+        assert stim._data_file.startswith(str(tmpdir))
+
+        # Least recently used files are removed beyond the byte budget, but
+        # stay readable while mapped
+        config.audio_cache_max_bytes = os.path.getsize(stim._data_file)
+        stim2 = AudioStim(join(audio_dir, 'homer.wav'), sampling_rate=11025)
+        stim2.data
+        assert [f.basename for f in tmpdir.listdir()] == \
+            [os.path.basename(stim2._data_file)]
+        assert np.array_equal(stim.data, data)
+        stim3 = AudioStim(join(audio_dir, 'barber.wav'), sampling_rate=11025)
+        assert np.array_equal(stim3.data, data)
+        assert exists(stim._data_file)
+    finally:
+        config.audio_cache_dir, config.audio_cache_max_bytes = defaults
+
+
+def test_image_stim_pickling():
+    filename = join(get_test_data_path(), 'image', 'apple.jpg')
+    stim = ImageStim(filename)
+    # Images loaded from files are re-read rather than pickled
+    data = pickle.dumps(stim)
+    assert len(data) < os.path.getsize(filename)
+    assert np.array_equal(pickle.loads(data).data, stim.data)
+    stim.data = stim.data[:10]
+    assert np.array_equal(pickle.loads(pickle.dumps(stim)).data, stim.data)
+
+
+def test_audio_stim_threads():
+    # Threads share one decoded copy of the samples, and one of each
+    # derivative
+    audio_dir = join(get_test_data_path(), 'audio')
+    stim = AudioStim(join(audio_dir, 'barber.wav'), sampling_rate=11025)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return stim.data.sum()
+
+    pool = ThreadPool(4)
+    try:
+        data = pool.map(lambda i: stim.data, range(4))
+        totals = pool.map(lambda i: stim.get_derivative(('sum',), compute),
+                          range(4))
+    finally:
+        pool.close()
+    assert all(d is data[0] for d in data)
+    assert len(calls) == 1
+    assert len(set(totals)) == 1
+
+    stim2 = pickle.loads(pickle.dumps(stim))
+    assert np.array_equal(stim2.data, stim.data)
+    assert stim2.get_derivative(('sum',), lambda: 0) == 0
+
+
 def test_audio_formats():
     audio_dir = join(get_test_data_path(), 'audio')
     stim = AudioStim(join(audio_dir, 'crowd.mp3'))
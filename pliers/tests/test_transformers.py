@@ -1,12 +1,18 @@
-from pliers.transformers import get_transformer
+from pliers.transformers import get_transformer, BatchSizer
 from pliers.extractors import (STFTAudioExtractor, BrightnessExtractor, ExtractorResult)
 from pliers.stimuli.base import TransformationLog
 from pliers.stimuli import ImageStim, VideoStim, TextStim
-from pliers import config
+from pliers import config, parallel
+from pliers.cache import get_cache
 from os.path import join
-from .utils import get_test_data_path, DummyExtractor, DummyBatchExtractor
+from .utils import (get_test_data_path, DummyExtractor, DummyBatchExtractor,
+                    DummyAPIExtractor, DummyMeanExtractor, api_stub)
 import numpy as np
+import os
+import pickle
 import pytest
+import requests
+import time
 
 
 def test_get_transformer_by_name():
@@ -37,14 +43,12 @@ def test_transform_with_string_input():
 
 
 def test_parallelization():
-    # TODO: test that parallelization actually happened (this will likely
-    # require some new logging functionality, or introspection). For now we
-    # just make sure the parallelized version produces the same result.
-    default = config.parallelize
+    default = config.parallelize, config.cache_transformers
+    config.cache_transformers = False
 
     filename = join(get_test_data_path(), 'video', 'small.mp4')
     video = VideoStim(filename)
-    ext = BrightnessExtractor()
+    ext = DummyMeanExtractor()
 
     # With parallelization
     config.parallelize = True
@@ -54,8 +58,69 @@ def test_parallelization():
     config.parallelize = False
     result2 = ext.transform(video)
 
-    assert result1 == result2
-    config.parallelize = default
+    assert len(result1) == len(result2)
+    assert all(r1.to_df()['mean'][0] == r2.to_df()['mean'][0]
+               for r1, r2 in zip(result1, result2))
+    assert all(r.to_df()['pid'][0] != os.getpid() for r in result1)
+    assert all(r.to_df()['pid'][0] == os.getpid() for r in result2)
+    config.parallelize, config.cache_transformers = default
+
+
+def test_parallel_pool():
+    default = config.parallelize, config.n_jobs
+    config.parallelize, config.n_jobs = True, 2
+    get_cache().clear()
+    image_dir = join(get_test_data_path(), 'image')
+    imgs = [ImageStim(join(image_dir, f))
+            for f in ['apple.jpg', 'button.jpg', 'obama.jpg']]
+    ext = DummyMeanExtractor()
+    results = ext.transform(imgs)
+    pool = parallel.get_pool()
+    # Results refer to the caller's Transformer and Stims, not copies
+    assert all(r.extractor is ext for r in results)
+    assert all(r.stim is img for r, img in zip(results, imgs))
+    assert all(r.to_df()['mean'][0] == ext._extract(img).to_df()['mean'][0]
+               for r, img in zip(results, imgs))
+    assert all(r.to_df()['pid'][0] != os.getpid() for r in results)
+
+    video = VideoStim(join(get_test_data_path(), 'video', 'small.mp4'))
+    frames = ext.transform(video)
+    assert len(frames) == 168
+    assert frames[5].stim.video is frames[6].stim.video
+    assert parallel.get_pool() is pool
+    parallel.shutdown_pool()
+    config.parallelize, config.n_jobs = default
+
+
+def test_parallel_tasks_are_light(tmpdir):
+    context = parallel._Context(DummyMeanExtractor(), str(tmpdir))
+    # Images loaded from files are sent as references to them
+    filename = join(get_test_data_path(), 'image', 'apple.jpg')
+    task, blocks = context.dump_task(ImageStim(filename), (), {})
+    assert len(task[2]) < os.path.getsize(filename)
+    assert not blocks
+
+    # Frames are passed in shared memory, if available
+    video = VideoStim(join(get_test_data_path(), 'video', 'small.mp4'))
+    frame = next(iter(video))
+    task, blocks = context.dump_task(frame, (), {})
+    if parallel.shared_memory is not None:
+        assert len(task[2]) < 1000
+        assert len(blocks) == 1
+    stim = parallel._loads(task[2], load_shared=context.objects.get)[0]
+    parallel._release(blocks)
+    assert np.array_equal(stim.data, frame.data)
+
+
+def test_batch_transformer_with_string_input():
+    image_dir = join(get_test_data_path(), 'image')
+    paths = [join(image_dir, f) for f in ['apple.jpg', 'obama.jpg']]
+    results = BrightnessExtractor().transform(paths)
+    assert len(results) == 2
+    assert [r.stim.filename for r in results] == paths
+    assert results[0].history is not None
+    expected = BrightnessExtractor().transform(ImageStim(paths[1]))
+    assert np.allclose(results[1].to_numpy(), expected.to_numpy())
 
 
 def test_batch_transformer():
@@ -72,6 +137,41 @@ def test_batch_transformer():
     assert res.equals(res2)
 
 
+def test_batch_byte_budget():
+    image_dir = join(get_test_data_path(), 'image')
+    imgs = [ImageStim(join(image_dir, f))
+            for f in ['apple.jpg', 'button.jpg', 'obama.jpg']]
+    ext = DummyBatchExtractor(batch_bytes=1)
+    ext.transform(imgs)
+    assert ext.num_calls == 3
+    budget = imgs[0].data.nbytes + imgs[1].data.nbytes
+    ext = DummyBatchExtractor(batch_bytes=budget)
+    results = ext.transform(imgs)
+    assert ext.num_calls == 2
+    assert [r.stim for r in results] == imgs
+
+
+def test_adaptive_batch_size():
+    sizer = BatchSizer(8, 1.0)
+    for size in [2, 4, 8, 8]:
+        sizer.update(sizer.size, 0.1)
+        assert sizer.size == size
+    sizer.update(8, 4.0)
+    assert sizer.size == 2
+    sizer.update(2)
+    assert sizer.size == 1
+
+    default = config.adaptive_batching
+    config.adaptive_batching = True
+    img = ImageStim(join(get_test_data_path(), 'image', 'apple.jpg'))
+    ext = DummyBatchExtractor(batch_size=4)
+    results = ext.transform([img] * 7)
+    # Batches of 1, 2 and 4
+    assert ext.num_calls == 3
+    assert len(results) == 7
+    config.adaptive_batching = default
+
+
 def test_validation_levels(capsys):
     ext = BrightnessExtractor()
     stim = TextStim(text='hello world')
@@ -97,3 +197,60 @@ def test_versioning():
     assert ext.VERSION == '0.1'
     ext = BrightnessExtractor()
     assert ext.VERSION >= '1.0'
+
+
+def test_digest_is_stable():
+    from nltk.tokenize import TreebankWordTokenizer, RegexpTokenizer
+    from pliers.filters import TokenizingFilter
+    filt = TokenizingFilter(tokenizer=TreebankWordTokenizer())
+    stim = TextStim(text='some words')
+    # Logged attributes that only have the default repr don't make the key
+    # depend on where they are in memory
+    copy = pickle.loads(pickle.dumps(filt))
+    assert copy.tokenizer is not filt.tokenizer
+    assert copy.digest == filt.digest
+    assert copy._get_cache_key(stim) == filt._get_cache_key(stim)
+    assert TokenizingFilter(tokenizer=RegexpTokenizer(r'\w+')).digest != \
+        TokenizingFilter(tokenizer=RegexpTokenizer(r'\s+')).digest
+
+
+def test_transform_async():
+    asyncio = pytest.importorskip('asyncio')
+    default = config.cache_transformers, config.api_rate_limits
+    config.cache_transformers = False
+    stims = [TextStim(text='x' * i) for i in range(1, 9)]
+    loop = asyncio.new_event_loop()
+
+    with api_stub(delay=0.2, fail_first=1) as server:
+        ext = DummyAPIExtractor(server.url)
+
+        # 4 batches of 2, sent concurrently; the first request fails once
+        start = time.time()
+        results = loop.run_until_complete(
+            ext.transform_async(stims, max_in_flight=4, retry_backoff=0.01))
+        assert time.time() - start < 0.8
+        assert server.requests == 5
+        assert [r.data[0][0] for r in results] == list(range(1, 9))
+        assert all(r.stim is s for r, s in zip(results, stims))
+
+        # Requests are spaced out according to the configured rate limit
+        config.api_rate_limits = {'DummyAPIExtractor': 5}
+        start = time.time()
+        loop.run_until_complete(ext.transform_async(stims, max_in_flight=4))
+        assert time.time() - start > 0.6
+
+        server.requests = -10
+        with pytest.raises(Exception):
+            loop.run_until_complete(
+                ext.transform_async(stims[:2], max_retries=0))
+
+    # Client errors aren't retried
+    with api_stub(delay=0, fail_first=1, fail_status=400) as server:
+        with pytest.raises(requests.HTTPError):
+            loop.run_until_complete(
+                DummyAPIExtractor(server.url).transform_async(
+                    stims[:2], retry_backoff=0.01))
+        assert server.requests == 1
+
+    loop.close()
+    config.cache_transformers, config.api_rate_limits = default
@@ -1,8 +1,16 @@
 from os.path import dirname, join
-from pliers.stimuli import ImageStim
+from pliers.stimuli import ImageStim, TextStim
 from pliers.extractors.base import Extractor, ExtractorResult
 from pliers.transformers import BatchTransformerMixin
+from pliers.utils import EnvironmentKeyMixin
+from six.moves import BaseHTTPServer, SimpleHTTPServer, socketserver
+from contextlib import contextmanager
 import numpy as np
+import json
+import os
+import requests
+import threading
+import time
 from copy import deepcopy
 
 
@@ -35,6 +43,17 @@ class DummyExtractor(Extractor):
         return ExtractorResult(data, stim, deepcopy(self), onsets=onsets)
 
 
+class DummyMeanExtractor(Extractor):
+
+    ''' Returns the mean of the image, along with the ID of the process the
+    extraction ran in. Not a batch Extractor, so it can be parallelized. '''
+    _input_type = ImageStim
+
+    def _extract(self, stim):
+        return ExtractorResult([[stim.data.mean(), os.getpid()]], stim, self,
+                               features=['mean', 'pid'])
+
+
 class DummyBatchExtractor(BatchTransformerMixin, Extractor):
 
     _input_type = ImageStim
@@ -50,3 +69,97 @@ class DummyBatchExtractor(BatchTransformerMixin, Extractor):
         for s in stims:
             results.append(ExtractorResult([[len(s.name)]], s, self))
         return results
+
+
+class DummyAPIExtractor(BatchTransformerMixin, Extractor, EnvironmentKeyMixin):
+
+    ''' A batch Extractor that queries an HTTP service (e.g., the stub
+    run by api_stub()) for the length of each TextStim. '''
+
+    _input_type = TextStim
+    _batch_size = 2
+    _env_keys = ()
+
+    def __init__(self, url, *args, **kwargs):
+        self.url = url
+        super(DummyAPIExtractor, self).__init__(*args, **kwargs)
+
+    def _extract(self, stims):
+        response = requests.post(self.url, json=[s.text for s in stims],
+                                 timeout=10)
+        response.raise_for_status()
+        return [ExtractorResult([[v]], s, self, features=['length'])
+                for s, v in zip(stims, response.json())]
+
+
+@contextmanager
+def _serve(handler):
+    # Runs a local HTTP server in a background thread, and stops it on exit
+    class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), handler)
+    server.url = 'http://127.0.0.1:%d/' % server.server_port
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextmanager
+def serve_directory(path):
+    ''' Serves the files in path over HTTP for the duration of a with block.
+    Yields the server, whose url attribute is the URL of path, and whose
+    requests attribute lists the paths requested. '''
+
+    class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+        def translate_path(self, request_path):
+            server.requests.append(request_path)
+            return join(path, *request_path.strip('/').split('/'))
+
+        def log_message(self, *args):
+            pass
+
+    with _serve(Handler) as server:
+        server.requests = []
+        yield server
+
+
+@contextmanager
+def api_stub(delay=0.2, fail_first=1, fail_status=503):
+    ''' Runs a local HTTP service, for the duration of a with block, that
+    responds to a POSTed list of strings with their lengths after a delay.
+    The first fail_first requests fail with the fail_status status code.
+    Yields the server, whose url attribute is the service's URL, and whose
+    requests attribute counts the requests received. '''
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            with lock:
+                server.requests += 1
+                n = server.requests
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            time.sleep(delay)
+            if n <= fail_first:
+                self.send_response(fail_status)
+                self.end_headers()
+                return
+            data = json.dumps([len(t) for t in json.loads(body.decode())])
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(data.encode())
+
+        def log_message(self, *args):
+            pass
+
+    lock = threading.Lock()
+    with _serve(Handler) as server:
+        server.requests = 0
+        yield server
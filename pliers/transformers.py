@@ -1,21 +1,65 @@
 ''' Core transformer logic. '''
 
 from pliers import config
+from pliers.cache import get_cache, estimate_size
+from pliers.parallel import parallel_transform
 from pliers.stimuli.base import Stim, _log_transformation, load_stims
 from pliers.stimuli.compound import CompoundStim
 from pliers.utils import (progress_bar_wrapper, isiterable,
-                          isgenerator, listify, batch_iterable,
-                          attempt_to_import)
+                          isgenerator, listify)
 import pliers
 from six import with_metaclass, string_types
 from abc import ABCMeta, abstractmethod, abstractproperty
+import hashlib
 import importlib
 import logging
-
-multiprocessing = attempt_to_import('pathos.multiprocessing',
-                                    'multiprocessing', ['ProcessingPool'])
-
-_cache = {}
+import numpy as np
+import pandas as pd
+import re
+import time
+
+
+_address = re.compile(r' at 0x[0-9a-fA-F]+')
+
+
+def _stable_repr(value, depth=0):
+    ''' Returns a representation of a logged attribute that doesn't depend on
+    where it lives in memory, so Transformer digests match across processes
+    (and after pickling). Objects with the default repr are represented by
+    their class and parameters (get_params(), if they have it, or else their
+    attributes); arrays and pandas objects by a hash of their contents. '''
+    if depth > 4:
+        return '...'
+    if isinstance(value, dict):
+        items = sorted((str(k), _stable_repr(v, depth + 1))
+                       for k, v in value.items())
+        return '{%s}' % ', '.join('%s: %s' % item for item in items)
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(_stable_repr(v, depth + 1) for v in value)
+    if isinstance(value, np.ndarray):
+        return 'ndarray(%s, %s, %s)' % (
+            value.dtype, value.shape,
+            hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest())
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        hashed = pd.util.hash_pandas_object(value).values
+        return '%s(%s, %s)' % (type(value).__name__,
+                               list(getattr(value, 'columns', [])),
+                               hashlib.sha1(hashed.tobytes()).hexdigest())
+    if isinstance(value, type) or callable(value) and \
+            hasattr(value, '__qualname__'):
+        return '%s.%s' % (getattr(value, '__module__', ''),
+                          value.__qualname__)
+    cls = type(value)
+    # e.g., scikit-learn estimators, whose reprs may be abbreviated
+    if hasattr(value, 'get_params') or cls.__repr__ is object.__repr__:
+        if hasattr(value, 'get_params'):
+            params = value.get_params()
+        else:
+            params = getattr(value, '__dict__', {})
+        return '%s.%s(%s)' % (cls.__module__, cls.__name__,
+                              _stable_repr(params, depth + 1))
+    # Any addresses left in custom reprs are dropped
+    return _address.sub('', repr(value))
 
 
 class Transformer(with_metaclass(ABCMeta)):
@@ -40,14 +84,17 @@ class Transformer(with_metaclass(ABCMeta)):
         def wrapper(self, stim, *args, **kwargs):
             use_cache = config.cache_transformers and isinstance(stim, Stim)
             if use_cache:
-                key = hash((hash(self), hash(stim)))
-                if key in _cache:
-                    return _cache[key]
+                cache = get_cache()
+                key = self._get_cache_key(stim)
+                try:
+                    return cache.get(key, self, stim)
+                except KeyError:
+                    pass
             result = transform(self, stim, *args, **kwargs)
             if use_cache:
                 if isgenerator(result):
                     result = list(result)
-                _cache[key] = result
+                cache.set(key, result, self, stim)
             return result
         return wrapper
 
@@ -96,6 +143,29 @@ class Transformer(with_metaclass(ABCMeta)):
                     result = list(result)
                 return result
 
+    def transform_async(self, stims, max_in_flight=None, max_retries=None,
+                        retry_backoff=None):
+        ''' Coroutine version of transform() for Transformers that query
+        remote services. Stims are sent in concurrent requests (one per
+        batch, for batch Transformers) from a pool of threads; requests are
+        spaced out according to config.api_rate_limits, and requests that
+        fail with a connection error, a timeout, or a 429/5xx response are
+        retried with exponential backoff. Requires Python 3.5+.
+        Args:
+            stims (Stim, list): The Stim(s) to transform.
+            max_in_flight (int): Maximum number of concurrent requests.
+                Defaults to config.api_max_in_flight.
+            max_retries (int): Number of times a failed request is retried
+                before the error is raised. Defaults to
+                config.api_max_retries.
+            retry_backoff (float): Seconds to wait before the first retry;
+                the wait doubles with every subsequent retry. Defaults to
+                config.api_retry_backoff.
+        '''
+        from pliers.asynchronous import transform_async
+        return transform_async(self, stims, max_in_flight, max_retries,
+                               retry_backoff)
+
     def _validate(self, stim):
         if not self._stim_matches_input_types(stim):
             from pliers.converters.base import get_converter
@@ -135,10 +205,14 @@ class Transformer(with_metaclass(ABCMeta)):
 
     def _iterate(self, stims, *args, **kwargs):
 
-        if config.parallelize and multiprocessing is not None:
-            def _transform(s):
-                return self.transform(s, *args, **kwargs)
-            return multiprocessing.ProcessingPool(config.n_jobs).map(_transform, stims)
+        if config.parallelize:
+            try:
+                return parallel_transform(self, stims, *args, **kwargs)
+            except Exception as err:
+                # E.g., Transformers holding API clients can't be pickled
+                logging.warning("Unable to parallelize %s; transforming "
+                                "stims serially instead (%s)." %
+                                (self.name, err))
 
         return (t for t in (self.transform(s, *args, **kwargs) for s in stims) if t)
 
@@ -150,29 +224,152 @@ class Transformer(with_metaclass(ABCMeta)):
     def _input_type(self):
         pass
 
+    @property
+    def digest(self):
+        ''' A hex digest of the Transformer's class, VERSION, name and logged
+        attributes that is stable across processes (see _stable_repr()). '''
+        attrs = [(attr, _stable_repr(getattr(self, attr)))
+                 for attr in self._log_attributes]
+        key = '%s/%s/%s/%s' % (self.__class__.__name__, self.VERSION,
+                               self.name, attrs)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _get_cache_key(self, stim):
+        return hashlib.sha1((self.digest + stim.digest).encode()).hexdigest()
+
     def __hash__(self):
         tr_attrs = [getattr(self, attr) for attr in self._log_attributes]
         return hash(self.name + str(dict(zip(self._log_attributes, tr_attrs))))
 
 
+class BatchSizer(object):
+
+    ''' Adapts the number of stims per batch to observed latencies, in the
+    manner of TCP congestion control: the size doubles after every full batch
+    that completes within the target latency (up to the maximum), and is cut
+    to the size expected to meet the target--at least halving it--after a
+    batch that takes too long or fails.
+    Args:
+        max_size (int): Maximum number of stims per batch.
+        target_latency (float): Target duration of a batch, in seconds.
+    '''
+
+    def __init__(self, max_size, target_latency):
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.size = 1
+
+    def update(self, n, latency=None):
+        ''' Records a batch of n stims that took latency seconds, or that
+        failed if latency is None. '''
+        if latency is not None and latency <= self.target_latency:
+            if n >= self.size:
+                self.size = min(self.size * 2, self.max_size)
+        else:
+            fit = int(n * self.target_latency / latency) if latency else 0
+            self.size = max(1, min(fit, n // 2))
+
+
 class BatchTransformerMixin(Transformer):
     ''' A mixin that overrides the default implicit iteration behavior. Use
     whenever batch processing of multiple stimuli should be handled within the
     _transform method rather than applying a naive loop--e.g., for API
-    Extractors that can handle list inputs. '''
+    Extractors that can handle list inputs.
 
-    def __init__(self, batch_size=None, *args, **kwargs):
+    Batches hold at most _batch_size stims and, if _batch_bytes is set, at
+    most _batch_bytes of (estimated) payload. If config.adaptive_batching is
+    True, the number of stims per batch is also tuned from the latencies of
+    previous batches (see BatchSizer).
+    Args:
+        batch_size (int): Maximum number of stims per batch. Defaults to the
+            class's _batch_size.
+        batch_bytes (int): Maximum estimated payload of a batch, in bytes.
+            Defaults to the class's _batch_bytes.
+    '''
+
+    _batch_bytes = None
+
+    def __init__(self, batch_size=None, batch_bytes=None, *args, **kwargs):
         if batch_size:
             self._batch_size = batch_size
+        if batch_bytes:
+            self._batch_bytes = batch_bytes
+        self._batch_sizer = None
         super(BatchTransformerMixin, self).__init__(*args, **kwargs)
 
+    def _get_stim_size(self, stim):
+        ''' Returns the estimated payload (in bytes) a stim adds to a batch.
+        Subclasses should override this when the payload differs from the
+        size of the stim's data in memory (e.g., for encoded images). '''
+        return estimate_size(getattr(stim, 'data', stim))
+
+    def _get_batch_sizer(self):
+        if not config.adaptive_batching:
+            return None
+        sizer = getattr(self, '_batch_sizer', None)
+        if sizer is None or sizer.max_size != self._batch_size or \
+                sizer.target_latency != config.batch_target_latency:
+            sizer = BatchSizer(self._batch_size, config.batch_target_latency)
+            self._batch_sizer = sizer
+        return sizer
+
+    def _iter_batches(self, stims):
+        ''' Splits stims into batches, lazily; see the class docstring. A
+        stim whose payload alone exceeds _batch_bytes gets a batch of its
+        own. '''
+        batch, n_bytes = [], 0
+        for stim in stims:
+            size = self._get_stim_size(stim) if self._batch_bytes else 0
+            if batch:
+                sizer = self._get_batch_sizer()
+                max_size = sizer.size if sizer else self._batch_size
+                if len(batch) >= max_size or (self._batch_bytes and
+                                              n_bytes + size >
+                                              self._batch_bytes):
+                    yield batch
+                    batch, n_bytes = [], 0
+            batch.append(stim)
+            n_bytes += size
+        if batch:
+            yield batch
+
     def _iterate(self, stims, *args, **kwargs):
-        batches = batch_iterable(stims, self._batch_size)
         results = []
-        for batch in batches:
-            res = self._transform(batch, *args, **kwargs)
-            for i, stim in enumerate(batch):
-                res[i] = _log_transformation(stim, res[i], self)
+        stims = (load_stims(s) if isinstance(s, string_types) else s
+                 for s in stims)
+        for batch in self._iter_batches(stims):
+            # With a persistent cache, only send stims without a stored
+            # result on to _transform, so interrupted jobs can resume
+            res, keys = [None] * len(batch), [None] * len(batch)
+            cache = get_cache() if config.cache_transformers else None
+            if cache is not None and cache.persistent:
+                for i, stim in enumerate(batch):
+                    if not isinstance(stim, Stim):
+                        continue
+                    keys[i] = self._get_cache_key(stim)
+                    try:
+                        res[i] = cache.get(keys[i], self, stim)
+                    except KeyError:
+                        pass
+            todo = [i for i, r in enumerate(res) if r is None]
+            if todo:
+                sizer = self._get_batch_sizer()
+                start = time.time()
+                try:
+                    new = self._transform([batch[i] for i in todo], *args,
+                                          **kwargs)
+                except Exception:
+                    if sizer is not None:
+                        sizer.update(len(todo))
+                    raise
+                if sizer is not None:
+                    sizer.update(len(todo), time.time() - start)
+                for i, r in zip(todo, new):
+                    res[i] = _log_transformation(batch[i], r, self)
+                    if keys[i] is not None and res[i] is not None:
+                        if isgenerator(res[i]):
+                            res[i] = list(res[i])
+                        cache.set(keys[i], res[i], self, batch[i])
             results.extend(res)
         return results
 
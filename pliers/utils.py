@@ -1,6 +1,8 @@
 import collections
 import os
+import threading
 from six import string_types
+from six.moves import queue
 from tqdm import tqdm
 from pliers import config
 from pliers.support.exceptions import MissingDependencyError
@@ -34,6 +36,52 @@ def batch_iterable(l, n):
         piece = list(islice(i, n))
 
 
+def prefetch_iterable(iterable, n):
+    ''' Consumes an iterable in a background thread, keeping up to n items
+    buffered ahead of the caller. Exceptions raised while producing items are
+    re-raised in the consuming thread. '''
+    buffer = queue.Queue(n)
+    stop = threading.Event()
+    end = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+            else:
+                put((end, None))
+        except Exception as err:
+            put((end, err))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, err = buffer.get()
+            if err is not None:
+                raise err
+            if item is end:
+                break
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
 class classproperty(object):
     ''' Implements a @classproperty decorator analogous to @classmethod.
     Solution from: http://stackoverflow.com/questions/128573/using-property-on-classmethodss